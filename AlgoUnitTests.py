@@ -2,87 +2,267 @@ import unittest
 
 import Algorithm
 from Algorithm import *
-import random
-
-class virtual_deck:
-    def __init__(self):
-        self.deck_list=['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']*4*8
-        random.shuffle(self.deck_list)  # Shuffle the deck when it's created
-        self.Alori = Algorithm()
-
-    # draws a random card and removes it from deck_list
-    def draw_card(self)->CardRank:
-        card = self.deck_list.pop()
-        print(self.deck_list)
-        print(card)
-        return CardRank(card)
-
-    def deck_total(self):
-        return len(self.deck_list)
-
-def test_bruh():
-        player_total = 0
-        hands_played = 0
-        algo = Algorithm(8)
-        deck = virtual_deck()
-        while (deck.deck_total() > 100):
-            dealer_cards = []
-            dealer_cards.append(deck.draw_card())
-            player_cards = []
-            player_cards.append(deck.draw_card())
-            player_cards.append(deck.draw_card())
-
-            player_action = True
-
-            doubled = 1
-            while(player_action):
-                action = algo.action(dealer_cards[0], player_cards)
-                if(action == 0): # stand
-                    player_action = False
-                elif(action == 1): # hit
-                    player_cards.append(deck.draw_card())
-                elif(action == 2): #double
-                    player_cards.append(deck.draw_card())
-                    player_action = False
-                    doubled = 2
-            if sum(card.worth() for card in dealer_cards) > 21:
-                player_total += 1*doubled
-            else:
-                while (sum(card.worth() for card in dealer_cards) < 17):
-                    dealer_cards.append(deck.draw_card())
-                    if deck.deck_total() == 0:
-                        break
-                deal_number = sum(card.worth() for card in dealer_cards)
-                player_number = sum(card.worth() for card in player_cards)
-                if  deal_number > 21:
-                    player_total += 1*doubled
-                elif deal_number == player_number:
-                    continue
-                elif player_number>deal_number:
-                    player_total += 1*doubled
-                elif deal_number>player_number:
-                    player_total -=1*doubled
-            hands_played +=1
-            for card in player_cards:
-                algo.remove_card_from_shoe(card)
-            for card in dealer_cards:
-                algo.remove_card_from_shoe(card)
-        algo.print_show()
-        print("Player value left: "+str(player_total))
-        return player_total, hands_played
+import time
 
 class TestAlgorithm(unittest.TestCase):
     #TODO write more tests for algo to see if they follow basic strategy
     def test_getEV_Algo(self):
-        ev = []
-        hands_played = 0
-        for i in range(30):
-            bets_change, hands = test_bruh()
-            ev.append(bets_change)
-            hands_played = hands_played + hands
-        print("Total bets change: " + str(sum(ev)))
-        print("Total of hands played: " + str(hands_played))
+        # a few single deck shoes; python Simulation.py exact 8 30 plays the long run
+        from Simulation import AlgorithmStrategy, simulate
+        in_process = simulate(AlgorithmStrategy(surrender=False), num_decks=1, shoes=4, seed=0, workers=0,
+                              shoes_per_task=2)
+        pooled = simulate(AlgorithmStrategy(surrender=False), num_decks=1, shoes=4, seed=0, workers=2,
+                          shoes_per_task=2)
+        self.assertEqual(in_process[:3], pooled[:3])
+        # a single deck dealt to 75% gives about 7 hands per shoe
+        self.assertGreater(in_process.hands, 4 * 5)
+        self.assertLess(abs(in_process.ev_per_hand), 4 * in_process.standard_error)
 
+    def test_simulation_is_reproducible(self):
+        from Simulation import BasicStrategy, simulate
+        in_process = simulate(BasicStrategy(), num_decks=6, shoes=40, seed=3, workers=0, shoes_per_task=10)
+        pooled = simulate(BasicStrategy(), num_decks=6, shoes=40, seed=3, workers=2, shoes_per_task=10)
+        self.assertEqual(in_process[:3], pooled[:3])
+        self.assertGreater(in_process.hands, 40 * 30)
+        # basic strategy without splits loses around one percent
+        self.assertLess(abs(in_process.ev_per_hand + 0.01), 4 * in_process.standard_error)
+
+    def test_nothing_to_simulate_is_rejected(self):
+        from Monte_Carlo import MonteCarlo
+        from Simulation import BasicStrategy, simulate
+        with self.assertRaisesRegex(ValueError, "shoes"):
+            simulate(BasicStrategy(), shoes=0, workers=0)
+        with self.assertRaisesRegex(ValueError, "samples"):
+            MonteCarlo(seed=0).estimate(Algorithm(1, workers=0).shoe.state(), 10, 16, False, False, True, samples=0)
+
+    def test_cache_reuses_states(self):
+        algo = Algorithm(1, workers=0)
+        first = algo.action(CardRank.NINE, [CardRank.EIGHT, CardRank.FOUR])
+        hits, misses = algo.cache_hits, algo.cache_misses
+        second = algo.action(CardRank.NINE, [CardRank.EIGHT, CardRank.FOUR])
+        self.assertEqual(first, second)
+        self.assertEqual(algo.cache_misses, misses)
+        self.assertGreater(algo.cache_hits, hits)
+
+    def test_cache_is_bounded(self):
+        algo = Algorithm(1, cache_size=50, workers=0)
+        algo.action(CardRank.NINE, [CardRank.EIGHT, CardRank.FOUR])
+        self.assertLessEqual(algo.cache_info()["size"], 50)
+
+    def test_default_cache_fits_memory_budget(self):
+        in_process, pooled = Algorithm(1, workers=0), Algorithm(1, workers=4)
+        self.assertEqual(in_process.cache_size, 4 * pooled.cache_size)
+        self.assertLessEqual(in_process.cache_size * Algorithm.CACHE_ENTRY_BYTES, Algorithm.CACHE_MEMORY_BUDGET)
+        self.assertEqual(Algorithm(1, cache_size=10, workers=4).cache_size, 10)
+
+    def test_dealer_distribution_sums_to_one(self):
+        algo = Algorithm(1)
+        for upcard in (CardRank.TWO, CardRank.SIX, CardRank.TEN, CardRank.ACE):
+            total = upcard.worth()
+            distribution = algo.dealer_distribution(list(algo.shoe.value_counts), total,
+                                                    upcard is CardRank.ACE, total >= 10)
+            self.assertEqual(len(distribution), Algorithm.DEALER_OUTCOMES)
+            self.assertAlmostEqual(sum(distribution), 1.0)
+            self.assertAlmostEqual(Algorithm.dealer_blackjack_chance(algo.shoe.state(), total, total >= 10),
+                                   distribution[Algorithm.DEALER_BLACKJACK])
+
+    def test_value_classes_merge_ten_ranks(self):
+        algo = Algorithm(2)
+        self.assertEqual(algo.shoe.state(), (8, 8, 8, 8, 8, 8, 8, 8, 8, 32))
+        algo.remove_card_from_shoe(CardRank.KING)
+        algo.remove_card_from_shoe(CardRank.ACE)
+        self.assertEqual(algo.shoe.value_counts[CardRank.TEN.value_class()], 31)
+        self.assertEqual(algo.shoe.value_counts[ACE_CLASS], 7)
+
+    def test_hand_total_handles_aces(self):
+        self.assertEqual(Algorithm.hand_total([CardRank.ACE, CardRank.SIX]), (17, True))
+        self.assertEqual(Algorithm.hand_total([CardRank.ACE, CardRank.FIVE, CardRank.TEN]), (16, False))
+        self.assertEqual(Algorithm.hand_total([CardRank.ACE, CardRank.ACE]), (12, True))
+
+    def test_process_pool_matches_in_process(self):
+        pooled = Algorithm(1, workers=2)
+        try:
+            for player_cards in ([CardRank.EIGHT, CardRank.FOUR], [CardRank.ACE, CardRank.SIX]):
+                self.assertEqual(pooled.action(CardRank.NINE, player_cards),
+                                 Algorithm(1, workers=0).action(CardRank.NINE, player_cards))
+        finally:
+            pooled.shutdown()
+
+    def test_start_evaluators_before_deciding(self):
+        pooled = Algorithm(1, workers=2)
+        try:
+            pooled.start_evaluators()
+            executor = pooled._executor
+            self.assertIsNotNone(executor)
+            self.assertEqual(pooled.action(CardRank.TEN, [CardRank.TEN, CardRank.SIX]),
+                             Algorithm(1, workers=0).action(CardRank.TEN, [CardRank.TEN, CardRank.SIX]))
+            self.assertIs(pooled._executor, executor)
+        finally:
+            pooled.shutdown()
+
+    def test_action_batch_matches_single_hands(self):
+        algo = Algorithm(1, workers=0, surrender=False, max_splits=0)
+        hands = [[CardRank.EIGHT, CardRank.FOUR], [CardRank.TEN, CardRank.KING], [CardRank.SEVEN, CardRank.FIVE]]
+        batch = algo.action_batch(CardRank.SIX, hands)
+        self.assertEqual(len(batch), len(hands))
+        self.assertEqual(batch[0], batch[2])
+        for player_cards, expected_values in zip(hands, batch):
+            self.assertEqual(set(expected_values), {Action.HIT, Action.STAND, Action.DOUBLE})
+            self.assertEqual(Algorithm.best_action(expected_values), algo.action(CardRank.SIX, player_cards))
+
+    def test_observe_cards_is_atomic(self):
+        algo = Algorithm(1, workers=0)
+        version = algo.shoe.version
+        algo.observe_cards([CardRank.KING, CardRank.FIVE, CardRank.FIVE])
+        self.assertEqual(algo.shoe.version, version + 1)
+        self.assertEqual(algo.shoe.rank_counts[CardRank.FIVE], 2)
+        with self.assertRaises(ValueError):
+            algo.observe_cards([CardRank.TWO, CardRank.FIVE, CardRank.FIVE, CardRank.FIVE])
+        self.assertEqual(algo.shoe.rank_counts[CardRank.TWO], 4)
+        self.assertEqual(algo.shoe.version, version + 1)
+
+    def test_observe_cards_keeps_reachable_states(self):
+        algo = Algorithm(1, workers=0)
+        algo.action(CardRank.NINE, [CardRank.EIGHT, CardRank.FOUR])
+        size = algo.cache_info()["size"]
+        algo.observe_cards([CardRank.FIVE])
+        algo.action_batch(CardRank.NINE, [])
+        self.assertEqual(algo.cache_info()["size"], size)
+        # the states still reachable from the smaller shoe are reused
+        hits = algo.cache_hits
+        reused = algo.estimate_batch(CardRank.NINE, [[CardRank.EIGHT, CardRank.FOUR]])[0]
+        self.assertGreater(algo.cache_hits, hits)
+        fresh = Algorithm(1, workers=0)
+        fresh.observe_cards([CardRank.FIVE])
+        self.assertEqual(reused, fresh.estimate_batch(CardRank.NINE, [[CardRank.EIGHT, CardRank.FOUR]])[0])
+
+    def test_unreachable_states_age_out(self):
+        algo = Algorithm(1, cache_size=2000, workers=0)
+        algo.action(CardRank.NINE, [CardRank.EIGHT, CardRank.FOUR])
+        stale = list(algo._ev_cache)
+        algo.observe_cards([CardRank.FIVE] * 4)
+        algo.action(CardRank.SIX, [CardRank.TEN, CardRank.TWO])
+        shoe_state = algo.shoe.state()
+        unreachable = [key for key in stale if any(cached > left for cached, left in zip(key[1], shoe_state))]
+        self.assertTrue(unreachable)
+        self.assertFalse(set(unreachable) & set(algo._ev_cache))
+
+    def test_sampled_double_matches_exact(self):
+        from Monte_Carlo import MonteCarlo
+        algo = Algorithm(1, workers=0)
+        exact = algo.estimate_batch(CardRank.TEN, [[CardRank.NINE, CardRank.SEVEN]])[0]
+        sampled = MonteCarlo(seed=0).estimate(algo.shoe.state(), 10, 16, False, False, True,
+                                              actions=(Action.STAND, Action.DOUBLE), samples=50_000)
+        for player_action in (Action.STAND, Action.DOUBLE):
+            self.assertLess(abs(sampled[player_action].mean - exact[player_action].mean),
+                            2 * sampled[player_action].half_width)
+
+    def test_sampled_split_of_aces_matches_exact(self):
+        from Monte_Carlo import MonteCarlo
+        algo = Algorithm(1, workers=0)
+        exact = algo.estimate_batch(CardRank.SIX, [[CardRank.ACE, CardRank.ACE]])[0][Action.SPLIT]
+        sampled = MonteCarlo(seed=0).estimate(algo.shoe.state(), 6, 11, True, False, False,
+                                              actions=(Action.SPLIT,), samples=50_000)[Action.SPLIT]
+        self.assertLess(abs(sampled.mean - exact.mean), 2 * sampled.half_width)
+
+    def test_sampled_mode_meets_time_budget_and_offers_split(self):
+        hands = [[CardRank.EIGHT, CardRank.EIGHT], [CardRank.TEN, CardRank.TWO]]
+        for upcard in (CardRank.ACE, CardRank.TWO):
+            for time_budget in (0.005, 0.02):
+                elapsed = []
+                for _ in range(5):
+                    # a cold shoe, where even the dealer distribution takes a good share of the budget
+                    algo = Algorithm(8, workers=0)
+                    algo._sampler()
+                    start = time.monotonic()
+                    pair, hard = algo.estimate_batch(upcard, hands, EvaluationMode.SAMPLED, time_budget)
+                    elapsed.append(time.monotonic() - start)
+                    self.assertGreater(pair[Action.SPLIT].samples, 0)
+                    self.assertNotIn(Action.SPLIT, hard)
+                    self.assertGreater(hard[Action.DOUBLE].samples, 0)
+                # the median, so a run the scheduler happened to preempt doesn't count as overshooting
+                self.assertLess(sorted(elapsed)[2], time_budget + 0.0025)
+
+    def test_auto_mode_meets_time_budget(self):
+        algo = Algorithm(8, workers=0)
+        start = time.monotonic()
+        estimates = algo.estimate_batch(CardRank.ACE, [[CardRank.ACE, CardRank.TWO]], EvaluationMode.AUTO, 0.1)[0]
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(estimates[Action.STAND].samples, 0)
+        self.assertGreater(estimates[Action.HIT].samples, 0)
+
+    def test_strategy_table_lookup_and_fallback(self):
+        import numpy as np
+        from Strategy_Table import StrategyTable
+        expected_values = np.full(StrategyTable.shape(), np.nan, dtype=np.float32)
+        # hard 16 against a 6 at a true count of 0
+        expected_values[-StrategyTable.MIN_TRUE_COUNT, 6 - StrategyTable.MIN_DEALER_TOTAL,
+                        16 - StrategyTable.MIN_PLAYER_TOTAL, 0] = [0.5, -0.5, -1.0]
+        algo = Algorithm(1, workers=0, surrender=False)
+        algo.strategy_table = StrategyTable(1, expected_values)
+        tabled, computed = algo.action_batch(CardRank.SIX, [[CardRank.TEN, CardRank.SIX], [CardRank.TEN, CardRank.SEVEN]],
+                                             EvaluationMode.TABLE)
+        self.assertEqual(tabled, {Action.STAND: 0.5, Action.HIT: -0.5, Action.DOUBLE: -1.0})
+        self.assertEqual(computed, algo.action_batch(CardRank.SIX, [[CardRank.TEN, CardRank.SEVEN]])[0])
+
+    def test_split_and_surrender(self):
+        algo = Algorithm(1, workers=0)
+        eights, sixteen, nine = algo.action_batch(CardRank.SIX, [[CardRank.EIGHT, CardRank.EIGHT],
+                                                                  [CardRank.TEN, CardRank.SIX],
+                                                                  [CardRank.TWO, CardRank.THREE, CardRank.FOUR]])
+        self.assertEqual(Algorithm.best_action(eights), Action.SPLIT.value)
+        self.assertNotIn(Action.SPLIT, sixteen)
+        self.assertEqual(sixteen[Action.SURRENDER], -0.5)  # a dealer showing a 6 can't have blackjack
+        self.assertNotIn(Action.SURRENDER, nine)
+        self.assertEqual(algo.action(CardRank.TEN, [CardRank.TEN, CardRank.SIX]), Action.SURRENDER.value)
+
+
+    def test_instrumentation_counts_recursion(self):
+        self.assertIsNone(Algorithm(1, workers=0).stats)
+        algo = Algorithm(1, workers=0, instrument=True)
+        algo.action(CardRank.NINE, [CardRank.EIGHT, CardRank.FOUR])
+        first = algo.last_stats
+        self.assertEqual(first.nodes(), first.cache_misses)
+        self.assertGreater(first.hit_nodes, 0)
+        self.assertGreater(first.stand_nodes, 0)
+        self.assertGreater(first.max_depth, 1)
+        self.assertEqual(first.depth, 0)
+        algo.action(CardRank.NINE, [CardRank.EIGHT, CardRank.FOUR])
+        self.assertEqual(algo.last_stats.nodes(), 0)
+        self.assertEqual(algo.stats.calls, 2)
+        self.assertEqual(algo.stats.cache_misses, first.cache_misses)
+
+    def test_instrumentation_survives_timeouts(self):
+        algo = Algorithm(8, workers=2, instrument=True)
+        algo.action(CardRank.TWO, [CardRank.SEVEN, CardRank.SEVEN], EvaluationMode.AUTO, time_budget=0.002)
+        self.assertIsNone(algo._executor)  # instrumented work stays in this process to be counted
+        self.assertGreater(algo.last_stats.nodes(), 0)
+        self.assertEqual(algo.last_stats.depth, 0)
+        self.assertLess(algo.last_stats.max_depth, 50)
+
+    def test_benchmark_flags_regressions(self):
+        from Benchmark import BenchmarkCase, compare, run
+        results = run([BenchmarkCase(CardRank.SIX, "hard 20", 1, 0.5)], repeats=2)
+        case = results["cases"]["hard 20 vs 6, 1 decks, 50% dealt"]
+        self.assertLessEqual(case["latency_p50"], case["latency_p95"])
+        self.assertGreater(case["nodes"], 0)
+        self.assertEqual(compare(results, results), [])
+        baseline = {"cases": {name: dict(result, latency_p50=0.0, nodes=result["nodes"] - 1)
+                              for name, result in results["cases"].items()}}
+        self.assertEqual(len(compare(results, baseline, slack=0.0)), 2)
+
+    def test_benchmark_needs_a_baseline(self):
+        import contextlib
+        import io
+        import json
+        from Benchmark import DEFAULT_BASELINE, grid, main
+        with contextlib.redirect_stderr(io.StringIO()) as error:
+            self.assertEqual(main(["--quick", "--baseline", "no/such/baseline.json"]), 2)
+        self.assertIn("No baseline", error.getvalue())
+        # the committed baseline covers the quick grid
+        with open(DEFAULT_BASELINE) as file:
+            baseline = json.load(file)
+        self.assertLessEqual({case.name() for case in grid(quick=True)}, baseline["cases"].keys())
 
 if __name__ == '__main__':
     unittest.main()
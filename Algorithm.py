@@ -3,7 +3,13 @@ Description: Algorithm handles probability and expected value calculations while
 the action that maximizes expected value
 '''
 from enum import Enum
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from threading import Lock
+from typing import NamedTuple
+import os
+import time
 
 
 class CardRank(Enum):
@@ -38,13 +44,129 @@ class CardRank(Enum):
             case _:
                 return int(self.value)
 
+    def value_class(self) -> int:
+        """Retrieves the index of this rank's value class, see VALUE_CLASS_WORTH. Every ten-valued
+        rank shares a value class since they are interchangeable for EV calculations.
+        """
+        if self is CardRank.ACE:
+            return ACE_CLASS
+        return self.worth() - 1
+
+
+# EV calculations only need the point value of a card, so the 13 ranks collapse into 10 value
+# classes: ace, two through nine, and every ten-valued rank
+VALUE_CLASS_WORTH = (11, 2, 3, 4, 5, 6, 7, 8, 9, 10)
+NUM_VALUE_CLASSES = len(VALUE_CLASS_WORTH)
+ACE_CLASS = 0
+
+# Hi-Lo card counting tag of each value class: +1 for two through six, -1 for aces and tens
+HI_LO_TAGS = (-1, 1, 1, 1, 1, 1, 0, 0, 0, -1)
+
+
+def hi_lo_true_count(value_counts: list[int] | tuple[int, ...]) -> float:
+    """Calculates the Hi-Lo true count of a shoe: the running count of the cards already dealt
+    divided by the number of decks left. A full shoe of any size has a true count of 0.
+
+    value_counts -- the value class counts left in the shoe, see Algorithm.Shoe.value_counts
+    """
+    # every full deck has a Hi-Lo sum of 0, so the dealt cards count the opposite of the rest
+    running_count = -sum(tag * count for tag, count in zip(HI_LO_TAGS, value_counts))
+    decks_remaining = sum(value_counts) / 52
+    return running_count / decks_remaining if decks_remaining else 0.0
+
 
 class Action(Enum):
-    """Represents a possible player action.
+    """Represents a possible player action. SPLIT is only possible on a pair and SURRENDER only on
+    the first two cards.
     """
     STAND = 0
     HIT = 1
     DOUBLE = 2
+    SPLIT = 3
+    SURRENDER = 4
+
+
+class EstimatedValue(NamedTuple):
+    """An EV together with how precisely it is known.
+
+    mean -- the EV, or its estimate when sampled
+    half_width -- half the width of the 95% confidence interval around mean, 0 when exact
+    samples -- the number of simulated rounds behind the estimate, 0 when exact
+    """
+    mean: float
+    half_width: float
+    samples: int
+
+
+class EvaluationMode(Enum):
+    """Represents how the EV of each player action is calculated.
+
+    EXACT -- the full recursion, however long it takes
+    SAMPLED -- a Monte Carlo estimate within the time budget
+    AUTO -- the full recursion while it fits in the time budget, Monte Carlo estimates for the rest
+    TABLE -- a precomputed strategy table lookup, the full recursion when the shoe is outside it
+    """
+    EXACT = "exact"
+    SAMPLED = "sampled"
+    AUTO = "auto"
+    TABLE = "table"
+
+
+class RecursionStats:
+    """Counters of the work done by the EV recursion, kept by an instrumented Algorithm for each
+    decision and cumulatively. Only the work done in this process is counted, so an instrumented
+    Algorithm evaluates its tasks in this process whatever its number of workers.
+
+    calls -- the number of decisions counted
+    hit_nodes -- hit EV states computed by expected_value_hit
+    stand_nodes -- stand EVs calculated by expected_value_stand
+    dealer_nodes -- dealer distributions computed by dealer_distribution
+    split_nodes -- split hand EV states computed by expected_value_split_hand
+    shoe_copies -- snapshots taken of a shoe state, for transposition table keys and evaluations
+    cache_hits -- the number of EV lookups answered from the transposition table
+    cache_misses -- the number of EV lookups that had to be computed
+    max_depth -- the deepest nesting of states being computed at once
+    wall_time -- seconds spent deciding
+    """
+    __slots__ = ("calls", "hit_nodes", "stand_nodes", "dealer_nodes", "split_nodes", "shoe_copies",
+                 "cache_hits", "cache_misses", "max_depth", "wall_time", "depth")
+
+    def __init__(self):
+        self.calls = 0
+        self.hit_nodes = 0
+        self.stand_nodes = 0
+        self.dealer_nodes = 0
+        self.split_nodes = 0
+        self.shoe_copies = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.max_depth = 0
+        self.wall_time = 0.0
+        # the nesting of states being computed right now
+        self.depth = 0
+
+    def enter(self) -> None:
+        """Records that the recursion went one state deeper.
+        """
+        self.depth += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+
+    def add(self, other: "RecursionStats") -> None:
+        """Adds another set of counters to these, keeping the larger max_depth.
+        """
+        for counter in ("calls", "hit_nodes", "stand_nodes", "dealer_nodes", "split_nodes", "shoe_copies",
+                        "cache_hits", "cache_misses", "wall_time"):
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+        self.max_depth = max(self.max_depth, other.max_depth)
+
+    def nodes(self) -> int:
+        """Returns the number of states the recursion computed.
+        """
+        return self.hit_nodes + self.dealer_nodes + self.split_nodes
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {counter: getattr(self, counter) for counter in self.__slots__ if counter != "depth"}
 
 
 class Algorithm:
@@ -52,8 +174,41 @@ class Algorithm:
     lasting state that tracks the contents of the dealer's shoe.
     
     shoe -- the dealer's current remaining cards
+    cache_size -- the maximum number of EV states kept in the transposition table of this process
+    and of each evaluator process; by default CACHE_MEMORY_BUDGET is split across the processes
+    doing the recursion, see default_cache_size()
+    cache_hits -- the number of EV lookups answered from the transposition table
+    workers -- the number of evaluator processes, 0 evaluates every EV in this process, as does an
+    instrumented Algorithm
+    surrender -- whether late surrender is offered
+    max_splits -- how many times a hand may be split, including resplits; 0 disables splitting.
+    Split hands may double, and split aces receive one card each
+    strategy_table -- the precomputed StrategyTable used by the TABLE mode, if one is loaded
+    stats -- the RecursionStats of every decision so far if instrumented, otherwise None
+    last_stats -- the RecursionStats of the latest decision if instrumented, otherwise None
     """
 
+    # share of an AUTO time budget given to the exact recursion before falling back to sampling
+    EXACT_BUDGET_SHARE = 0.5
+
+    # memory the transposition tables may fill together; an entry takes about 550 to 620 bytes, so
+    # 512 MiB holds about 866k states in one process or 108k in each of 8 evaluators
+    CACHE_MEMORY_BUDGET = 512 * 2 ** 20
+    CACHE_ENTRY_BYTES = 620
+
+    # dealer outcomes: a final total of 17 through 21, a bust, or a blackjack
+    DEALER_FINAL_TOTALS = (17, 18, 19, 20, 21)
+    DEALER_BUST = 5
+    DEALER_BLACKJACK = 6
+    DEALER_OUTCOMES = 7
+
+    # tags that keep hit EVs, dealer distributions and evaluator results apart in the
+    # transposition table; every key holds the shoe state at index 1
+    _HIT_KEY = 0
+    _DEALER_KEY = 1
+    _TASK_KEY = 2
+    _SPLIT_KEY = 3
+
     class Shoe:
         """Stores card information to enable the use of card-counting techniques in blackjack
         calculations. Card suits are not used in standard blackjack, and therefore not tracked
@@ -61,11 +216,16 @@ class Algorithm:
 
         num_decks -- the number of 52-card decks that are combined to form this shoe
         rank_counts -- a mapping of card rank to the amount of that card rank present in this shoe
+        value_counts -- the amount of cards of each value class present in this shoe, indexed as
+        VALUE_CLASS_WORTH; this is the compact state the EV calculations run on
+        version -- incremented every time the contents of this shoe change
         """
 
         def __init__(self, num_decks):
             self.num_decks = num_decks
             self.rank_counts: dict[CardRank, int] = dict()
+            self.value_counts: list[int] = [0] * NUM_VALUE_CLASSES
+            self.version = 0
             self.initialize_shoe()
 
         def initialize_shoe(self) -> None:
@@ -73,6 +233,25 @@ class Algorithm:
             each deck.
             """
             self.rank_counts = {rank: self.num_decks * 4 for rank in CardRank}
+            self.value_counts = [0] * NUM_VALUE_CLASSES
+            for rank, count in self.rank_counts.items():
+                self.value_counts[rank.value_class()] += count
+            self.version += 1
+
+        def true_count(self) -> float:
+            """Returns the Hi-Lo true count of this shoe, see hi_lo_true_count().
+            """
+            return hi_lo_true_count(self.value_counts)
+
+        def decks_remaining(self) -> float:
+            """Returns the number of decks' worth of cards left in this shoe.
+            """
+            return sum(self.value_counts) / 52
+
+        def state(self) -> tuple[int, ...]:
+            """Returns a hashable snapshot of the value class counts in this shoe.
+            """
+            return tuple(self.value_counts)
 
         def remove_card(self, rank: CardRank) -> None:
             """Removes a card from this shoe.
@@ -86,9 +265,173 @@ class Algorithm:
                 raise ValueError(f"{rank} already has zero cards in shoe")
 
             self.rank_counts[rank] -= 1
+            self.value_counts[rank.value_class()] -= 1
+            self.version += 1
+
+        def remove_cards(self, ranks: list[CardRank]) -> None:
+            """Removes several cards from this shoe as a single change. Every card is checked
+            before any is removed, so a ValueError leaves this shoe untouched.
+
+            ranks -- the ranks of the cards being removed
+
+            ValueError -- if this shoe does not contain enough of one of the specified ranks
+            """
+            removed_counts = Counter(ranks)
+            for rank, count in removed_counts.items():
+                if self.rank_counts[rank] < count:
+                    raise ValueError(f"{rank} has fewer than {count} cards in shoe")
 
-    def __init__(self, num_decks: int = 6):
+            for rank, count in removed_counts.items():
+                self.rank_counts[rank] -= count
+                self.value_counts[rank.value_class()] -= count
+            self.version += 1
+
+    def __init__(self, num_decks: int = 6, cache_size: int | None = None, workers: int | None = None,
+                 surrender: bool = True, max_splits: int = 3, instrument: bool = False):
         self.shoe = self.Shoe(num_decks)
+        self.workers = os.cpu_count() if workers is None else workers
+        self.cache_size = self.default_cache_size(self.workers) if cache_size is None else cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._ev_cache: OrderedDict[tuple, float] = OrderedDict()
+        self._ev_cache_lock = Lock()
+        self.surrender = surrender
+        self.max_splits = max_splits
+        self._executor: ProcessPoolExecutor | None = None
+        # time.monotonic() value at which the exact recursion gives up, None to never give up
+        self._deadline: float | None = None
+        self._monte_carlo = None
+        self.strategy_table = None
+        self.stats = RecursionStats() if instrument else None
+        self.last_stats: RecursionStats | None = None
+        # the counters of the decision being made, only set while instrumented
+        self._stats: RecursionStats | None = None
+
+    def evaluate(self, action: Action, shoe_state: tuple[int, ...], dealer_total: int, player_total: int,
+                 player_soft_total: bool, dealer_soft_total: bool, dealer_can_blackjack: bool,
+                 deadline: float | None = None) -> float | None:
+        """Calculates the EV of a single player action in this process. Returns None if the
+        deadline passes first; the states finished by then stay in the transposition table.
+
+        action -- the player action to evaluate
+        shoe_state -- a snapshot of the value class counts in the shoe, see Shoe.state()
+        player_total -- the point total of the player's cards, or of one card of the pair to SPLIT
+        deadline -- the time.monotonic() value to give up at, None to never give up
+        """
+        self._deadline = deadline
+        if self._stats is not None:
+            self._stats.shoe_copies += 1
+        try:
+            if action is Action.SPLIT:
+                return 2 * self.expected_value_split_hand(list(shoe_state), dealer_total, player_total,
+                                                          dealer_soft_total, dealer_can_blackjack,
+                                                          self.max_splits - 1)
+            if action is Action.STAND:
+                return self.expected_value_stand(list(shoe_state), dealer_total, player_total, False,
+                                                 dealer_soft_total, dealer_can_blackjack)
+            return self.expected_value_hit(list(shoe_state), dealer_total, player_total, action is Action.DOUBLE,
+                                           player_soft_total, dealer_soft_total, dealer_can_blackjack)
+        except TimeoutError:
+            self._unwind_stats()
+            return None
+        finally:
+            self._deadline = None
+
+    def evaluate_tasks(self, tasks: list[tuple], deadline: float | None = None) -> list[float | None]:
+        """Calculates the EV of every task, where each task holds the arguments of evaluate(). The
+        tasks are fanned out over the evaluator processes, which are started on first use and kept
+        alive (along with their transposition tables) until shutdown(). An instrumented Algorithm
+        evaluates them in this process instead, so its counters see all of the work.
+
+        tasks -- the evaluate() arguments for each EV
+        deadline -- the time.monotonic() value to give up at, tasks that miss it return None
+        """
+        if self.workers == 0 or self.stats is not None or len(tasks) == 1:
+            return [self.evaluate(*task, deadline=deadline) for task in tasks]
+
+        # only send the tasks whose results aren't already known for this shoe state
+        keys = [(self._TASK_KEY, task[1], task[0].value) + task[2:] for task in tasks]
+        expected_values = [self._cache_get(key) for key in keys]
+        missing = [index for index, expected_value in enumerate(expected_values) if expected_value is None]
+        if not missing:
+            return expected_values
+
+        self.start_evaluators()
+        results = self._executor.map(_evaluate_task, [tasks[index] for index in missing], repeat(deadline))
+        for index, expected_value in zip(missing, results):
+            expected_values[index] = expected_value
+            if expected_value is not None:
+                self._cache_put(keys[index], expected_value)
+        return expected_values
+
+    def start_evaluators(self) -> None:
+        """Starts the evaluator processes now rather than on the first batch of tasks. Call this
+        before starting other threads, so the processes aren't forked from a multi-threaded process.
+        """
+        if self.workers == 0 or self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_evaluator,
+                                             initargs=(self.cache_size, self.max_splits))
+        # the processes are forked on the first submission, wait until every one is running
+        for future in [self._executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def shutdown(self) -> None:
+        """Stops the evaluator processes. They are restarted if another EV is requested.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @classmethod
+    def default_cache_size(cls, workers: int) -> int:
+        """Returns how many states each transposition table holds by default, so that the tables of
+        every process doing the recursion fit in CACHE_MEMORY_BUDGET together.
+
+        workers -- the number of evaluator processes, 0 when the recursion runs in this process
+        """
+        return cls.CACHE_MEMORY_BUDGET // cls.CACHE_ENTRY_BYTES // max(1, workers)
+
+    def cache_info(self) -> dict[str, int]:
+        """Returns the transposition table statistics: hits, misses, current size and capacity,
+        along with the shoe version they were taken at.
+        """
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self._ev_cache),
+            "max_size": self.cache_size,
+            "shoe_version": self.shoe.version,
+        }
+
+    def clear_cache(self) -> None:
+        """Empties the transposition table and resets its statistics.
+        """
+        with self._ev_cache_lock:
+            self._ev_cache.clear()
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def _cache_get(self, key: tuple) -> float | None:
+        """Looks up an EV state, marking it as most recently used. Returns None on a miss.
+        """
+        with self._ev_cache_lock:
+            expected_value = self._ev_cache.get(key)
+            if expected_value is None:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+                self._ev_cache.move_to_end(key)
+            return expected_value
+
+    def _cache_put(self, key: tuple, expected_value: float) -> None:
+        """Stores an EV state, evicting the least recently used states once the table is full.
+        """
+        with self._ev_cache_lock:
+            self._ev_cache[key] = expected_value
+            self._ev_cache.move_to_end(key)
+            while len(self._ev_cache) > self.cache_size:
+                self._ev_cache.popitem(last=False)
 
     def remove_card_from_shoe(self, shown_card: CardRank) -> None:
         """Removes a card from the shoe. 
@@ -99,83 +442,325 @@ class Algorithm:
         """
         self.shoe.remove_card(rank=shown_card)
 
+    def observe_cards(self, shown_cards: list[CardRank]) -> None:
+        """Removes every card seen in a hand from the shoe at once.
+
+        Transposition table entries are keyed by shoe contents, so they never go stale, and
+        everything computed earlier in the shoe is kept. The entries that need more cards than the
+        shoe has left can no longer be reached; they are never used again, so they drift to the
+        least recently used end of the table and are evicted first, here and in the evaluator
+        processes alike, without a scan on the decision path.
+
+        shown_cards -- the ranks of the cards being removed
+
+        ValueError -- if the shoe does not contain enough of one of the specified ranks
+        """
+        self.shoe.remove_cards(shown_cards)
+
     def print_show(self):
         print(self.shoe.rank_counts)
 
-    def action(self, dealer_card: CardRank, player_cards: list[CardRank]) -> int:
-        """Determines the expected value of each player action given a blackjack state.  Each EV
-        is returned in a dictionary with Action keys (i.e. hit, stand, and double).
+    @staticmethod
+    def hand_total(cards: list[CardRank]) -> tuple[int, bool]:
+        """Calculates the point total of a hand and whether it is soft, i.e. whether an ace in it
+        still counts as 11 and can become a 1.
+
+        cards -- the cards in the hand
+        """
+        total = 0
+        aces_as_eleven = 0
+        for card in cards:
+            total += card.worth()
+            # for aces, we automatically add 11, then turn them into 1s while the hand is over 21
+            if card is CardRank.ACE:
+                aces_as_eleven += 1
+        while total > 21 and aces_as_eleven:
+            total -= 10
+            aces_as_eleven -= 1
+        return total, aces_as_eleven > 0
+
+    @staticmethod
+    def dealer_state(dealer_card: CardRank) -> tuple[int, bool, bool]:
+        """Calculates the dealer's point total, whether it is soft, and whether the dealer can still
+        hit blackjack from the card the dealer is showing.
 
         dealer_card -- the card the dealer is showing
-        player_cards -- list of the cards that the player has
         """
         # can dealer hit blackjack?
         dealer_can_blackjack = False
         # manages soft totals, where aces can change from 11 to 1 within a total
-        player_soft_total = False
         dealer_soft_total = False
 
-
-        # calculate player total
-        player_total = 0
-        for card in player_cards:
-            player_total += card.worth()
-            # for aces, we automatically add 11, but there is special logic
-            if card is CardRank.ACE:
-                player_soft_total = True
-                if player_total > 21:  # handles if player has two aces
-                    player_total -= 10
-
-        # calculate dealer total
         dealer_total = dealer_card.worth()
         if dealer_total == 10:
             dealer_can_blackjack = True
         elif dealer_total == 11:
             dealer_can_blackjack = True
             dealer_soft_total = True
+        return dealer_total, dealer_soft_total, dealer_can_blackjack
+
+    def hand_state(self, cards: list[CardRank]) -> tuple[int, bool, int | None, bool]:
+        """Calculates everything about a hand that its EVs depend on: its point total, whether it
+        is soft, the point value of one card of the pair if it can be split (otherwise None), and
+        whether it can be surrendered.
+
+        cards -- the cards in the hand
+        """
+        player_total, player_soft_total = self.hand_total(cards)
+        first_two_cards = len(cards) == 2
+        split_card_total = None
+        if first_two_cards and self.max_splits > 0 and cards[0].value_class() == cards[1].value_class():
+            split_card_total = cards[0].worth()
+        return player_total, player_soft_total, split_card_total, first_two_cards and self.surrender
+
+    @staticmethod
+    def best_action(expected_values: dict[Action, float]) -> int:
+        """Returns the value of the Action with the highest EV. Ties prefer standing, then
+        hitting, doubling, splitting and surrendering.
+
+        expected_values -- the EV of each available action, as returned by action_batch()
+        """
+        highest_ev = max(expected_values.values())
+
+        for player_action in (Action.STAND, Action.HIT, Action.DOUBLE, Action.SPLIT, Action.SURRENDER):
+            if expected_values.get(player_action) == highest_ev:
+                return player_action.value
+
+    def action(self, dealer_card: CardRank, player_cards: list[CardRank],
+               mode: EvaluationMode = EvaluationMode.EXACT, time_budget: float | None = None) -> int:
+        """Determines the player action that maximizes expected value given a blackjack state, and
+        returns its Action value. See action_batch() for the EVs themselves.
+
+        dealer_card -- the card the dealer is showing
+        player_cards -- list of the cards that the player has
+        mode -- how the EVs are calculated, see EvaluationMode
+        time_budget -- seconds the SAMPLED and AUTO modes may spend on the decision
+        """
+        return self.best_action(self.action_batch(dealer_card, [player_cards], mode, time_budget)[0])
+
+    def action_batch(self, dealer_card: CardRank, hands: list[list[CardRank]],
+                     mode: EvaluationMode = EvaluationMode.EXACT,
+                     time_budget: float | None = None) -> list[dict[Action, float]]:
+        """Determines the expected value of each player action for every hand at the table.  Each
+        hand's EVs are returned in a dictionary with Action keys (i.e. hit, stand, and double), in
+        the same order as hands. See estimate_batch().
+
+        dealer_card -- the card the dealer is showing
+        hands -- list of the cards that each player has
+        mode -- how the EVs are calculated, see EvaluationMode
+        time_budget -- seconds the SAMPLED and AUTO modes may spend on the whole table
+        """
+        return [{player_action: estimate.mean for player_action, estimate in estimates.items()}
+                for estimates in self.estimate_batch(dealer_card, hands, mode, time_budget)]
+
+    def estimate_batch(self, dealer_card: CardRank, hands: list[list[CardRank]],
+                       mode: EvaluationMode = EvaluationMode.EXACT, time_budget: float | None = None,
+                       samples: int = 200_000) -> list[dict[Action, EstimatedValue]]:
+        """Determines the expected value of each player action for every hand at the table, along
+        with a confidence interval for the ones that were sampled.
+
+        All hands share one dealer distribution for standing and surrendering, hands with the same
+        total share their EVs, and the hit, double and split EVs of every hand are fanned out in a
+        single pass. Split and surrender are only included for the hands that allow them. Stand
+        and surrender EVs are exact, except that under a time budget standing is sampled too when the dealer
+        distribution doesn't fit in it. In AUTO mode, hit, double and split EVs the exact recursion can't
+        finish in its share of the time budget are sampled instead; the exact work done so far stays cached.
+        A sampled EV has a nonzero samples count, see EstimatedValue, and a sampled split plays its hands by
+        basic strategy, see MonteCarlo.
+        In TABLE mode, hands the loaded strategy table covers are looked up and the rest are exact.
+
+        dealer_card -- the card the dealer is showing
+        hands -- list of the cards that each player has
+        mode -- how the EVs are calculated, see EvaluationMode
+        time_budget -- seconds the SAMPLED and AUTO modes may spend on the whole table, None for
+        no limit
+        samples -- the maximum number of rounds simulated per sampled EV
+        """
+        if self.stats is None:
+            return self._estimate_batch(dealer_card, hands, mode, time_budget, samples)
+
+        # hits, misses and time are taken as differences, so the recursion only counts nodes
+        self._stats = RecursionStats()
+        cache_hits, cache_misses = self.cache_hits, self.cache_misses
+        start = time.perf_counter()
+        try:
+            return self._estimate_batch(dealer_card, hands, mode, time_budget, samples)
+        finally:
+            call_stats, self._stats = self._stats, None
+            call_stats.calls = 1
+            call_stats.wall_time = time.perf_counter() - start
+            call_stats.cache_hits = self.cache_hits - cache_hits
+            call_stats.cache_misses = self.cache_misses - cache_misses
+            # every transposition table lookup is keyed by a snapshot of the shoe
+            call_stats.shoe_copies += call_stats.cache_hits + call_stats.cache_misses
+            self.last_stats = call_stats
+            self.stats.add(call_stats)
+
+    def _estimate_batch(self, dealer_card: CardRank, hands: list[list[CardRank]], mode: EvaluationMode,
+                        time_budget: float | None, samples: int) -> list[dict[Action, EstimatedValue]]:
+        """Does the work of estimate_batch().
+        """
+        start = time.monotonic()
+        end = None if time_budget is None else start + time_budget
+
+        # calculate dealer total
+        dealer_total, dealer_soft_total, dealer_can_blackjack = self.dealer_state(dealer_card)
+
+        # seats in the same situation have the same EVs, and hit, stand and double only depend on the total
+        hand_states = [self.hand_state(player_cards) for player_cards in hands]
+        unique_states = list(dict.fromkeys(hand_states))
+        unique_totals = list(dict.fromkeys((player_total, player_soft_total)
+                                           for player_total, player_soft_total, _, _ in unique_states))
+        split_card_totals = list(dict.fromkeys(split_card_total for _, _, split_card_total, _ in unique_states
+                                               if split_card_total is not None))
+
+        # answer from the strategy table where the shoe is inside its range
+        expected_values = {}
+        if mode is EvaluationMode.TABLE and self.strategy_table is not None:
+            for player_total, player_soft_total in unique_totals:
+                tabled_values = self.strategy_table.lookup(self.shoe, dealer_total, player_total, player_soft_total)
+                if tabled_values is not None:
+                    expected_values[player_total, player_soft_total] = tabled_values
+        pending_totals = [hand_total for hand_total in unique_totals if hand_total not in expected_values]
 
         # EV: 0 = push, 1 = win, -1 = loss, 2 = double win, -2 = double loss
-        with ThreadPoolExecutor() as executor:
-            # Define tasks for the thread pool
-            futures = {
-                'hit': executor.submit(
-                    self.expected_value_hit,
-                    self.shoe.rank_counts, dealer_total, player_total, False,
-                    player_soft_total, dealer_soft_total, dealer_can_blackjack
-                ),
-                'stand': executor.submit(
-                    self.expected_value_stand,
-                    self.shoe.rank_counts, dealer_total, player_total, False,
-                    dealer_soft_total, dealer_can_blackjack
-                ),
-                'double': executor.submit(
-                    self.expected_value_hit,
-                    self.shoe.rank_counts, dealer_total, player_total, True,
-                    player_soft_total, dealer_soft_total, dealer_can_blackjack
-                ),
+        shoe_state = self.shoe.state()
+        tasks = [
+            (player_action, shoe_state, dealer_total, player_total,
+             player_soft_total, dealer_soft_total, dealer_can_blackjack)
+            for player_total, player_soft_total in pending_totals
+            for player_action in (Action.HIT, Action.DOUBLE)
+        ]
+        tasks += [
+            (Action.SPLIT, shoe_state, dealer_total, split_card_total,
+             split_card_total == 11, dealer_soft_total, dealer_can_blackjack)
+            for split_card_total in split_card_totals
+        ]
+        if mode is EvaluationMode.SAMPLED:
+            results = iter([None] * len(tasks))
+        elif mode is EvaluationMode.AUTO and time_budget is not None:
+            results = iter(self.evaluate_tasks(tasks, deadline=start + time_budget * self.EXACT_BUDGET_SHARE))
+        else:
+            results = iter(self.evaluate_tasks(tasks))
+
+        distribution = None
+        if pending_totals or any(can_surrender for _, _, _, can_surrender in unique_states):
+            # the dealer plays out the same way for every hand that stands or surrenders now; under a
+            # time budget it has to fit too, SAMPLED mode giving it the exact share, or standing is sampled
+            if self._stats is not None:
+                self._stats.shoe_copies += 1
+            distribution_deadline = None
+            if mode is EvaluationMode.SAMPLED and end is not None:
+                distribution_deadline = start + time_budget * self.EXACT_BUDGET_SHARE
+            elif mode is EvaluationMode.AUTO:
+                distribution_deadline = end
+            distribution = self._dealer_distribution_by(shoe_state, dealer_total, dealer_soft_total,
+                                                        dealer_can_blackjack, distribution_deadline)
+            if distribution is None:
+                dealer_blackjack = self.dealer_blackjack_chance(shoe_state, dealer_total, dealer_can_blackjack)
+            else:
+                dealer_blackjack = distribution[self.DEALER_BLACKJACK]
+            # surrendering gives up half the bet, unless the dealer has blackjack and takes all of it
+            surrender_value = -0.5 - 0.5 * dealer_blackjack
+
+        for player_total, player_soft_total in pending_totals:
+            expected_values[player_total, player_soft_total] = {
+                Action.HIT: next(results),
+                Action.STAND: (None if distribution is None
+                               else self.expected_value_from_distribution(distribution, player_total, False)),
+                Action.DOUBLE: next(results),
             }
+        split_values = {split_card_total: next(results) for split_card_total in split_card_totals}
 
-            # Retrieve results from the futures
-            hit_expected_result = futures['hit'].result()
-            stand_expected_result = futures['stand'].result()
-            double_expected_result = futures['double'].result()
+        # sample whatever the exact recursion didn't get to, splitting the remaining time evenly
+        unfinished = []
+        for (player_total, player_soft_total), hand_values in expected_values.items():
+            missing_actions = tuple(player_action for player_action, value in hand_values.items() if value is None)
+            if missing_actions:
+                unfinished.append((player_total, player_soft_total, missing_actions))
+        unfinished += [(split_card_total, split_card_total == 11, (Action.SPLIT,))
+                       for split_card_total, value in split_values.items() if value is None]
+        for index, (player_total, player_soft_total, sampled_actions) in enumerate(unfinished):
+            deadline = None if end is None else time.monotonic() + (end - time.monotonic()) / (len(unfinished) - index)
+            sampled_values = self._sampler().estimate(
+                shoe_state, dealer_total, player_total, player_soft_total, dealer_soft_total, dealer_can_blackjack,
+                actions=sampled_actions, deadline=deadline, samples=samples,
+            )
+            if sampled_actions == (Action.SPLIT,):
+                split_values[player_total] = sampled_values[Action.SPLIT]
+            else:
+                expected_values[player_total, player_soft_total].update(sampled_values)
 
-        highest_ev = max(hit_expected_result, stand_expected_result, double_expected_result)
+        estimates = {}
+        for hand_state in unique_states:
+            player_total, player_soft_total, split_card_total, can_surrender = hand_state
+            hand_values = dict(expected_values[player_total, player_soft_total])
+            if split_card_total is not None:
+                hand_values[Action.SPLIT] = split_values[split_card_total]
+            if can_surrender:
+                hand_values[Action.SURRENDER] = surrender_value
+            estimates[hand_state] = {
+                player_action: value if isinstance(value, EstimatedValue) else EstimatedValue(value, 0.0, 0)
+                for player_action, value in hand_values.items()
+            }
+        return [dict(estimates[hand_state]) for hand_state in hand_states]
+
+    def _dealer_distribution_by(self, shoe_state: tuple[int, ...], dealer_total: int, dealer_soft_total: bool,
+                                dealer_can_blackjack: bool, deadline: float | None) -> tuple[float, ...] | None:
+        """Calculates dealer_distribution(), or returns None if the deadline passes first; the
+        states finished by then stay in the transposition table.
 
-        if highest_ev == stand_expected_result:
-            return Action.STAND.value
-        elif highest_ev == hit_expected_result:
-            return Action.HIT.value
-        elif highest_ev == double_expected_result:
-            return Action.DOUBLE.value
+        deadline -- the time.monotonic() value to give up at, None to never give up
+        """
+        self._deadline = deadline
+        try:
+            return self.dealer_distribution(list(shoe_state), dealer_total, dealer_soft_total, dealer_can_blackjack)
+        except TimeoutError:
+            self._unwind_stats()
+            return None
+        finally:
+            self._deadline = None
 
-        # return {
-        #     Action.HIT: hit_expected_result,
-        #     Action.STAND: stand_expected_result,
-        #     Action.DOUBLE: double_expected_result,
-        # }
+    def _unwind_stats(self) -> None:
+        """Resets the recursion depth after a timeout, which leaves every state being computed
+        without reaching its depth decrement.
+        """
+        if self._stats is not None:
+            self._stats.depth = 0
+
+    @staticmethod
+    def dealer_blackjack_chance(shoe_state: tuple[int, ...], dealer_total: int, dealer_can_blackjack: bool) -> float:
+        """Returns the probability that the dealer's hole card completes a blackjack, the
+        DEALER_BLACKJACK outcome of dealer_distribution() without the rest of the recursion.
+
+        shoe_state -- a snapshot of the value class counts in the shoe, see Shoe.state()
+        dealer_total -- the point value of the card the dealer is showing
+        """
+        if not dealer_can_blackjack:
+            return 0.0
+        completing_class = VALUE_CLASS_WORTH.index(10) if dealer_total == 11 else ACE_CLASS
+        return shoe_state[completing_class] / sum(shoe_state)
 
-    def expected_value_hit(self, shoe_state: dict[CardRank, int],
+    def load_strategy_table(self, path: str | None = None) -> None:
+        """Memory-maps a strategy table generated by Strategy_Table for the TABLE mode, importing
+        NumPy the first time it is needed.
+
+        path -- the table file, defaults to the table for this shoe's number of decks
+
+        ValueError -- if the file doesn't hold a strategy table
+        """
+        from Strategy_Table import StrategyTable
+        self.strategy_table = StrategyTable.load(self.shoe.num_decks, path)
+
+    def _sampler(self):
+        """Returns the Monte Carlo estimator, importing NumPy the first time it is needed.
+        """
+        if self._monte_carlo is None:
+            from Monte_Carlo import MonteCarlo
+            self._monte_carlo = MonteCarlo()
+        return self._monte_carlo
+
+    def expected_value_hit(self, shoe_state: list[int],
                            dealer_total: int, player_total: int,
                            is_doubled: bool,
                            player_soft_total: bool, dealer_soft_total: bool, dealer_can_blackjack: bool) -> float:
@@ -183,135 +768,295 @@ class Algorithm:
         player cards and every possible series of dealer cards. Recursively called. See action()
         comment for EV explanation.
 
-        shoe_state -- the rank counts in this shoe
+        shoe_state -- the value class counts in this shoe, see Shoe.value_counts
         dealer_total -- the point value of the card the dealer is showing
         player_total -- the current point total of the player's cards
         is_doubled -- whether the player doubled, which prevents another hit but doubles the EV
 
+        Results are memoized in the transposition table. shoe_state is updated in place while
+        recursing and is restored before returning.
+
         VTL?
         """
+        key = (self._HIT_KEY, tuple(shoe_state), dealer_total, player_total, is_doubled,
+               player_soft_total, dealer_soft_total, dealer_can_blackjack)
+        cached_value = self._cache_get(key)
+        if cached_value is not None:
+            return cached_value
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise TimeoutError
+        stats = self._stats
+        if stats is not None:
+            stats.hit_nodes += 1
+            stats.enter()
+
         expected_value = 0
         # total number of cards in shoe = number of cards that could be dealt
-        total_cards_in_shoe = sum(shoe_state[rank] for rank in shoe_state)
+        total_cards_in_shoe = sum(shoe_state)
         # adjusts bet for correct expected value if doubled or not
         bet_absolute_value = 2 if is_doubled else 1
 
-        # iterates through all possible ranks
-        for shown_rank in shoe_state.keys():
-            # how many of the rank are in the shoe?
-            total_of_rank_in_shoe = shoe_state[shown_rank]
+        # iterates through all possible value classes
+        for shown_class in range(NUM_VALUE_CLASSES):
+            # how many of the value class are in the shoe?
+            total_of_class_in_shoe = shoe_state[shown_class]
 
             # if it's zero, we don't have to worry about this timeline. otherwise...
-            if total_of_rank_in_shoe != 0:
-                # ...how likely was this rank to appear? (weight)
-                fraction_of_all_outcomes = total_of_rank_in_shoe / total_cards_in_shoe
+            if total_of_class_in_shoe != 0:
+                # ...how likely was this value class to appear? (weight)
+                fraction_of_all_outcomes = total_of_class_in_shoe / total_cards_in_shoe
 
-                # new_shoe_state represents the hypothetical shoe after *this* potential hit
-                new_shoe_state = dict(shoe_state)  # copy to a new dictionary
-                new_shoe_state[shown_rank] -= 1  # if we saw a card, there's one less in the shoe now
+                # the shoe now represents the hypothetical shoe after *this* potential hit
+                shoe_state[shown_class] -= 1  # if we saw a card, there's one less in the shoe now
 
                 # establish a new player total after this hit
-                shown_rank_value = CardRank(shown_rank).worth()
-                new_player_total = player_total + shown_rank_value
+                new_player_total = player_total + VALUE_CLASS_WORTH[shown_class]
+                new_player_soft_total = player_soft_total
 
                 # if next card is an ace...
-                if shown_rank == "A":
+                if shown_class == ACE_CLASS:
                     if new_player_total > 21:  # ...and the 11 puts the player over 21...
                         new_player_total -= 10  # ...the ace becomes a 1
                     else:  # ...and the 11 keeps the player under or at 21...
-                        player_soft_total = True  # ...then the 11 can still become a 1
+                        new_player_soft_total = True  # ...then the 11 can still become a 1
 
                 # adjusts new_player_total if it goes over 21 with a soft total
-                if new_player_total > 21 and player_soft_total:
+                if new_player_total > 21 and new_player_soft_total:
                     new_player_total -= 10  # ace becomes a 1
-                    player_soft_total = False  # this can never be true again
+                    new_player_soft_total = False  # this can never be true again
 
                 # evaluating expected value based on new_player_total
                 if new_player_total > 21:  # automatic loss
                     expected_value += -1 * bet_absolute_value * fraction_of_all_outcomes
                 elif new_player_total == 21 or is_doubled:  # automatic stand
-                    expected_value += self.expected_value_stand(new_shoe_state, dealer_total, new_player_total,
+                    expected_value += self.expected_value_stand(shoe_state, dealer_total, new_player_total,
                                                                 is_doubled,
                                                                 dealer_soft_total,
                                                                 dealer_can_blackjack) * fraction_of_all_outcomes
                 else:  # chooses the optimal play post-hit, as that will give us the optimal play here
-                    ev_when_hit = self.expected_value_hit(new_shoe_state, dealer_total, new_player_total, False,
-                                                          player_soft_total, dealer_soft_total, dealer_can_blackjack)
-                    ev_when_stand = self.expected_value_stand(new_shoe_state, dealer_total, new_player_total, False,
+                    ev_when_hit = self.expected_value_hit(shoe_state, dealer_total, new_player_total, False,
+                                                          new_player_soft_total, dealer_soft_total,
+                                                          dealer_can_blackjack)
+                    ev_when_stand = self.expected_value_stand(shoe_state, dealer_total, new_player_total, False,
                                                               dealer_soft_total, dealer_can_blackjack)
                     expected_value += max(ev_when_hit, ev_when_stand) * fraction_of_all_outcomes
 
+                shoe_state[shown_class] += 1  # put the card back for the next timeline
+
+        self._cache_put(key, expected_value)
+        if stats is not None:
+            stats.depth -= 1
         return expected_value
 
-    def expected_value_stand(self, shoe_state: dict[CardRank, int],
+    def expected_value_split_hand(self, shoe_state: list[int], dealer_total: int, split_card_total: int,
+                                  dealer_soft_total: bool, dealer_can_blackjack: bool, splits_left: int) -> float:
+        """Calculates the EV of one hand of a split pair. Does so by going through every possible
+        second card and playing the hand optimally from there, reusing the hit and stand EVs in the
+        transposition table. Split hands may double; split aces receive one card each and stand.
+        Both hands of a split are valued on the same shoe, so SPLIT is worth twice this EV.
+
+        shoe_state -- the value class counts in this shoe, see Shoe.value_counts
+        dealer_total -- the point value of the card the dealer is showing
+        split_card_total -- the point value of the split card, 11 for an ace
+        splits_left -- how many more times the hand may be resplit if it is dealt another match
+
+        Results are memoized in the transposition table. shoe_state is updated in place while
+        recursing and is restored before returning.
+        """
+        key = (self._SPLIT_KEY, tuple(shoe_state), dealer_total, split_card_total,
+               dealer_soft_total, dealer_can_blackjack, splits_left)
+        cached_value = self._cache_get(key)
+        if cached_value is not None:
+            return cached_value
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise TimeoutError
+        stats = self._stats
+        if stats is not None:
+            stats.split_nodes += 1
+            stats.enter()
+
+        expected_value = 0
+        # total number of cards in shoe = number of cards that could be dealt
+        total_cards_in_shoe = sum(shoe_state)
+        split_class = ACE_CLASS if split_card_total == 11 else split_card_total - 1
+
+        # iterates through all possible second cards
+        for shown_class in range(NUM_VALUE_CLASSES):
+            total_of_class_in_shoe = shoe_state[shown_class]
+
+            if total_of_class_in_shoe != 0:
+                fraction_of_all_outcomes = total_of_class_in_shoe / total_cards_in_shoe
+                shoe_state[shown_class] -= 1  # if we saw a card, there's one less in the shoe now
+
+                # a hand with an ace is soft, and a second ace counts as 1
+                new_player_total = split_card_total + VALUE_CLASS_WORTH[shown_class]
+                new_player_soft_total = split_class == ACE_CLASS or shown_class == ACE_CLASS
+                if new_player_total > 21:
+                    new_player_total -= 10
+
+                best_ev = self.expected_value_stand(shoe_state, dealer_total, new_player_total, False,
+                                                    dealer_soft_total, dealer_can_blackjack)
+                if split_class != ACE_CLASS:
+                    if new_player_total < 21:
+                        best_ev = max(best_ev, self.expected_value_hit(shoe_state, dealer_total, new_player_total,
+                                                                       False, new_player_soft_total,
+                                                                       dealer_soft_total, dealer_can_blackjack))
+                    best_ev = max(best_ev, self.expected_value_hit(shoe_state, dealer_total, new_player_total, True,
+                                                                   new_player_soft_total, dealer_soft_total,
+                                                                   dealer_can_blackjack))
+                    if shown_class == split_class and splits_left > 0:  # resplitting makes two hands again
+                        best_ev = max(best_ev, 2 * self.expected_value_split_hand(shoe_state, dealer_total,
+                                                                                  split_card_total, dealer_soft_total,
+                                                                                  dealer_can_blackjack,
+                                                                                  splits_left - 1))
+                expected_value += best_ev * fraction_of_all_outcomes
+
+                shoe_state[shown_class] += 1  # put the card back for the next timeline
+
+        self._cache_put(key, expected_value)
+        if stats is not None:
+            stats.depth -= 1
+        return expected_value
+
+    def expected_value_stand(self, shoe_state: list[int],
                              dealer_total: int, player_total: int,
                              is_doubled: bool,
                              dealer_soft_total: bool, dealer_can_blackjack: bool) -> float:
-        """Calculates the EV after standing. Does so by going through every possible series of
-        dealer cards. Recursively called. See action() comment for EV explanation.
+        """Calculates the EV after standing. The dealer's final-total distribution only depends on
+        the dealer's cards and the shoe, so it is looked up with dealer_distribution() and the EV
+        for this player total is a dot product against it. See action() comment for EV explanation.
 
-        shoe_state -- the rank counts in this shoe
+        shoe_state -- the value class counts in this shoe, see Shoe.value_counts
         dealer_total -- the point total of the dealer's cards
         player_total -- the point total of the player's cards
         is_doubled -- whether the player doubled, which doubles the EV
+        """
+        if self._stats is not None:
+            self._stats.stand_nodes += 1
+        distribution = self.dealer_distribution(shoe_state, dealer_total, dealer_soft_total, dealer_can_blackjack)
+        return self.expected_value_from_distribution(distribution, player_total, is_doubled)
+
+    @staticmethod
+    def expected_value_from_distribution(distribution: tuple[float, ...], player_total: int,
+                                         is_doubled: bool) -> float:
+        """Calculates the EV of standing on player_total against a dealer final-total distribution.
 
-        VTL? rest of docstring
+        distribution -- the dealer outcome probabilities, see dealer_distribution()
+        player_total -- the point total of the player's cards, at most 21
+        is_doubled -- whether the player doubled, which doubles the EV
         """
-        expected_value = 0
-        # total number of cards in shoe = number of cards that could be dealt
-        total_cards_in_shoe = sum(shoe_state[rank] for rank in shoe_state)
         # adjusts bet for correct expected value if doubled or not
         bet_absolute_value = 2 if is_doubled else 1
 
-        # iterates through all possible ranks
-        for shown_rank in shoe_state:
-            # how many of the rank are in the shoe?
-            total_of_rank_in_shoe = shoe_state[shown_rank]
+        # the player wins on a dealer bust and loses to a dealer blackjack
+        expected_value = distribution[Algorithm.DEALER_BUST] - distribution[Algorithm.DEALER_BLACKJACK]
+        for outcome, dealer_final_total in enumerate(Algorithm.DEALER_FINAL_TOTALS):
+            if player_total > dealer_final_total:  # automatic win
+                expected_value += distribution[outcome]
+            elif dealer_final_total > player_total:  # automatic loss
+                expected_value -= distribution[outcome]
+            # otherwise it's a push and adds nothing
+
+        return bet_absolute_value * expected_value
+
+    def dealer_distribution(self, shoe_state: list[int], dealer_total: int,
+                            dealer_soft_total: bool, dealer_can_blackjack: bool) -> tuple[float, ...]:
+        """Calculates the probability of each dealer outcome by going through every possible
+        series of dealer cards. Recursively called.
+
+        Outcomes are indexed as in DEALER_FINAL_TOTALS (a final total of 17 through 21), followed
+        by DEALER_BUST and DEALER_BLACKJACK.
+
+        shoe_state -- the value class counts in this shoe, see Shoe.value_counts
+        dealer_total -- the point total of the dealer's cards
+        dealer_soft_total -- whether an ace in the dealer's total can still become a 1
+        dealer_can_blackjack -- whether the next dealer card can complete a blackjack
+
+        Results are memoized in the transposition table. shoe_state is updated in place while
+        recursing and is restored before returning.
+        """
+        key = (self._DEALER_KEY, tuple(shoe_state), dealer_total,
+               dealer_soft_total, dealer_can_blackjack)
+        cached_distribution = self._cache_get(key)
+        if cached_distribution is not None:
+            return cached_distribution
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise TimeoutError
+        stats = self._stats
+        if stats is not None:
+            stats.dealer_nodes += 1
+            stats.enter()
+
+        distribution = [0.0] * self.DEALER_OUTCOMES
+        # total number of cards in shoe = number of cards that could be dealt
+        total_cards_in_shoe = sum(shoe_state)
+
+        # iterates through all possible value classes
+        for shown_class in range(NUM_VALUE_CLASSES):
+            # how many of the value class are in the shoe?
+            total_of_class_in_shoe = shoe_state[shown_class]
 
             # if it's zero, we don't have to worry about this timeline. otherwise...
-            if total_of_rank_in_shoe != 0:
-                # ...how likely was this rank to appear? (weight)
-                fraction_of_all_outcomes = total_of_rank_in_shoe / total_cards_in_shoe
+            if total_of_class_in_shoe != 0:
+                # ...how likely was this value class to appear? (weight)
+                fraction_of_all_outcomes = total_of_class_in_shoe / total_cards_in_shoe
 
-                # new_shoe_state represents the hypothetical shoe after *this* potential dealer hit
-                new_shoe_state = dict(shoe_state)  # copy to a new dictionary
-                new_shoe_state[shown_rank] -= 1  # if we saw a card, there's one less in the shoe now
+                # the shoe now represents the hypothetical shoe after *this* potential dealer hit
+                shoe_state[shown_class] -= 1  # if we saw a card, there's one less in the shoe now
 
                 # establish a new dealer total after this dealer hit
-                shown_rank_value = CardRank(shown_rank).worth()
-                new_dealer_total = dealer_total + shown_rank_value
+                new_dealer_total = dealer_total + VALUE_CLASS_WORTH[shown_class]
+                new_dealer_soft_total = dealer_soft_total
 
                 # if next card is an ace...
-                if shown_rank == "A":
+                if shown_class == ACE_CLASS:
                     if new_dealer_total > 21:  # ...and the 11 puts the dealer over 21...
                         new_dealer_total -= 10  # ...the ace becomes a 1
                     else:  # ...and the 11 keeps the dealer under or at 21...
-                        dealer_soft_total = True  # ...then the 11 can still become a 1
+                        new_dealer_soft_total = True  # ...then the 11 can still become a 1
 
                 # adjusts new_dealer_total if it goes over 21 with a soft total
-                if new_dealer_total > 21 and dealer_soft_total:
+                if new_dealer_total > 21 and new_dealer_soft_total:
                     new_dealer_total -= 10  # ace becomes a 1
-                    dealer_soft_total = False  # this can never be true again
+                    new_dealer_soft_total = False  # this can never be true again
 
-                if new_dealer_total > 21:  # automatic win
-                    expected_value += bet_absolute_value * fraction_of_all_outcomes
+                if new_dealer_total > 21:  # dealer busts
+                    distribution[self.DEALER_BUST] += fraction_of_all_outcomes
                 elif new_dealer_total == 21 and dealer_can_blackjack:  # dealer hits blackjack
-                    expected_value += -1 * bet_absolute_value * fraction_of_all_outcomes
-                # elif new_dealer_total == 17 and dealer_soft_total:  # soft 17, dealer hits again
-                #     expected_value += self.expected_value_stand(new_shoe_state, new_dealer_total, player_total, is_doubled,
-                #                                                 dealer_soft_total, False) * fraction_of_all_outcomes
-                elif new_dealer_total >= 17 and player_total > new_dealer_total:  # automatic win
-                    expected_value += bet_absolute_value * fraction_of_all_outcomes
-                elif new_dealer_total >= 17 and new_dealer_total > player_total:  # automatic loss
-                    expected_value += -1 * bet_absolute_value * fraction_of_all_outcomes
-                elif new_dealer_total >= 17 and new_dealer_total == player_total:  # automatic push
-                    expected_value += 0
+                    distribution[self.DEALER_BLACKJACK] += fraction_of_all_outcomes
+                # elif new_dealer_total == 17 and new_dealer_soft_total:  # soft 17, dealer hits again
+                elif new_dealer_total >= 17:  # dealer stands
+                    distribution[new_dealer_total - 17] += fraction_of_all_outcomes
                 else:  # the dealer has to keep going, but the next card could be any remaining in the shoe
-                    expected_value += self.expected_value_stand(new_shoe_state, new_dealer_total, player_total,
-                                                                is_doubled,
-                                                                dealer_soft_total, False) * fraction_of_all_outcomes
+                    next_distribution = self.dealer_distribution(shoe_state, new_dealer_total,
+                                                                 new_dealer_soft_total, False)
+                    for outcome in range(self.DEALER_OUTCOMES):
+                        distribution[outcome] += next_distribution[outcome] * fraction_of_all_outcomes
 
-        return expected_value
+                shoe_state[shown_class] += 1  # put the card back for the next timeline
+
+        distribution = tuple(distribution)
+        self._cache_put(key, distribution)
+        if stats is not None:
+            stats.depth -= 1
+        return distribution
+
+
+# each evaluator process keeps its own Algorithm, so its transposition table outlives single calls
+_evaluator_algorithm: Algorithm | None = None
+
+
+def _init_evaluator(cache_size: int, max_splits: int) -> None:
+    """Creates the Algorithm used by an evaluator process.
+    """
+    global _evaluator_algorithm
+    _evaluator_algorithm = Algorithm(num_decks=0, cache_size=cache_size, workers=0, max_splits=max_splits)
+
+
+def _evaluate_task(task: tuple, deadline: float | None) -> float | None:
+    """Calculates one task's EV in an evaluator process, see Algorithm.evaluate().
+    """
+    return _evaluator_algorithm.evaluate(*task, deadline=deadline)
 
 
 # Testing
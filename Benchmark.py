@@ -0,0 +1,198 @@
+'''
+Description: Benchmark measures how long Algorithm.action takes over a grid of dealer upcards,
+player hands, deck counts and shoe penetrations, saves the results as JSON and fails when they
+regress against a stored baseline
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+from typing import NamedTuple
+
+from Algorithm import Algorithm, CardRank
+
+UPCARDS = (CardRank.TWO, CardRank.SIX, CardRank.TEN, CardRank.ACE)
+HANDS = {
+    "hard 20": (CardRank.TEN, CardRank.KING),
+    "hard 16": (CardRank.TEN, CardRank.SIX),
+    "hard 12": (CardRank.TEN, CardRank.TWO),
+    "hard 11": (CardRank.SIX, CardRank.FIVE),
+    "soft 13": (CardRank.ACE, CardRank.TWO),
+    "soft 18": (CardRank.ACE, CardRank.SEVEN),
+    "pair of 8s": (CardRank.EIGHT, CardRank.EIGHT),
+}
+DECK_COUNTS = (1, 6, 8)
+PENETRATIONS = (0.0, 0.5, 0.75)
+
+# a smaller grid for quick checks, which still includes the slowest hand
+QUICK_UPCARDS = (CardRank.SIX, CardRank.ACE)
+QUICK_HANDS = ("hard 16", "soft 13", "pair of 8s")
+QUICK_DECK_COUNTS = (1, 6)
+QUICK_PENETRATIONS = (0.0, 0.5)
+
+# the committed baseline holds the quick grid, which every full run includes
+DEFAULT_BASELINE = "benchmarks/latency_baseline.json"
+
+
+class BenchmarkCase(NamedTuple):
+    """One decision to time.
+
+    upcard -- the card the dealer is showing
+    hand -- the name of the player's hand, see HANDS
+    num_decks -- the number of decks in the shoe
+    penetration -- the share of the shoe dealt before the decision
+    """
+    upcard: CardRank
+    hand: str
+    num_decks: int
+    penetration: float
+
+    def name(self) -> str:
+        return f"{self.hand} vs {self.upcard.value}, {self.num_decks} decks, {self.penetration:.0%} dealt"
+
+
+def grid(quick: bool = False) -> list[BenchmarkCase]:
+    """Returns every case of the full grid, or of the quick one.
+    """
+    if quick:
+        upcards, hands, deck_counts, penetrations = QUICK_UPCARDS, QUICK_HANDS, QUICK_DECK_COUNTS, QUICK_PENETRATIONS
+    else:
+        upcards, hands, deck_counts, penetrations = UPCARDS, HANDS, DECK_COUNTS, PENETRATIONS
+    return [BenchmarkCase(upcard, hand, num_decks, penetration)
+            for num_decks in deck_counts for penetration in penetrations
+            for upcard in upcards for hand in hands]
+
+
+def dealt_cards(num_decks: int, penetration: float, seed: int) -> list[CardRank]:
+    """Returns a reproducible random share of a full shoe, to deal out before a decision.
+    """
+    shoe = [rank for rank in CardRank] * 4 * num_decks
+    return random.Random(seed).sample(shoe, int(penetration * len(shoe)))
+
+
+def run_case(case: BenchmarkCase, repeats: int = 5, seed: int = 0) -> dict[str, float]:
+    """Times one decision, each repeat on a new Algorithm so none of them start with a warm
+    transposition table. Nodes are the EV states the recursion had to compute, see RecursionStats.
+
+    case -- the decision to time
+    repeats -- the number of times to time it
+    seed -- the seed that picks the dealt cards
+    """
+    latencies = []
+    for _ in range(repeats):
+        algorithm = Algorithm(case.num_decks, workers=0, instrument=True)
+        algorithm.observe_cards(dealt_cards(case.num_decks, case.penetration, seed))
+        algorithm.action(case.upcard, list(HANDS[case.hand]))
+        latencies.append(algorithm.last_stats.wall_time)
+
+    stats = algorithm.last_stats
+    return {
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_max": max(latencies),
+        "nodes": stats.nodes(),
+        "stand_nodes": stats.stand_nodes,
+        "cache_hits": stats.cache_hits,
+        "max_depth": stats.max_depth,
+    }
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    """Returns the nearest-rank percentile of the samples.
+    """
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def run(cases: list[BenchmarkCase], repeats: int = 5, seed: int = 0) -> dict:
+    """Times every case and returns the results, ready to be saved as JSON.
+    """
+    results = {}
+    for case in cases:
+        results[case.name()] = run_case(case, repeats, seed)
+        print(f"{case.name()}: p50 {results[case.name()]['latency_p50'] * 1000:.1f} ms, "
+              f"{results[case.name()]['nodes']} nodes")
+
+    all_p50 = [result["latency_p50"] for result in results.values()]
+    return {
+        "environment": {"python": platform.python_version(), "machine": platform.machine(),
+                        "repeats": repeats, "seed": seed},
+        "summary": {"latency_p50": percentile(all_p50, 0.50), "latency_p95": percentile(all_p50, 0.95),
+                    "latency_max": max(result["latency_max"] for result in results.values()),
+                    "nodes": sum(result["nodes"] for result in results.values())},
+        "cases": results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.25, slack: float = 0.005) -> list[str]:
+    """Returns a description of every case that regressed against the baseline: its p50 latency
+    grew by more than tolerance (plus slack seconds, so fast cases don't fail on timer noise), or
+    its node count grew at all. The p50 is compared because with a few repeats the p95 is the
+    slowest one, which a single scheduling hiccup decides. Cases missing from either side are ignored.
+
+    results -- the results of run()
+    baseline -- earlier results of run()
+    tolerance -- the allowed relative latency increase
+    slack -- the allowed absolute latency increase, in seconds
+    """
+    regressions = []
+    for name, result in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            continue
+        allowed = base["latency_p50"] * (1 + tolerance) + slack
+        if result["latency_p50"] > allowed:
+            regressions.append(f"{name}: p50 {result['latency_p50'] * 1000:.1f} ms, "
+                               f"baseline {base['latency_p50'] * 1000:.1f} ms")
+        if result["nodes"] > base["nodes"]:
+            regressions.append(f"{name}: {result['nodes']} nodes, baseline {base['nodes']}")
+    return regressions
+
+
+def main(arguments: list[str]) -> int:
+    parser = argparse.ArgumentParser(description="Time Algorithm.action over a grid of decisions.")
+    parser.add_argument("--quick", action="store_true", help="run the smaller grid")
+    parser.add_argument("--repeats", type=int, default=5, help="timings per case")
+    parser.add_argument("--output", help="file to save the results to")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative latency increase")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    options = parser.parse_args(arguments)
+
+    # a comparison needs a baseline, so a missing one fails before the grid is run
+    baseline = None
+    if not options.save_baseline:
+        try:
+            with open(options.baseline) as file:
+                baseline = json.load(file)
+        except FileNotFoundError:
+            print(f"No baseline at {options.baseline}, run with --save-baseline to store one", file=sys.stderr)
+            return 2
+
+    results = run(grid(options.quick), options.repeats)
+    summary = results["summary"]
+    print(f"p50 {summary['latency_p50'] * 1000:.1f} ms, p95 {summary['latency_p95'] * 1000:.1f} ms, "
+          f"max {summary['latency_max'] * 1000:.1f} ms, {summary['nodes']} nodes")
+
+    for path in filter(None, [options.output, options.baseline if options.save_baseline else None]):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+    if options.save_baseline:
+        return 0
+
+    if not results["cases"].keys() & baseline["cases"].keys():
+        print(f"The baseline at {options.baseline} has none of these cases, run with --save-baseline to "
+              f"store them", file=sys.stderr)
+        return 2
+    regressions = compare(results, baseline, options.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
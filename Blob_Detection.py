@@ -0,0 +1,102 @@
+'''
+Description: Blob_Detection finds the blobs of a binary image with vectorized connected component
+labelling, keeping only per-blob statistics instead of every pixel
+'''
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+
+class Blob(NamedTuple):
+    """
+    A group of foreground pixels, each within reach of another pixel of the group
+    :arg rect [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y], the bottom right exclusive
+    :arg area the number of foreground pixels
+    :arg centroid the mean (x, y) of the foreground pixels
+    """
+    rect: list
+    area: int
+    centroid: tuple
+
+    def return_rect(self):
+        return tuple(self.rect)
+
+    def __repr__(self):
+        return f"Blob with {self.area} pixels"
+
+
+class Blobs:
+    """
+    The statistics of every blob of an image, stored in arrays
+    :arg rects (n, 4) array of [x1, y1, x2, y2], the bottom right exclusive
+    :arg areas (n,) array of foreground pixel counts
+    :arg centroids (n, 2) array of mean (x, y) positions
+    """
+
+    def __init__(self, rects, areas, centroids):
+        self.rects = rects
+        self.areas = areas
+        self.centroids = centroids
+
+    def __len__(self):
+        return len(self.areas)
+
+    def __getitem__(self, index):
+        return Blob(self.rects[index].tolist(), int(self.areas[index]), tuple(self.centroids[index].tolist()))
+
+    def large(self, min_width, min_height):
+        """
+        Returns the blobs at least min_width wide or min_height tall
+        """
+        widths = self.rects[:, 2] - self.rects[:, 0]
+        heights = self.rects[:, 3] - self.rects[:, 1]
+        keep = (widths >= min_width) | (heights >= min_height)
+        return Blobs(self.rects[keep], self.areas[keep], self.centroids[keep])
+
+
+def detect_blobs(image, reach=4, min_width=0, min_height=0):
+    """
+    Detects the blobs of a binary image. Pixels up to reach pixels apart in both directions belong
+    to the same blob, the same as the 9x9 flood fill of Old_Source_Files/Blob for a reach of 4.
+    The gaps are bridged by dilating with a reach x reach square, which makes exactly those pixels
+    8-connected, and each original pixel takes the label of the dilated region it is in.
+    8-connected pieces narrower than min_width and shorter than min_height are dropped before the
+    gaps are bridged, so they can't join or link up larger pieces
+    :arg image 2D binary array (0 for background, anything else for foreground)
+    :arg reach the largest distance between neighbouring pixels of a blob, 1 for plain 8-connectivity
+    :arg min_width the width a piece needs to be kept, unless it has min_height
+    :arg min_height the height a piece needs to be kept, unless it has min_width
+    :return Blobs
+    """
+    mask = (image > 0).astype(np.uint8)
+
+    # Exact statistics of the 8-connected pieces of the original pixels
+    num_pieces, piece_labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+        mask, 8, cv2.CV_32S, cv2.CCL_GRANA)
+    kept = (stats[:, cv2.CC_STAT_WIDTH] >= min_width) | (stats[:, cv2.CC_STAT_HEIGHT] >= min_height)
+    kept[0] = False
+    if not kept[1:].all():
+        mask = kept[piece_labels].astype(np.uint8)
+
+    # Group the kept pieces, each inside one bridged region
+    bridged = cv2.dilate(mask, np.ones((reach, reach), dtype=np.uint8)) if reach > 1 else mask
+    _, group_labels = cv2.connectedComponentsWithAlgorithm(bridged, 8, cv2.CV_32S, cv2.CCL_SPAGHETTI)
+    foreground = mask.astype(bool)
+    piece_groups = np.zeros(num_pieces, dtype=np.int64)
+    piece_groups[piece_labels[foreground]] = group_labels[foreground]
+    piece_groups, stats, centroids = piece_groups[kept], stats[kept], centroids[kept]
+    # Combine the pieces of each group
+    present, groups = np.unique(piece_groups, return_inverse=True)
+    areas = np.bincount(groups, weights=stats[:, cv2.CC_STAT_AREA], minlength=len(present)).astype(np.int64)
+    rects = np.empty((len(present), 4), dtype=np.int64)
+    rects[:, :2] = np.iinfo(np.int64).max
+    rects[:, 2:] = np.iinfo(np.int64).min
+    np.minimum.at(rects[:, 0], groups, stats[:, cv2.CC_STAT_LEFT])
+    np.minimum.at(rects[:, 1], groups, stats[:, cv2.CC_STAT_TOP])
+    np.maximum.at(rects[:, 2], groups, stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH])
+    np.maximum.at(rects[:, 3], groups, stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT])
+    weighted = centroids * stats[:, cv2.CC_STAT_AREA, None]
+    mean_centroids = np.stack([np.bincount(groups, weights=weighted[:, axis], minlength=len(present))
+                               for axis in (0, 1)], axis=1) / np.maximum(areas, 1)[:, None]
+    return Blobs(rects, areas, mean_centroids)
@@ -1,28 +1,75 @@
+import math
+
 import cv2
 import numpy as np
 
+from Blob_Detection import detect_blobs
+from Debug_Artifacts import artifacts
+
 
 def merge_rectangles(rects, threshold=10):
-    merged_rects = []
-    while rects:
-        rect = rects.pop(0)
-        x1, y1, x2, y2 = rect
-        index = 0
-        while index < len(rects):
-            nx1, ny1, nx2, ny2 = rects[index]
-            # Check if rectangles are close or overlapping
-            if (x1 - threshold < nx2 and x2 + threshold > nx1 and
-                    y1 - threshold < ny2 and y2 + threshold > ny1):
-                # Merge the rectangles
-                x1 = min(x1, nx1)
-                y1 = min(y1, ny1)
-                x2 = max(x2, nx2)
-                y2 = max(y2, ny2)
-                rects.pop(index)
-            else:
-                index += 1
-        merged_rects.append([x1, y1, x2, y2])
-    return merged_rects
+    """
+    Merges rectangles that overlap or are within threshold pixels of each other, repeating until
+    no two rectangles are close, so a merged rectangle that grows into another is merged with it too
+    :arg rects list of [x1, y1, x2, y2], left untouched
+    :arg threshold the largest gap between rectangles that still get merged
+    :return a list of [x1, y1, x2, y2], in the order of the first rectangle of each group
+    """
+    boxes = np.array(rects, dtype=np.int64).reshape(-1, 4)
+    while len(boxes) > 1:
+        groups = _group_close_rectangles(boxes, threshold)
+        if np.array_equal(groups, np.arange(len(boxes))):
+            break
+        # every group is labelled by its first rectangle, so groups keep their order
+        _, labels = np.unique(groups, return_inverse=True)
+        merged = np.empty((labels.max() + 1, 4), dtype=np.int64)
+        merged[:, :2] = np.iinfo(np.int64).max
+        merged[:, 2:] = np.iinfo(np.int64).min
+        np.minimum.at(merged[:, 0], labels, boxes[:, 0])
+        np.minimum.at(merged[:, 1], labels, boxes[:, 1])
+        np.maximum.at(merged[:, 2], labels, boxes[:, 2])
+        np.maximum.at(merged[:, 3], labels, boxes[:, 3])
+        boxes = merged
+    return boxes.tolist()
+
+
+def _group_close_rectangles(boxes, threshold):
+    """
+    Finds the groups of rectangles that are connected through close pairs
+    :arg boxes array of [x1, y1, x2, y2] rows
+    :arg threshold the largest gap between close rectangles
+    :return the index of the first rectangle of each rectangle's group
+    """
+    # two rectangles are close when they overlap after growing each by half the threshold
+    grown = boxes + np.array([-threshold, -threshold, threshold, threshold]) / 2
+
+    # sweep along x: sorted by left edge, a rectangle can only be close to the ones that start
+    # before it ends
+    order = np.argsort(grown[:, 0], kind="stable")
+    sorted_boxes = grown[order]
+    ends = np.searchsorted(sorted_boxes[:, 0], sorted_boxes[:, 2], side="left")
+    candidates = np.maximum(ends - np.arange(len(order)) - 1, 0)
+    first = np.repeat(np.arange(len(order)), candidates)
+    second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(candidates) - candidates, candidates)
+    close = ((sorted_boxes[first, 1] < sorted_boxes[second, 3]) & (sorted_boxes[second, 1] < sorted_boxes[first, 3])
+             & (sorted_boxes[first, 0] < sorted_boxes[second, 2]))
+    first, second = order[first[close]], order[second[close]]
+
+    # union-find, hooking the larger root of every close pair onto the smaller one until none are left
+    parent = np.arange(len(boxes))
+    while True:
+        first_root, second_root = parent[first], parent[second]
+        joining = first_root != second_root
+        if not joining.any():
+            return parent
+        np.minimum.at(parent, np.maximum(first_root, second_root)[joining],
+                      np.minimum(first_root, second_root)[joining])
+        # compress paths until every rectangle points at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
 
 
 def segment_cards(image, rects):
@@ -34,51 +81,118 @@ def segment_cards(image, rects):
     return cards
 
 
-class Card_Detection:
+def crop_card_groups(image, rects, padding=200):
     """
-    Method to draw rects around card grouos
+    Crops each card group out of an image with padding around it, clipped to the image
     :arg image read as cv2 img
-    :return a list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y]
+    :arg rects list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y]
+    :arg padding pixels kept around each group
+    :return a list of crops, views into image
     """
+    height, width = image.shape[:2]
+    return [image[max(0, y1 - padding):min(y2 + padding, height), max(0, x1 - padding):min(x2 + padding, width)]
+            for x1, y1, x2, y2 in rects]
 
-    @staticmethod
-    def DectectCards(image):
-        # Convert the image to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        # cv2.imwrite('out/gray.jpg', gray)
 
-        # Apply thresholding to create a binary image
-        _, binary = cv2.threshold(gray, 190, 255, cv2.THRESH_BINARY)
+def find_card_groups(image, min_width, min_height, threshold=10, method="contours"):
+    """
+    Finds the bright regions of an image that are large enough to be cards, merged into groups
+    :arg image read as cv2 img
+    :arg min_width the width a region needs, unless it has min_height
+    :arg min_height the height a region needs, unless it has min_width
+    :arg threshold the largest gap between regions of the same group
+    :arg method "contours" to merge the bounding rectangles of large contours, or "components" to
+    group the pixels of large regions with Blob_Detection
+    :return a list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y], and the binary image
+    """
+    # Convert the image to grayscale
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # Apply thresholding to create a binary image
+    _, binary = cv2.threshold(gray, 190, 255, cv2.THRESH_BINARY)
+
+    if method == "components":
+        # Small regions are dropped first, as with contours, then the pixels within threshold of
+        # each other are grouped as they are labelled; groups whose rectangles still overlap or
+        # nearly touch, e.g. a region inside another's hole, are merged like the contours' rectangles
+        blobs = detect_blobs(binary, max(int(threshold), 1), min_width, min_height)
+        return merge_rectangles(blobs.rects.tolist(), threshold), binary
 
-        # Find contours
-        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Find contours
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-        cv2.imwrite('out/binary.jpg', binary)
+    # Iterate over the contours and add bounding rectangles
+    rectangles = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w >= min_width or h >= min_height:
+            rectangles.append([x, y, x + w, y + h])
 
-        # Create a list to store rectangles
-        rectangles = []
+    # Merge rectangles that are nearby or overlapping
+    return merge_rectangles(rectangles, threshold), binary
+
+
+class Card_Detection:
+    """
+    Method to draw rects around card grouos
+    :arg image read as cv2 img
+    :arg scale factor the image is shrunk by to find the card groups, 1 searches at full resolution
+    :arg refine whether to find the edges of each group again at full resolution, only inside
+    the group's region
+    :arg method how the groups are found, see find_card_groups
+    :return a list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y]
+    """
 
-        # Minimum size for width and height of the blob
-        min_width = 200
-        min_height = 200
+    # Minimum size for width and height of the blob, at full resolution
+    MIN_WIDTH = 200
+    MIN_HEIGHT = 200
 
-        # Iterate over the contours and add bounding rectangles
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if w >= min_width or h >= min_height:
-                rectangles.append([x, y, x + w, y + h])
-        # Merge rectangles that are nearby or overlapping
-        merged_rectangles = merge_rectangles(rectangles)
+    # Largest gap between blobs of the same group, at full resolution
+    MERGE_THRESHOLD = 10
 
-        # Draw the merged rectangles
-        for rect in merged_rectangles:
-            x1, y1, x2, y2 = rect
-            # cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 15)
+    # Full resolution pixels searched around each group when refining
+    REFINE_MARGIN = 32
 
-        # # Save image for debugging
-        # cv2.imwrite('out/merged_rectangles.jpg', image)
+    # Share of the minimum size a blob needs on the shrunk image when refining, so blobs right at
+    # the minimum size are found there and get measured exactly at full resolution
+    REFINE_SIZE_SLACK = 0.8
 
-        return merged_rectangles
+    @staticmethod
+    def DectectCards(image, scale=1.0, refine=False, method="contours"):
+        if scale >= 1:
+            merged_rectangles, binary = find_card_groups(image, Card_Detection.MIN_WIDTH, Card_Detection.MIN_HEIGHT,
+                                                         Card_Detection.MERGE_THRESHOLD, method)
+            artifacts.submit("binary", binary)
+            return merged_rectangles
+
+        # Find the groups on the shrunk image, where the cards are still hundreds of pixels wide
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        min_scale = scale * Card_Detection.REFINE_SIZE_SLACK if refine else scale
+        small_rectangles, binary = find_card_groups(small, Card_Detection.MIN_WIDTH * min_scale,
+                                                    Card_Detection.MIN_HEIGHT * min_scale,
+                                                    Card_Detection.MERGE_THRESHOLD * scale, method)
+        artifacts.submit("binary", binary)
+
+        # Map the groups back to full resolution, rounding outwards
+        height, width = image.shape[:2]
+        merged_rectangles = [[int(x1 / scale), int(y1 / scale),
+                              min(math.ceil(x2 / scale), width), min(math.ceil(y2 / scale), height)]
+                             for x1, y1, x2, y2 in small_rectangles]
+        if not refine:
+            return merged_rectangles
+
+        # Find the exact edges inside each group's region, dropping the groups that are too small
+        refined_rectangles = []
+        margin = Card_Detection.REFINE_MARGIN
+        for x1, y1, x2, y2 in merged_rectangles:
+            x1, y1 = max(x1 - margin, 0), max(y1 - margin, 0)
+            x2, y2 = min(x2 + margin, width), min(y2 + margin, height)
+            region_rectangles, _ = find_card_groups(image[y1:y2, x1:x2], Card_Detection.MIN_WIDTH,
+                                                    Card_Detection.MIN_HEIGHT, Card_Detection.MERGE_THRESHOLD,
+                                                    method)
+            refined_rectangles += [[x1 + rx1, y1 + ry1, x1 + rx2, y1 + ry2]
+                                   for rx1, ry1, rx2, ry2 in region_rectangles]
+        return merge_rectangles(refined_rectangles, Card_Detection.MERGE_THRESHOLD)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from Card_Detection import Card_Detection
+from Card_Detection import Card_Detection, crop_card_groups
 from Prediction import Prediction
 import os
 import cv2
@@ -19,21 +19,20 @@ for img in os.listdir('test_images/Card_Detection/Input'):
     # output image
     image_out = image.copy()
 
-    # Get the card prediction
-    pred_cards = []
-    for card_group in card_groups:
+    # Get the card prediction, every card group in one batch
+    pred_cards = [pred.cards for pred in pd.predict_batch(crop_card_groups(image, card_groups))]
+
+    for card_group, cards in zip(card_groups, pred_cards):
         x1, y1, x2, y2 = card_group
         b_box = 200
         x1 = max(0, x1 - b_box)
         y1 = max(0, y1 - b_box)
         y2 = min(y2 + b_box, image.shape[0])
         x2 = min(x2 + b_box, image.shape[1])
-        card = image[y1:y2, x1:x2]
-        pred_cards.append(pd.predict(card)[1])
 
         # Draw bounding box around every card group and state card prediction for group
         cv2.rectangle(image_out, (x1, y1), (x2, y2), (0, 255, 0), 15)
-        cv2.putText(image_out, str(pred_cards[-1]), (x1, y1+170), cv2.FONT_HERSHEY_SIMPLEX, 6, (0, 255, 0), 15)
+        cv2.putText(image_out, str(cards), (x1, y1+170), cv2.FONT_HERSHEY_SIMPLEX, 6, (0, 255, 0), 15)
     cv2.imwrite("test_images/Card_Detection/Output/" + img, image_out)
     print(pred_cards)
     print("Image saved as test_images/Card_Detection/Output/" + img)
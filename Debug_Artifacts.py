@@ -0,0 +1,164 @@
+'''
+Description: Debug_Artifacts writes diagnostic images from the pipeline stages on a background
+thread, only for the stages that have been switched on
+'''
+import atexit
+import os
+import queue
+import sys
+import threading
+from typing import NamedTuple
+
+import cv2
+
+
+class StageSettings(NamedTuple):
+    """
+    How the images of one stage are written
+    :arg every_nth only every nth image of the stage is written
+    :arg scale factor the images are shrunk by before writing, 1 for full resolution
+    :arg keep_all whether every written image gets its own numbered file instead of replacing the last
+    """
+    every_nth: int
+    scale: float
+    keep_all: bool
+
+
+class ArtifactSink:
+    """
+    Collects debug images from named pipeline stages and writes them on a background thread. Every
+    stage is off until it is enabled, and a full queue drops images instead of waiting for the
+    writer, so diagnostics never block the pipeline. An image that can't be written is reported and
+    counted, and the writer moves on to the next one
+    :arg directory where the images are written
+    :arg queue_size the most images waiting to be written at once
+    """
+
+    # environment variable listing the stages to enable, e.g. DEBUG_ARTIFACTS=binary,predictions:10
+    ENVIRONMENT_VARIABLE = "DEBUG_ARTIFACTS"
+
+    def __init__(self, directory="out", queue_size=8):
+        self.directory = directory
+        self.stages: dict[str, StageSettings] = {}
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._frames: dict[str, int] = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, directory="out"):
+        """
+        Creates a sink with the stages listed in the DEBUG_ARTIFACTS environment variable enabled,
+        each as a stage name optionally followed by :N to only write every Nth image
+        """
+        sink = cls(directory)
+        for entry in filter(None, os.environ.get(cls.ENVIRONMENT_VARIABLE, "").split(",")):
+            stage, _, every_nth = entry.strip().partition(":")
+            sink.enable(stage, int(every_nth or 1))
+        return sink
+
+    def enable(self, stage, every_nth=1, scale=1.0, keep_all=False):
+        """
+        Starts writing the images of a stage, see StageSettings
+        """
+        self.stages[stage] = StageSettings(every_nth, scale, keep_all)
+
+    def disable(self, stage):
+        """
+        Stops writing the images of a stage
+        """
+        self.stages.pop(stage, None)
+
+    def wants(self, stage):
+        """
+        Whether a stage is enabled, for callers that only build an image for debugging
+        """
+        return stage in self.stages
+
+    def submit(self, stage, image):
+        """
+        Queues an image to be written as out/<stage>.jpg if its stage is enabled and the image is
+        sampled. The image is copied, or shrunk, before returning, so the caller can keep using it
+        :arg stage the name of the pipeline stage
+        :arg image read as cv2 img
+        :return whether the image was queued
+        """
+        settings = self.stages.get(stage)
+        if settings is None:
+            return False
+        frame = self._frames.get(stage, 0)
+        self._frames[stage] = frame + 1
+        if frame % settings.every_nth:
+            return False
+
+        if settings.scale < 1:
+            image = cv2.resize(image, None, fx=settings.scale, fy=settings.scale, interpolation=cv2.INTER_LINEAR)
+        else:
+            image = image.copy()
+        name = f"{stage}_{frame:06d}.jpg" if settings.keep_all else f"{stage}.jpg"
+
+        self._start_writer()
+        try:
+            self._queue.put_nowait((os.path.join(self.directory, name), image))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        """
+        Waits until every queued image has been written, or the writer thread has stopped
+        """
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks and self._thread is not None and self._thread.is_alive():
+                self._queue.all_tasks_done.wait(0.1)
+
+    def close(self):
+        """
+        Writes the queued images and stops the writer thread, which is started again by the next submit
+        """
+        with self._thread_lock:
+            if self._thread is None:
+                return
+            # a writer that has stopped can't make room in a full queue
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self._thread.join()
+            self._thread = None
+
+    def _start_writer(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write, name="debug-artifacts", daemon=True)
+                self._thread.start()
+                # write whatever is still queued when the program exits
+                atexit.register(self.close)
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, image = item
+                try:
+                    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                    if not cv2.imwrite(path, image):
+                        raise OSError("the image could not be encoded")
+                    self.written += 1
+                except Exception as error:
+                    self.failed += 1
+                    print(f"Could not write {path}: {error}", file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+
+# the sink every pipeline stage submits to, off unless DEBUG_ARTIFACTS lists stages
+artifacts = ArtifactSink.from_environment()
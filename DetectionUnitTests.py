@@ -0,0 +1,181 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from Blob_Detection import detect_blobs
+from Card_Detection import Card_Detection, crop_card_groups, merge_rectangles
+from Debug_Artifacts import ArtifactSink
+from Frame_Tracking import FrameTracker
+
+
+class TestCardDetection(unittest.TestCase):
+    def test_merge_rectangles_reaches_fixed_point(self):
+        # the third rectangle only touches the first once the second has grown it
+        rects = [[0, 0, 100, 100], [500, 0, 600, 100], [95, 0, 505, 50], [1000, 1000, 1100, 1100]]
+        self.assertEqual(merge_rectangles(rects), [[0, 0, 600, 100], [1000, 1000, 1100, 1100]])
+        self.assertEqual(len(rects), 4)
+
+    def test_merge_rectangles_absorbs_nested_rectangles(self):
+        rects = [[10, 10, 20, 20], [0, 0, 500, 500], [100, 100, 120, 400]]
+        self.assertEqual(merge_rectangles(rects), [[0, 0, 500, 500]])
+
+    def test_merge_rectangles_respects_threshold(self):
+        self.assertEqual(len(merge_rectangles([[0, 0, 10, 10], [19, 0, 30, 10]], threshold=10)), 1)
+        self.assertEqual(len(merge_rectangles([[0, 0, 10, 10], [20, 0, 30, 10]], threshold=10)), 2)
+        self.assertEqual(merge_rectangles([]), [])
+
+    def test_merge_rectangles_leaves_no_close_pairs(self):
+        rng = np.random.default_rng(0)
+        corners = rng.integers(0, 2000, (300, 2))
+        rects = np.hstack([corners, corners + rng.integers(1, 60, (300, 2))]).tolist()
+        merged = merge_rectangles(rects)
+        for index, (x1, y1, x2, y2) in enumerate(merged):
+            for nx1, ny1, nx2, ny2 in merged[index + 1:]:
+                self.assertFalse(x1 - 10 < nx2 and x2 + 10 > nx1 and y1 - 10 < ny2 and y2 + 10 > ny1)
+
+    def test_pyramid_matches_full_resolution(self):
+        image = np.full((2000, 1600, 3), 40, dtype=np.uint8)
+        cv2.rectangle(image, (101, 203), (620, 951), (255, 255, 255), -1)
+        cv2.rectangle(image, (633, 207), (1150, 960), (255, 255, 255), -1)
+        cv2.rectangle(image, (400, 1301), (905, 1899), (255, 255, 255), -1)
+        cv2.rectangle(image, (1500, 10), (1530, 190), (255, 255, 255), -1)  # smaller than a card
+        full = Card_Detection.DectectCards(image)
+        self.assertEqual(len(full), 3)
+        self.assertEqual(sorted(Card_Detection.DectectCards(image, 0.25, refine=True)), sorted(full))
+        for coarse, exact in zip(sorted(Card_Detection.DectectCards(image, 0.25)), sorted(full)):
+            self.assertLessEqual(np.abs(np.subtract(coarse, exact)).max(), 4)
+
+    def test_detect_blobs_bridges_gaps_within_reach(self):
+        image = np.zeros((100, 100), dtype=np.uint8)
+        image[10:20, 10:20] = 255
+        image[10:20, 23:30] = 255  # 4 pixels right of the first square's last column
+        image[60:70, 10:20] = 255
+        image[60:70, 24:30] = 255  # 5 pixels right of the third square's last column
+        blobs = detect_blobs(image, reach=4)
+        self.assertEqual(sorted(blobs.rects.tolist()), [[10, 10, 30, 20], [10, 60, 20, 70], [24, 60, 30, 70]])
+        first = blobs[int(np.argmin(blobs.rects[:, 1] * 100 + blobs.rects[:, 0]))]
+        self.assertEqual(first.area, 170)
+        self.assertAlmostEqual(first.centroid[1], 14.5)
+        self.assertAlmostEqual(first.centroid[0], (10 * 14.5 + 7 * 26) / 17)
+        self.assertEqual(len(detect_blobs(image, reach=1)), 4)
+        self.assertEqual(len(detect_blobs(np.zeros((10, 10), dtype=np.uint8))), 0)
+
+    def test_components_method_finds_the_same_cards(self):
+        image = np.full((2000, 1600, 3), 40, dtype=np.uint8)
+        cv2.rectangle(image, (101, 203), (620, 951), (255, 255, 255), -1)
+        cv2.rectangle(image, (400, 1301), (905, 1899), (255, 255, 255), -1)
+        cv2.rectangle(image, (1500, 10), (1530, 190), (255, 255, 255), -1)  # smaller than a card
+        self.assertEqual(sorted(Card_Detection.DectectCards(image, method="components")),
+                         sorted(Card_Detection.DectectCards(image)))
+
+    def test_components_method_matches_contours_on_sample_photos(self):
+        # photos where bridging small bright specks used to add or grow groups
+        for name in ("IMG_8933.JPG", "IMG_8935.JPG", "IMG_8962.JPG", "IMG_8979.JPG"):
+            image = cv2.imread(os.path.join("test_images/Card_Detection/Input", name), cv2.IMREAD_COLOR)
+            for scale, refine in ((0.25, True), (1.0, False)):
+                with self.subTest(name=name, scale=scale):
+                    self.assertEqual(sorted(Card_Detection.DectectCards(image, scale, refine, method="components")),
+                                     sorted(Card_Detection.DectectCards(image, scale, refine)))
+
+    def test_detect_blobs_drops_small_pieces_before_bridging(self):
+        image = np.zeros((100, 100), dtype=np.uint8)
+        image[10:60, 10:20] = 255
+        image[10:60, 40:50] = 255
+        image[30:32, 22:38:3] = 255  # a line of specks within reach of both bars
+        self.assertEqual(len(detect_blobs(image, reach=4)), 1)
+        self.assertEqual(sorted(detect_blobs(image, reach=4, min_width=20, min_height=20).rects.tolist()),
+                         [[10, 10, 20, 60], [40, 10, 50, 60]])
+
+    def test_crop_card_groups_pads_inside_the_image(self):
+        image = np.zeros((1000, 800, 3), dtype=np.uint8)
+        crops = crop_card_groups(image, [[100, 300, 400, 700], [600, 50, 750, 900]], padding=200)
+        self.assertEqual([crop.shape[:2] for crop in crops], [(800, 600), (1000, 400)])
+
+    def test_artifact_sink_samples_and_downscales(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sink = ArtifactSink(directory)
+            image = np.zeros((400, 200), dtype=np.uint8)
+            self.assertFalse(sink.submit("binary", image))
+            sink.enable("binary", every_nth=2, scale=0.5, keep_all=True)
+            queued = [sink.submit("binary", image) for _ in range(5)]
+            sink.close()
+            self.assertEqual(queued, [True, False, True, False, True])
+            self.assertEqual(sorted(os.listdir(directory)), ["binary_000000.jpg", "binary_000002.jpg",
+                                                             "binary_000004.jpg"])
+            self.assertEqual(cv2.imread(os.path.join(directory, "binary_000000.jpg")).shape[:2], (200, 100))
+
+    def test_artifact_sink_survives_failed_writes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            blocker = os.path.join(directory, "not_a_directory")
+            open(blocker, "w").close()
+            sink = ArtifactSink(blocker, queue_size=1)
+            sink.enable("binary")
+            with contextlib.redirect_stderr(io.StringIO()) as error:
+                for _ in range(3):
+                    self.assertTrue(sink.submit("binary", np.zeros((10, 10), dtype=np.uint8)))
+                    sink.flush()
+                # the writer carries on with the next image
+                sink.directory = directory
+                self.assertTrue(sink.submit("binary", np.zeros((10, 10), dtype=np.uint8)))
+                sink.close()
+            self.assertEqual((sink.failed, sink.written), (3, 1))
+            self.assertIn("Could not write", error.getvalue())
+            self.assertTrue(os.path.exists(os.path.join(directory, "binary.jpg")))
+
+    def test_artifact_sink_close_returns_when_the_writer_is_gone(self):
+        class DeadSink(ArtifactSink):
+            def _write(self):
+                pass  # the writer stops without taking anything off the queue
+
+        sink = DeadSink(queue_size=1)
+        sink.enable("binary")
+        sink.submit("binary", np.zeros((10, 10), dtype=np.uint8))
+        sink._thread.join()
+        sink.flush()
+        sink.close()
+        self.assertIsNone(sink._thread)
+
+    def test_artifact_sink_drops_when_full(self):
+        class StalledSink(ArtifactSink):
+            def _start_writer(self):
+                pass  # nothing takes images off the queue
+
+        sink = StalledSink(queue_size=1)
+        sink.enable("predictions")
+        self.assertTrue(sink.submit("predictions", np.zeros((10, 10, 3), dtype=np.uint8)))
+        self.assertFalse(sink.submit("predictions", np.zeros((10, 10, 3), dtype=np.uint8)))
+        self.assertEqual(sink.dropped, 1)
+
+    def test_frame_tracker_only_redoes_changed_groups(self):
+        frame = np.full((1200, 1600, 3), 40, dtype=np.uint8)
+        cv2.rectangle(frame, (100, 100), (400, 500), (255, 255, 255), -1)
+        cv2.rectangle(frame, (900, 100), (1200, 500), (255, 255, 255), -1)
+        classified = []
+        tracker = FrameTracker(classify=lambda crop: classified.append(crop.shape) or len(classified))
+        first = tracker.update(frame)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(tracker.classifications, 2)
+
+        # an unchanged frame only costs the comparison
+        steady = tracker.update(frame.copy())
+        self.assertEqual([group.rect for group in steady], [group.rect for group in first])
+        self.assertFalse(any(group.updated for group in steady))
+        self.assertEqual((tracker.full_detections, tracker.region_detections, tracker.classifications), (1, 0, 2))
+
+        # a new card far from the others is detected and classified on its own
+        dealt = frame.copy()
+        cv2.rectangle(dealt, (500, 700), (800, 1100), (255, 255, 255), -1)
+        groups = tracker.update(dealt)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(tracker.region_detections, 1)
+        self.assertEqual(tracker.classifications, 3)
+        self.assertEqual([group.labels for group in groups if not group.updated], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+'''
+Description: Frame_Tracking follows card groups from frame to frame of a live feed, so card
+detection and classification only run again where the table actually changed
+'''
+import math
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+from Card_Detection import Card_Detection, crop_card_groups, merge_rectangles
+
+
+class TrackedGroup(NamedTuple):
+    """
+    A card group followed across frames
+    :arg rect [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y] of the group in the frame
+    :arg labels what classify returned for the group, None without a classifier
+    :arg updated whether the group was detected or classified again on this frame
+    """
+    rect: list
+    labels: object
+    updated: bool
+
+
+class FrameTracker:
+    """
+    Sits between the camera and card detection. Each frame is shrunk and compared with the last
+    frame that was processed; while nothing changes the known groups are returned as they are.
+    Changed regions are detected again on their own, together with the groups they touch, and
+    only groups whose pixels changed are classified again
+    :arg detect function that returns the card groups of an image, see Card_Detection.DectectCards
+    :arg classify function that returns the labels of a card group crop, None to only track groups
+    :arg diff_scale factor frames are shrunk by before comparing them
+    :arg pixel_threshold gray level difference that counts as a change
+    :arg margin full resolution pixels added around each changed region before detecting in it
+    :arg padding full resolution pixels added around each group before classifying it
+    """
+
+    def __init__(self, detect=Card_Detection.DectectCards, classify=None, diff_scale=0.125,
+                 pixel_threshold=30, margin=50, padding=200):
+        self.detect = detect
+        self.classify = classify
+        self.diff_scale = diff_scale
+        self.pixel_threshold = pixel_threshold
+        self.margin = margin
+        self.padding = padding
+        self.groups: list[TrackedGroup] = []
+        self.full_detections = 0
+        self.region_detections = 0
+        self.classifications = 0
+        # the shrunk gray image of the last processed frame
+        self._reference = None
+
+    def track(self, frames):
+        """
+        Follows the card groups through a feed, e.g. Camera.get_frame()
+        :return a generator of each frame along with its groups
+        """
+        for frame in frames:
+            yield frame, self.update(frame)
+
+    def update(self, frame):
+        """
+        Brings the card groups up to date with a new frame
+        :arg frame read as cv2 img
+        :return the TrackedGroups in the frame
+        """
+        small = cv2.cvtColor(cv2.resize(frame, None, fx=self.diff_scale, fy=self.diff_scale,
+                                        interpolation=cv2.INTER_NEAREST), cv2.COLOR_BGR2GRAY)
+        if self._reference is None or self._reference.shape != small.shape:
+            self._reference = small
+            self.full_detections += 1
+            self.groups = [self._classified(frame, rect) for rect in self.detect(frame)]
+            return self.groups
+
+        # Pixels that changed by more than sensor noise, without isolated specks
+        difference = cv2.absdiff(small, self._reference)
+        _, changed = cv2.threshold(difference, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+        changed = cv2.erode(changed, np.ones((3, 3), dtype=np.uint8))
+        if not cv2.countNonZero(changed):
+            self.groups = [group._replace(updated=False) for group in self.groups]
+            return self.groups
+        self._reference = small
+
+        groups = [group._replace(updated=False) for group in self.groups]
+        for region in self._changed_regions(changed, frame.shape):
+            touched = [group for group in groups if self._overlaps(group.rect, region)]
+            groups = [group for group in groups if not self._overlaps(group.rect, region)]
+
+            # Detect again inside the changed region and every group it touches
+            x1 = max(min([region[0]] + [group.rect[0] for group in touched]), 0)
+            y1 = max(min([region[1]] + [group.rect[1] for group in touched]), 0)
+            x2 = min(max([region[2]] + [group.rect[2] for group in touched]), frame.shape[1])
+            y2 = min(max([region[3]] + [group.rect[3] for group in touched]), frame.shape[0])
+            self.region_detections += 1
+            for rx1, ry1, rx2, ry2 in self.detect(frame[y1:y2, x1:x2]):
+                rect = [x1 + rx1, y1 + ry1, x1 + rx2, y1 + ry2]
+                # A group that is still in the same place and didn't change keeps its labels
+                unchanged = [group for group in touched
+                             if group.rect == rect and not self._changed_inside(changed, rect)]
+                groups.append(unchanged[0] if unchanged else self._classified(frame, rect))
+        self.groups = groups
+        return self.groups
+
+    def _changed_regions(self, changed, shape):
+        """
+        Returns the full resolution rectangles around the changed pixels, grown by margin
+        """
+        contours, _ = cv2.findContours(changed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        regions = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            regions.append([max(int(x / self.diff_scale) - self.margin, 0),
+                            max(int(y / self.diff_scale) - self.margin, 0),
+                            min(math.ceil((x + w) / self.diff_scale) + self.margin, shape[1]),
+                            min(math.ceil((y + h) / self.diff_scale) + self.margin, shape[0])])
+        return merge_rectangles(regions, 0)
+
+    def _changed_inside(self, changed, rect):
+        x1, y1, x2, y2 = rect
+        scale = self.diff_scale
+        return cv2.countNonZero(changed[int(y1 * scale):math.ceil(y2 * scale),
+                                        int(x1 * scale):math.ceil(x2 * scale)]) > 0
+
+    @staticmethod
+    def _overlaps(rect, region):
+        return rect[0] < region[2] and region[0] < rect[2] and rect[1] < region[3] and region[1] < rect[3]
+
+    def _classified(self, frame, rect):
+        """
+        Classifies a newly detected group from its crop, padded like Integration.compute does
+        """
+        if self.classify is None:
+            return TrackedGroup(rect, None, True)
+        crop, = crop_card_groups(frame, [rect], self.padding)
+        self.classifications += 1
+        return TrackedGroup(rect, self.classify(crop), True)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append("Old_Source_Files")
+    from Camera import Camera
+
+    camera = Camera()
+    tracker = FrameTracker(lambda image: Card_Detection.DectectCards(image, 0.25, refine=True))
+    for frame, groups in tracker.track(camera.get_frame()):
+        for group in groups:
+            x1, y1, x2, y2 = group.rect
+            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255) if group.updated else (0, 255, 0), 4)
+        cv2.imshow("frame", frame)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+    camera.release()
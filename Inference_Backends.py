@@ -0,0 +1,322 @@
+'''
+Description: Inference_Backends runs the card model with eager PyTorch, ONNX Runtime or OpenVINO,
+exports and int8 quantizes it for CPU inference, and checks every backend against PyTorch
+'''
+import argparse
+import ast
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# the backend used for each kind of weights file when none is asked for
+BACKEND_BY_EXTENSION = {".pt": "torch", ".onnx": "onnxruntime", ".xml": "openvino"}
+
+# detections kept by the exported models, matching what ultralytics keeps by default
+CONFIDENCE_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.7
+MAX_DETECTIONS = 300
+
+CALIBRATION_IMAGES = "test_images/Card_Detection/Input"
+
+
+def backend_for(weights):
+    """
+    Returns the backend that runs a weights file by default, from its extension
+    """
+    extension = os.path.splitext(weights)[1].lower()
+    if extension not in BACKEND_BY_EXTENSION:
+        raise ValueError(f"No backend runs {weights}, expected one of {', '.join(BACKEND_BY_EXTENSION)}")
+    return BACKEND_BY_EXTENSION[extension]
+
+
+def load_backend(weights, backend=None):
+    """
+    Loads a weights file with a backend, importing the backend's libraries only now
+    :arg weights a .pt file for torch, a .onnx file for onnxruntime or openvino, or a .xml file for openvino
+    :arg backend "torch", "onnxruntime" or "openvino", None to pick from the extension
+    :return the loaded backend
+    """
+    backend = backend or backend_for(weights)
+    if backend == "torch":
+        return TorchBackend(weights)
+    if backend == "onnxruntime":
+        return OnnxRuntimeBackend(weights)
+    if backend == "openvino":
+        return OpenVinoBackend(weights)
+    raise ValueError(f"Unknown backend {backend}")
+
+
+def decode_yolo_output(output, confidence_threshold=CONFIDENCE_THRESHOLD, iou_threshold=IOU_THRESHOLD,
+                       max_detections=MAX_DETECTIONS):
+    """
+    Turns the raw output of an exported YOLOv8 model into detections, keeping the best class of every
+    anchor above the confidence threshold and suppressing overlapping boxes of the same class
+    :arg output (batch, 4 + classes, anchors) array of centre x, centre y, width, height and class scores
+    :return a list with, for each image, the (n, 4) boxes as [x1, y1, x2, y2], the (n,) confidences
+    and the (n,) class ids, most confident first
+    """
+    detections = []
+    for prediction in output:
+        scores = prediction[4:]
+        class_ids = scores.argmax(axis=0)
+        confidences = scores[class_ids, np.arange(scores.shape[1])]
+        keep = confidences > confidence_threshold
+        centre_x, centre_y, width, height = prediction[:4, keep]
+        confidences, class_ids = confidences[keep], class_ids[keep]
+        boxes = np.stack([centre_x - width / 2, centre_y - height / 2, centre_x + width / 2,
+                          centre_y + height / 2], axis=1).astype(np.float32)
+
+        kept = non_max_suppression(boxes, confidences, class_ids, iou_threshold, max_detections)
+        detections.append((boxes[kept], confidences[kept].astype(np.float32), class_ids[kept].astype(np.int64)))
+    return detections
+
+
+def non_max_suppression(boxes, confidences, class_ids, iou_threshold=IOU_THRESHOLD, max_detections=MAX_DETECTIONS):
+    """
+    Suppresses the boxes that overlap a more confident box of the same class
+    :arg boxes (n, 4) array of [x1, y1, x2, y2]
+    :arg confidences (n,) array
+    :arg class_ids (n,) array
+    :return the indices of the kept boxes, most confident first
+    """
+    if not len(boxes):
+        return np.empty(0, dtype=np.int64)
+    kept = cv2.dnn.NMSBoxesBatched(np.column_stack([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]]).tolist(),
+                                   confidences.tolist(), np.asarray(class_ids).tolist(), 0.0, iou_threshold)
+    kept = np.array(kept, dtype=np.int64).reshape(-1)
+    return kept[np.argsort(-confidences[kept], kind="stable")][:max_detections]
+
+
+def read_names(onnx_path):
+    """
+    Reads the class names ultralytics stores in the metadata of an exported model
+    :return a dict of class id to card name
+    """
+    import onnx
+
+    metadata = {prop.key: prop.value for prop in onnx.load(onnx_path, load_external_data=False).metadata_props}
+    return ast.literal_eval(metadata["names"])
+
+
+def read_openvino_names(model):
+    """
+    Reads the class names ultralytics stores in the runtime info of a model it exported to OpenVINO,
+    as labels separated by spaces
+    :arg model the openvino.Model read from the .xml file
+    :return a dict of class id to card name, or None if the model has no labels
+    """
+    if not model.has_rt_info(["model_info", "labels"]):
+        return None
+    labels = model.get_rt_info(["model_info", "labels"]).astype(str).split()
+    return dict(enumerate(labels))
+
+
+class TorchBackend:
+    """
+    Runs the ultralytics model with eager PyTorch
+    :arg weights the .pt weights file
+    :arg verbose whether to print if a GPU is available to run on
+    """
+
+    def __init__(self, weights, verbose=False):
+        import torch
+        from ultralytics import YOLO
+
+        if verbose:
+            if torch.cuda.is_available():
+                print(f"GPU: {torch.cuda.get_device_name(0)} is available.")
+            else:
+                print("No GPU available. Inference will run on CPU.")
+        self.name = "torch"
+        self.model = YOLO(weights)
+        self.names = self.model.names
+
+    def __call__(self, batch):
+        """
+        Runs the model on a batch
+        :arg batch (n, 3, size, size) float32 RGB array scaled to [0, 1]
+        :return the detections of each image, see decode_yolo_output
+        """
+        import torch
+
+        results = self.model(torch.from_numpy(batch), imgsz=batch.shape[-1], verbose=False)
+        return [(result.boxes.xyxy.cpu().numpy(), result.boxes.conf.cpu().numpy(),
+                 result.boxes.cls.cpu().numpy().astype(np.int64)) for result in results]
+
+
+class OnnxRuntimeBackend:
+    """
+    Runs an exported model with ONNX Runtime on the CPU
+    :arg weights the .onnx file, float or int8 quantized
+    """
+
+    def __init__(self, weights):
+        import onnxruntime
+
+        self.name = "onnxruntime"
+        self.session = onnxruntime.InferenceSession(weights, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.names = read_names(weights)
+
+    def __call__(self, batch):
+        return decode_yolo_output(self.session.run(None, {self.input_name: batch})[0])
+
+
+class OpenVinoBackend:
+    """
+    Runs an exported model with OpenVINO on the CPU
+    :arg weights the .onnx file, float or int8 quantized, or an OpenVINO .xml file converted from it
+    :arg names dict of class id to card name, None to read them from the model. An .xml file's are
+    read from its runtime info, or else from the .onnx file next to it
+    """
+
+    def __init__(self, weights, names=None):
+        import openvino
+
+        self.name = "openvino"
+        core = openvino.Core()
+        model = core.read_model(weights)
+        self.model = core.compile_model(model, "CPU")
+        if names is None and os.path.splitext(weights)[1].lower() == ".xml":
+            names = read_openvino_names(model)
+            onnx_path = os.path.splitext(weights)[0] + ".onnx"
+            if names is None and not os.path.exists(onnx_path):
+                raise ValueError(f"{weights} has no class names in its runtime info and there is no {onnx_path} "
+                                 f"to read them from, pass them as names")
+            weights = onnx_path
+        self.names = read_names(weights) if names is None else names
+
+    def __call__(self, batch):
+        return decode_yolo_output(self.model([batch])[self.model.output(0)])
+
+
+def export_onnx(weights="best.pt", image_size=416):
+    """
+    Exports the trained model to ONNX with a dynamic batch size, so every crop of a frame runs in one call
+    :return the path of the .onnx file, next to the weights
+    """
+    from ultralytics import YOLO
+
+    return YOLO(weights).export(format="onnx", imgsz=image_size, dynamic=True, simplify=True)
+
+
+def calibration_crops(directory=CALIBRATION_IMAGES, max_images=20):
+    """
+    Crops the card groups of the test photos the way Integration.compute does, so the model is
+    calibrated on the inputs it sees in use
+    :return a list of crops
+    """
+    from Card_Detection import Card_Detection, crop_card_groups
+
+    crops = []
+    for name in sorted(os.listdir(directory))[:max_images]:
+        image = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+        if image is not None:
+            crops += crop_card_groups(image, Card_Detection.DectectCards(image, 0.25, refine=True))
+    return crops
+
+
+class CalibrationReader:
+    """
+    Feeds prepared crops to ONNX Runtime's static quantization one at a time
+    :arg input_name the name of the model's input
+    :arg crops images read as cv2 img
+    :arg prepare function that turns a list of crops into a model batch, see Prediction.prepare_batch
+    """
+
+    def __init__(self, input_name, crops, prepare):
+        self._batches = iter([{input_name: prepare([crop])} for crop in crops])
+
+    def get_next(self):
+        return next(self._batches, None)
+
+
+def quantize_onnx(onnx_path, crops=None, output=None):
+    """
+    Quantizes an exported model to int8 with static post-training quantization, calibrated on card
+    group crops. The QDQ model runs on both ONNX Runtime and OpenVINO
+    :arg onnx_path the float .onnx file
+    :arg crops calibration crops, the test photos' card groups if None
+    :arg output where the quantized model is saved, <name>_int8.onnx next to the float model if None
+    :return the path of the quantized model
+    """
+    import onnx
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    from Prediction import Prediction
+
+    output = output or os.path.splitext(onnx_path)[0] + "_int8.onnx"
+    input_name = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    reader = CalibrationReader(input_name, calibration_crops() if crops is None else crops,
+                               Prediction.prepare_batch)
+    quantize_static(onnx_path, output, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+    # keep the class names in the quantized model
+    source, quantized = onnx.load(onnx_path), onnx.load(output)
+    onnx.helper.set_model_props(quantized, {prop.key: prop.value for prop in source.metadata_props})
+    onnx.save(quantized, output)
+    return output
+
+
+def check_parity(candidates, weights="best.pt", directory=CALIBRATION_IMAGES, max_images=None):
+    """
+    Runs the card groups of the test photos through PyTorch and through each candidate backend,
+    comparing the card names found for every crop
+    :arg candidates list of (weights, backend) pairs, backend None to pick from the extension
+    :arg weights the .pt weights the candidates were exported from
+    :return a dict with, for each backend, the share of crops whose card names match PyTorch's and
+    the median milliseconds per photo
+    """
+    from Card_Detection import Card_Detection, crop_card_groups
+    from Prediction import ModelRegistry, Prediction
+
+    photos = []
+    for name in sorted(os.listdir(directory))[:max_images]:
+        image = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+        if image is not None:
+            photos.append(crop_card_groups(image, Card_Detection.DectectCards(image, 0.25, refine=True)))
+
+    registry = ModelRegistry()
+    report = {}
+    reference = None
+    for candidate, backend in [(weights, "torch")] + list(candidates):
+        prediction = Prediction(candidate, registry, backend)
+        prediction.warm_up()
+        labels, latencies = [], []
+        for crops in photos:
+            start = time.perf_counter()
+            labels += [pred.cards for pred in prediction.predict_batch(crops)]
+            latencies.append(time.perf_counter() - start)
+        reference = labels if reference is None else reference
+        name = f"{prediction.model.name} {os.path.basename(candidate)}"
+        report[name] = {
+            "label_agreement": float(np.mean([a == b for a, b in zip(labels, reference)])) if labels else 1.0,
+            "latency_ms": float(np.median(latencies) * 1000) if latencies else 0.0,
+        }
+    return report
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Export the card model for CPU inference and check it.")
+    parser.add_argument("--weights", default="best.pt", help="trained PyTorch weights")
+    parser.add_argument("--int8", action="store_true", help="also quantize the exported model to int8")
+    parser.add_argument("--openvino", action="store_true", help="also check the exported models on OpenVINO")
+    parser.add_argument("--max-images", type=int, help="test photos to check, all of them by default")
+    options = parser.parse_args(arguments)
+
+    onnx_path = export_onnx(options.weights)
+    exported = [onnx_path] + ([quantize_onnx(onnx_path)] if options.int8 else [])
+    candidates = [(path, "onnxruntime") for path in exported]
+    candidates += [(path, "openvino") for path in exported] if options.openvino else []
+    for name, result in check_parity(candidates, options.weights, max_images=options.max_images).items():
+        print(f"{name}: {result['label_agreement']:.1%} label agreement, {result['latency_ms']:.1f} ms per photo")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,15 +1,31 @@
 import Card_Detection as CD
 import Prediction as P
 import Algorithm as A
+import Recognition_Cache as RC
+import Label_Voting as LV
 import re
 
 import cv2
 import numpy as np
 
+from Debug_Artifacts import artifacts
+
 class Integration:
-    def __init__(self):
+    # Card groups are found on the photo shrunk by this factor, then refined at full resolution
+    DETECTION_SCALE = 0.25
+
+    def __init__(self, tiled=False, voting=False):
+        """
+        :arg tiled whether to find the cards with one tiled pass of the model over the whole photo,
+        instead of one padded crop per card group
+        :arg voting whether to vote on each card group's cards over consecutive frames of a feed,
+        instead of trusting every frame on its own
+        """
+        self.tiled = tiled
+        self.voter = LV.LabelVoter() if voting else None
         self.card_detection = CD.Card_Detection()
         self.prediction = P.Prediction()
+        self.recognition_cache = RC.RecognitionCache()
         self.algorithm = A.Algorithm()
 
     def compute(self, img):
@@ -18,23 +34,35 @@ class Integration:
         :return: prediction
         """
         # Get the card groups
-        card_groups = self.card_detection.DectectCards(img)
+        card_groups = self.card_detection.DectectCards(img, self.DETECTION_SCALE, refine=True)
         print(card_groups)
 
         # Get the card prediction
-        pred_cards = []
-        for card_group in card_groups:
-            x1, y1, x2, y2 = card_group
-            b_box = 200
-            x1 = max(0, x1 - b_box)
-            y1 = max(0, y1 - b_box)
-            y2 = min(y2 + b_box, image.shape[0])
-            x2 = min(x2 + b_box, image.shape[1])
-            card = image[y1:y2, x1:x2]
-            pred_cards.append(self.prediction.predict(card)[1])
+        pred_cards = self.classify_groups(img, card_groups)
 
         print(pred_cards)
 
+        decision = self.decide(card_groups, pred_cards)
+        if decision is None:
+            print("No dealer found")
+            return None
+        action_list, player_Coords = decision
+
+        self.draw_actions(img, player_Coords, action_list)
+        artifacts.submit("predictions", img)
+
+        return action_list
+
+    def decide(self, card_groups, pred_cards, mode=A.EvaluationMode.EXACT, time_budget=None):
+        """
+        Finds the dealer's card group, the one with a single card, and the best action of every player
+        :arg card_groups list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y]
+        :arg pred_cards the set of card names of each card group
+        :arg mode the Algorithm.EvaluationMode the expected values are found with
+        :arg time_budget seconds the SAMPLED and AUTO modes may spend on all the players together
+        :return the list of actions and the rectangles of the players' groups, or None if no dealer was found
+        """
+        pred_cards = list(pred_cards)
         dealer = None
         players = None
         player_Coords = None
@@ -47,11 +75,8 @@ class Integration:
                 break
 
         if dealer is None:
-            print("No dealer found")
             return None
 
-        print(dealer)
-        print(players)
         dealer = list(dealer)
         # Convert list of string card values to card Enum Values
         Dealer_Card = dealer[0]
@@ -59,27 +84,84 @@ class Integration:
         Dealer_Card = A.CardRank(Dealer_Card)
 
         # list of actions from algo
-        action_list = []
+        hands = []
         for player in players:  # Iterates through all players
             player_cards = [] # cards for player
             for card in player:
                 card = card.replace("c","").replace("s", "").replace("h","").replace("d","")
                 card_rank_enum = A.CardRank(card)
                 player_cards.append(card_rank_enum)
-            action_list.append(self.algorithm.action(Dealer_Card, player_cards))
-
-        # On the original image draw the bounding box as well as the action to take for each player based on the
-        # action list. Place the action near the bounding box for that player.
-        # Action List: 0 -> Stand, 1 -> Hit, 2 -> Double Down
+            hands.append(player_cards)
+        # evaluate every player in one pass, sharing the dealer side
+        action_list = [self.algorithm.best_action(expected_values)
+                       for expected_values in self.algorithm.action_batch(Dealer_Card, hands, mode, time_budget)]
+        return action_list, player_Coords
+
+    @staticmethod
+    def draw_actions(img, player_Coords, action_list):
+        """
+        On the original image draw the bounding box as well as the action to take for each player based on the
+        action list. Place the action near the bounding box for that player.
+        """
+        # Action List: 0 -> Stand, 1 -> Hit, 2 -> Double Down, 3 -> Split, 4 -> Surrender
+        action_names = ["Stand", "Hit", "Double Down", "Split", "Surrender"]
         for i in range(len(player_Coords)):
             x1, y1, x2, y2 = player_Coords[i]
             cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 15)
             # Convert action to string for display based on the action list
-            out = "Stand" if action_list[i] == 0 else "Hit" if action_list[i] == 1 else "Double Down"
+            out = action_names[action_list[i]]
             cv2.putText(img, out, (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 6, (0, 255, 0), 10, cv2.LINE_AA)
-        cv2.imwrite("out/predictions.jpg", img)
 
-        return action_list
+    def classify_groups(self, img, card_groups):
+        """
+        Finds the cards of every card group, either from the whole photo in tiles or from a batch of
+        padded crops. Groups that look the same as recently recognized ones are taken from the cache.
+        When voting, groups whose cards have settled aren't classified again, and each group gets its
+        settled cards once it has them
+        :return a list with the set of card names of each card group
+        """
+        if self.voter is None:
+            return [pred.cards for pred in self._predict_groups(img, card_groups)]
+
+        pending = [index for index, stable in enumerate(self.voter.stable(card_groups)) if not stable]
+        predictions = dict(zip(pending, self._predict_groups(img, [card_groups[index] for index in pending])))
+        voted = self.voter.update(card_groups, [predictions[index].card_confidences if index in predictions else None
+                                                for index in range(len(card_groups))])
+        return [group.cards if group.cards is not None else predictions[index].cards
+                for index, group in enumerate(voted)]
+
+    def _predict_groups(self, img, card_groups):
+        """
+        Predicts the cards of card groups, running the model only for the ones that aren't cached
+        :return a list with a CardPrediction for each card group
+        """
+        if self.tiled:
+            predictions = self.recognition_cache.recognize(
+                CD.crop_card_groups(img, card_groups, padding=0),
+                lambda missing: self.prediction.predict_frame(img, [card_groups[index] for index in missing]))
+        else:
+            crops = CD.crop_card_groups(img, card_groups)
+            predictions = self.recognition_cache.recognize(
+                crops, lambda missing: self.prediction.predict_batch([crops[index] for index in missing]))
+        return predictions
+
+    def warm_up(self):
+        """
+        Loads the card model and runs it once, so the first hand isn't slowed down by it
+        """
+        self.prediction.warm_up()
+
+    def start_evaluators(self):
+        """
+        Starts the algorithm's evaluator processes, before any other threads are started
+        """
+        self.algorithm.start_evaluators()
+
+    def shutdown(self):
+        """
+        Stops the algorithm's evaluator processes
+        """
+        self.algorithm.shutdown()
 
     def blackjack_game(self):
         Game = True
@@ -89,9 +171,8 @@ class Integration:
                 # Load the image
                 image = cv2.imread('test_images/card_detect.jpg')
 
-                # Call the Integration method
-                integration = Integration()
-                prediction = integration.compute(image)
+                # Call the Integration method, keeping the model and the shoe between hands
+                prediction = self.compute(image)
                 print(prediction)
 
                 Input = input("Y to continue, Done for standing")
@@ -107,26 +188,20 @@ class Integration:
             # Game is concluded - get final image from table
             image_table = cv2.imread('test_images/final_table.jpg')
 
-            card_groups = self.card_detection.DectectCards(image_table)
+            card_groups = self.card_detection.DectectCards(image_table, self.DETECTION_SCALE, refine=True)
             print(card_groups)
 
             # Get the card prediction
-            pred_cards = []
-            for card_group in card_groups:
-                x1, y1, x2, y2 = card_group
-                b_box = 200
-                x1 = max(0, x1 - b_box)
-                y1 = max(0, y1 - b_box)
-                y2 = min(y2 + b_box, image_table.shape[0])
-                x2 = min(x2 + b_box, image_table.shape[1])
-                card = image_table[y1:y2, x1:x2]
-                pred_cards.append(self.prediction.predict(card)[1])
+            pred_cards = self.classify_groups(image_table, card_groups)
 
+            shown_cards = []
             for card_group in pred_cards:  # Iterate through all card groups in image
                 for card in card_group:  # iterate through all the cards
                     card = card.replace("c", "").replace("s", "").replace("h", "").replace("d", "")
                     card_rank_enum = A.CardRank(card)
-                    self.algorithm.remove_card_from_shoe(card_rank_enum)
+                    shown_cards.append(card_rank_enum)
+            # remove the whole hand from the shoe as one update
+            self.algorithm.observe_cards(shown_cards)
             Input = input("Game over? Y/n")
             if (Input == Y):
                 Game = False
@@ -134,11 +209,16 @@ class Integration:
 
 
 if __name__ == "__main__":
+    # write the annotated image to out/predictions.jpg
+    artifacts.enable("predictions")
     integration = Integration()
+    integration.warm_up()
     # Load the image
     image = cv2.imread('test_images/Card_Detection/Input/IMG_8935.jpg', cv2.IMREAD_COLOR)
 
     # Call the Integration method
     integration.compute(image)
+    print(f"Recognition cache hit rate {integration.recognition_cache.hit_rate:.0%}")
     # Integration.blackjack_game(Integration)
+    integration.shutdown()
 
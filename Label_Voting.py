@@ -0,0 +1,164 @@
+'''
+Description: Label_Voting follows each card group's predictions over the last frames and only
+settles on its cards once confidence-weighted votes agree, so one noisy frame can't flip a label
+'''
+from collections import deque
+from typing import NamedTuple
+
+
+class VotedGroup(NamedTuple):
+    """
+    The voted cards of a card group
+    :arg rect [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y] of the group in the latest frame
+    :arg cards the settled frozenset of card names, None until the votes have settled once
+    :arg scores the vote of each card name seen in the window, its confidence averaged over the frames
+    :arg stable whether the latest votes agree with the settled cards and the group is still where
+    it was last classified, so it needn't be classified again
+    """
+    rect: list
+    cards: frozenset
+    scores: dict
+    stable: bool
+
+
+class GroupVotes:
+    """
+    The votes of one card group
+    :arg rect where the group was last seen
+    :arg window the number of frames voting
+    """
+
+    def __init__(self, rect, window):
+        self.rect = rect
+        # where the group was when it was last classified
+        self.voted_rect = rect
+        self.frames = deque(maxlen=window)
+        self.scores = {}
+        self.cards = None
+        self.candidate = None
+        self.agreeing = 0
+        self.missing = 0
+
+    def stable(self, rect, stable_iou):
+        """
+        Whether the votes agree with the settled cards and rect, where the group is now, overlaps
+        where it was last classified by at least stable_iou. A group that grew, e.g. because a card
+        was dealt into it, has to be classified again
+        """
+        return (self.cards is not None and self.candidate == self.cards
+                and iou(rect, self.voted_rect) >= stable_iou)
+
+    def vote(self, confidences, vote_threshold, settle, stable_iou):
+        """
+        Adds the predictions of a frame to the votes. When the group has changed shape since its
+        last vote the older votes are dropped, so its new cards settle as quickly as a new group's,
+        while the settled cards are kept until they do
+        :arg confidences dict of the highest confidence of each card name found in the frame
+        """
+        if iou(self.rect, self.voted_rect) < stable_iou:
+            self.frames.clear()
+            self.candidate, self.agreeing = None, 0
+        self.voted_rect = self.rect
+        self.frames.append(confidences)
+        names = set().union(*self.frames)
+        self.scores = {name: sum(frame.get(name, 0.0) for frame in self.frames) / len(self.frames)
+                       for name in names}
+        voted = frozenset(name for name, score in self.scores.items() if score >= vote_threshold)
+        if voted == self.candidate:
+            self.agreeing += 1
+        else:
+            self.candidate, self.agreeing = voted, 1
+        if self.agreeing >= settle:
+            self.cards = self.candidate
+
+    def result(self, stable_iou):
+        return VotedGroup(self.rect, self.cards, dict(self.scores), self.stable(self.rect, stable_iou))
+
+
+class LabelVoter:
+    """
+    Votes on the cards of every card group across frames. Each frame, every card found in a group
+    votes with its confidence; a card belongs to the group while its votes, averaged over the last
+    window frames, reach vote_threshold. The group's cards settle once the same set has been voted
+    settle frames in a row, and only change when a different set has been voted as long. A settled
+    group is stable, and can skip classification, only while it stays where it was last classified
+    :arg window the number of frames voting
+    :arg settle the frames in a row a set of cards needs to be voted to settle
+    :arg vote_threshold the average confidence a card needs to belong to the group
+    :arg match_iou the overlap, as intersection over union, a group needs with one of the last
+    frame to be the same group
+    :arg max_missing the frames a group may go unseen before it is forgotten
+    :arg stable_iou the overlap a settled group needs with where it was last classified to be stable
+    """
+
+    def __init__(self, window=7, settle=3, vote_threshold=0.5, match_iou=0.5, max_missing=5, stable_iou=0.95):
+        self.window = window
+        self.settle = settle
+        self.vote_threshold = vote_threshold
+        self.match_iou = match_iou
+        self.max_missing = max_missing
+        self.stable_iou = stable_iou
+        self.groups: list[GroupVotes] = []
+
+    def update(self, rects, predictions):
+        """
+        Adds a frame's predictions to the votes of its card groups
+        :arg rects list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y] of the groups in the frame
+        :arg predictions for each group, a dict of the highest confidence of each card name found,
+        see Prediction.CardPrediction.card_confidences, or None if it wasn't classified this frame
+        :return a list with a VotedGroup for each group, in order
+        """
+        matched = self._match(rects)
+        for group in self.groups:
+            group.missing += 1
+        voted = []
+        for rect, confidences, group in zip(rects, predictions, matched):
+            if group is None:
+                group = GroupVotes(rect, self.window)
+                self.groups.append(group)
+            group.rect, group.missing = rect, 0
+            if confidences is not None:
+                group.vote(confidences, self.vote_threshold, self.settle, self.stable_iou)
+            voted.append(group.result(self.stable_iou))
+        self.groups = [group for group in self.groups if group.missing <= self.max_missing]
+        return voted
+
+    def stable(self, rects):
+        """
+        Finds the card groups of a frame that have settled and whose latest votes agree, so
+        classifying them again can be skipped
+        :arg rects list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y] of the groups in the frame
+        :return a list with whether each group is stable, matched to known groups as update does
+        """
+        return [group is not None and group.stable(rect, self.stable_iou)
+                for rect, group in zip(rects, self._match(rects))]
+
+    def _match(self, rects):
+        """
+        Pairs each rectangle with the known group it overlaps most, each group at most once
+        """
+        pairs = sorted(((iou(rect, group.rect), index, group_index)
+                        for index, rect in enumerate(rects) for group_index, group in enumerate(self.groups)),
+                       reverse=True)
+        matched, taken = [None] * len(rects), set()
+        for overlap, index, group_index in pairs:
+            if overlap < self.match_iou:
+                break
+            if matched[index] is None and group_index not in taken:
+                matched[index] = self.groups[group_index]
+                taken.add(group_index)
+        return matched
+
+
+def iou(first, second):
+    """
+    Returns the intersection over union of two [x1, y1, x2, y2] rectangles
+    """
+    width = min(first[2], second[2]) - max(first[0], second[0])
+    height = min(first[3], second[3]) - max(first[1], second[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = ((first[2] - first[0]) * (first[3] - first[1]) + (second[2] - second[0]) * (second[3] - second[1])
+             - intersection)
+    return intersection / union
@@ -0,0 +1,227 @@
+'''
+Description: Monte_Carlo estimates the expected value of player actions by simulating large batches
+of rounds dealt from the shoe, for hands where the exact recursion in Algorithm is too slow
+'''
+import time
+
+import numpy as np
+
+from Algorithm import Action, ACE_CLASS, EstimatedValue, VALUE_CLASS_WORTH
+
+VALUE_CLASS_WORTH_ARRAY = np.array(VALUE_CLASS_WORTH)
+
+
+def add_card(total: np.ndarray, soft: np.ndarray, drawn: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Adds drawn cards to hand totals, with the same soft ace handling as the exact recursion.
+
+    total -- the point total of each hand
+    soft -- whether an ace in each hand's total can still become a 1
+    drawn -- the value class of the card drawn into each hand
+    """
+    is_ace = drawn == ACE_CLASS
+    total = total + VALUE_CLASS_WORTH_ARRAY[drawn]
+
+    # an ace that would bust the hand counts as 1, otherwise it keeps the hand soft
+    ace_over = is_ace & (total > 21)
+    total = total - 10 * ace_over
+    soft = soft | (is_ace & ~ace_over)
+
+    # an earlier soft ace becomes a 1 when the hand goes over 21
+    soft_over = soft & (total > 21)
+    total = total - 10 * soft_over
+    soft = soft & ~soft_over
+    return total, soft
+
+
+class MonteCarlo:
+    """Simulates rounds of blackjack from a shoe state in vectorized batches. Every round draws
+    without replacement from its own copy of the shoe.
+
+    After hitting once, the simulated player keeps playing basic strategy, so a sampled hit EV
+    slightly underestimates the exact EV, which plays every later card optimally. A sampled split
+    plays one hand of the pair by basic strategy too, doubling but never resplitting, and like the
+    exact recursion counts it twice; it underestimates the exact split EV a little more.
+
+    batch_size -- the most rounds simulated per batch
+    rng -- the random generator the rounds are drawn with
+    """
+
+    # z-score of a 95% confidence interval
+    CONFIDENCE_Z = 1.96
+
+    # rounds of the first batch under a deadline before any batch has been timed
+    PILOT_ROUNDS = 64
+    # rounds simulated when the deadline has already passed, just enough for an estimate
+    LATE_ROUNDS = 16
+    # share of the time left a batch is sized to fill, leaving room for batches that run slower
+    BATCH_TIME_SHARE = 0.8
+
+    def __init__(self, batch_size: int = 8192, seed: int | None = None):
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        # how fast the last timed batch simulated rounds, summed over its actions
+        self._rounds_per_second = None
+
+    def estimate(self, shoe_state: tuple[int, ...], dealer_total: int, player_total: int,
+                 player_soft_total: bool, dealer_soft_total: bool, dealer_can_blackjack: bool,
+                 actions: tuple[Action, ...] = (Action.HIT, Action.STAND, Action.DOUBLE),
+                 deadline: float | None = None, samples: int = 200_000) -> dict[Action, EstimatedValue]:
+        """Estimates the EV of each action by simulating batches of rounds until every action has
+        samples rounds or the deadline passes. At least one batch is always simulated. Under a
+        deadline every batch is sized to fit the time left from how fast the last timed batch went,
+        the very first one is only PILOT_ROUNDS, and once the deadline has passed only LATE_ROUNDS
+        are simulated.
+
+        shoe_state -- a snapshot of the value class counts in the shoe, see Algorithm.Shoe.state()
+        player_total -- the point total of the player's cards, or of one card of the pair to SPLIT
+        actions -- the player actions to estimate
+        deadline -- the time.monotonic() value to stop sampling at, None to only stop at samples
+        samples -- the maximum number of rounds to simulate per action
+        """
+        if samples < 1:
+            raise ValueError(f"samples must be at least 1, got {samples}")
+        shoe = np.array(shoe_state, dtype=np.int32)
+        totals = np.zeros(len(actions))
+        squares = np.zeros(len(actions))
+        count = 0
+
+        now = time.monotonic()
+        if deadline is None:
+            batch_size = self.batch_size
+        elif now >= deadline:
+            batch_size = self.LATE_ROUNDS
+        elif self._rounds_per_second is None:
+            batch_size = self.PILOT_ROUNDS
+        else:
+            batch_size = max(self.LATE_ROUNDS, self._rounds_that_fit(deadline - now, len(actions)))
+        batch_size = min(self.batch_size, batch_size)
+        while count < samples and batch_size > 0:
+            batch_size = min(batch_size, samples - count)
+            batch_start = time.monotonic()
+            payoffs = self.simulate(actions, shoe, batch_size, dealer_total, player_total,
+                                    player_soft_total, dealer_soft_total, dealer_can_blackjack)
+            totals += payoffs.sum(axis=1)
+            squares += np.square(payoffs).sum(axis=1)
+            count += batch_size
+            if deadline is not None:
+                now = time.monotonic()
+                self._rounds_per_second = batch_size * len(actions) / max(now - batch_start, 1e-6)
+                batch_size = min(self.batch_size, self._rounds_that_fit(deadline - now, len(actions)))
+
+        estimates = {}
+        for index, action in enumerate(actions):
+            mean = totals[index] / count
+            variance = max(squares[index] / count - mean * mean, 0.0)
+            half_width = self.CONFIDENCE_Z * (variance / count) ** 0.5
+            estimates[action] = EstimatedValue(float(mean), float(half_width), count)
+        return estimates
+
+    def _rounds_that_fit(self, seconds: float, actions: int) -> int:
+        """Returns how many rounds of each action the last timed rate fits in BATCH_TIME_SHARE of seconds.
+        """
+        return int(self._rounds_per_second * seconds * self.BATCH_TIME_SHARE / actions)
+
+    def simulate(self, actions: tuple[Action, ...], shoe: np.ndarray, rounds: int, dealer_total: int,
+                 player_total: int, player_soft_total: bool, dealer_soft_total: bool,
+                 dealer_can_blackjack: bool) -> np.ndarray:
+        """Plays rounds of each player action, all in the same vectorized pass, and returns the
+        payoff of each round as a (len(actions), rounds) array. See Algorithm.action() comment for
+        EV explanation. For SPLIT, player_total is the split card's and the payoff is twice that of
+        one hand of the pair.
+
+        actions -- the player actions to play
+        shoe -- the value class counts in the shoe
+        rounds -- the number of rounds to simulate per action
+        """
+        played = np.repeat(np.array([action.value for action in actions]), rounds)
+        size = len(played)
+        counts = np.tile(shoe, (size, 1))
+        player = np.full(size, player_total)
+        player_soft = np.full(size, player_soft_total)
+
+        drawing = played != Action.STAND.value
+        if drawing.any():
+            new_player, new_player_soft = add_card(player, player_soft, self._draw(counts, drawing))
+            player = np.where(drawing, new_player, player)
+            player_soft = np.where(drawing, new_player_soft, player_soft)
+
+        bet = np.where(played == Action.DOUBLE.value, 2.0, 1.0)
+        # a split hand doubles where basic strategy does, and otherwise plays on like a hit; split
+        # aces take their second card and stand
+        splitting = played == Action.SPLIT.value
+        playing_split = splitting & (player_total != 11)
+        if playing_split.any():
+            doubling = playing_split & self._basic_strategy_doubles(player, player_soft, dealer_total)
+            new_player, new_player_soft = add_card(player, player_soft, self._draw(counts, doubling))
+            player = np.where(doubling, new_player, player)
+            player_soft = np.where(doubling, new_player_soft, player_soft)
+            bet[doubling] = 2.0
+
+        # keep drawing while basic strategy says to hit, standing on 21 like the exact recursion
+        hitting = (((played == Action.HIT.value) | playing_split) & (bet == 1.0) & (player < 21)
+                   & self._basic_strategy_hits(player, player_soft, dealer_total))
+        while hitting.any():
+            drawn = self._draw(counts, hitting)
+            new_player, new_player_soft = add_card(player, player_soft, drawn)
+            player = np.where(hitting, new_player, player)
+            player_soft = np.where(hitting, new_player_soft, player_soft)
+            hitting &= (player < 21) & self._basic_strategy_hits(player, player_soft, dealer_total)
+
+        player_bust = player > 21
+
+        # the dealer's first card is the hole card, which is the only one that can make a blackjack
+        dealer = np.full(size, dealer_total)
+        dealer_soft = np.full(size, dealer_soft_total)
+        drawn = self._draw(counts, ~player_bust)
+        dealer, dealer_soft = add_card(dealer, dealer_soft, drawn)
+        dealer_blackjack = dealer_can_blackjack & (dealer == 21)
+
+        # dealer stands on all 17s
+        drawing = ~player_bust & (dealer < 17)
+        while drawing.any():
+            drawn = self._draw(counts, drawing)
+            new_dealer, new_dealer_soft = add_card(dealer, dealer_soft, drawn)
+            dealer = np.where(drawing, new_dealer, dealer)
+            dealer_soft = np.where(drawing, new_dealer_soft, dealer_soft)
+            drawing &= dealer < 17
+
+        payoffs = np.where(player_bust | dealer_blackjack, -1.0,
+                           np.where(dealer > 21, 1.0, np.sign(player - dealer).astype(float)))
+        # both hands of a split are played on the same shoe, so the pair is worth twice one hand
+        hands = np.where(splitting, 2.0, 1.0)
+        return (hands * bet * payoffs).reshape(len(actions), rounds)
+
+    def _draw(self, counts: np.ndarray, drawing: np.ndarray) -> np.ndarray:
+        """Draws one card per round from that round's shoe, removing it only for drawing rounds.
+        Returns the value class of each drawn card.
+
+        counts -- the value class counts of each round's shoe, updated in place
+        drawing -- which rounds actually take the card
+        """
+        boundaries = counts.cumsum(axis=1)
+        position = self.rng.random(len(counts)) * boundaries[:, -1]
+        drawn = (boundaries <= position[:, None]).sum(axis=1)
+        rows = np.flatnonzero(drawing)
+        counts[rows, drawn[rows]] -= 1
+        return drawn
+
+    @staticmethod
+    def _basic_strategy_hits(total: np.ndarray, soft: np.ndarray, dealer_total: int) -> np.ndarray:
+        """Returns whether basic strategy hits each hand against the dealer's upcard.
+        """
+        dealer_strong = dealer_total >= 7
+        soft_hits = (total <= 17) | ((total == 18) & (dealer_total >= 9))
+        hard_hits = (total <= 11) | ((total <= 16) & dealer_strong) | ((total == 12) & (dealer_total <= 3))
+        return np.where(soft, soft_hits, hard_hits)
+
+    @staticmethod
+    def _basic_strategy_doubles(total: np.ndarray, soft: np.ndarray, dealer_total: int) -> np.ndarray:
+        """Returns whether basic strategy doubles each two-card hand against the dealer's upcard.
+        """
+        dealer_weak = 3 <= dealer_total <= 6
+        soft_doubles = (((total == 13) | (total == 14)) & (dealer_total in (5, 6))
+                        | ((total == 15) | (total == 16)) & (4 <= dealer_total <= 6)
+                        | ((total == 17) | (total == 18)) & dealer_weak)
+        hard_doubles = ((total == 9) & dealer_weak | (total == 10) & (dealer_total <= 9)
+                        | (total == 11) & (dealer_total <= 10))
+        return np.where(soft, soft_doubles, hard_doubles)
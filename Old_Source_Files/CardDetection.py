@@ -15,6 +15,10 @@ import cv2
 class CardDection:
     @staticmethod
     def detectcard(img_array):
+        """
+        Finds card-sized bright blobs
+        :return the mask with rectangles drawn around the blobs, for the caller to save when debugging
+        """
         # Convert image to grayscale
         image = cv2.cvtColor(img_array, cv2.COLOR_BGR2GRAY)
         image = cv2.GaussianBlur(image, (15, 15), 1)
@@ -60,14 +64,23 @@ class CardDection:
             x, y, w, h = cv2.boundingRect(contour)
             if w >= min_width or h >= min_height:  # Check if the blob is big enough
                 cv2.rectangle(mask, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        
-        # # Export the image with rectangles
-        cv2.imwrite("out/rectangles.jpg", mask)
-        
 
+        return mask
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from Debug_Artifacts import artifacts
+
+    # Read file in as RGB
+    img_array = cv2.imread("test_images/card_detect2.jpg")
+    rectangles = CardDection.detectcard(img_array)
 
-# Read file in as RGB
-img_array = cv2.imread("test_images/card_detect2.jpg")
-CardDection.detectcard(img_array)
+    # Export the image with rectangles as out/rectangles.jpg
+    artifacts.enable("rectangles")
+    artifacts.submit("rectangles", rectangles)
+    artifacts.close()
 
 
@@ -0,0 +1,279 @@
+'''
+Description: Pipeline runs capture, card group segmentation, card classification and the action
+decision as concurrent stages joined by small queues that keep only the latest frames, so a slow
+stage drops stale frames instead of stalling the camera
+'''
+import threading
+import time
+import traceback
+from collections import deque
+from typing import NamedTuple
+
+import Algorithm as A
+import Frame_Tracking as FT
+import Integration as I
+
+
+class Frame(NamedTuple):
+    """
+    A camera frame on its way through the pipeline
+    :arg index the number of the frame in the feed
+    :arg image read as cv2 img
+    :arg captured the time.perf_counter() value the frame was captured at
+    :arg card_groups list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y], once segmented
+    :arg cards the set of card names of each card group, once classified
+    :arg actions the action of each player, once decided, None when no dealer was found
+    :arg players the rectangles of the players' card groups, once decided
+    """
+    index: int
+    image: object
+    captured: float
+    card_groups: list = None
+    cards: list = None
+    actions: list = None
+    players: list = None
+
+
+class LatestQueue:
+    """
+    A bounded queue between two stages. Putting into a full queue drops its oldest item, so the
+    consumer always gets the most recent frames and the producer never waits
+    :arg maxsize the most items waiting at once
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._items = deque()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """
+        Adds an item, dropping the oldest one if the queue is full
+        """
+        with self._condition:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Takes the oldest item, waiting for one if the queue is empty
+        :return the item, or None once the queue is closed and empty, or when timeout runs out
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._items or self._closed, timeout)
+            return self._items.popleft() if self._items else None
+
+    def close(self):
+        """
+        Tells the consumer no more items are coming, once it has taken the waiting ones
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class StageMetrics:
+    """
+    What a stage has done so far
+    :arg name the stage's name
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.busy_time = 0.0
+        self.started = None
+        self.stopped = None
+
+    def as_dict(self, queue):
+        """
+        :arg queue the stage's input queue, None for the first stage
+        :return the frames processed, frames per second, mean seconds per frame, and the depth of
+        and frames dropped from the stage's input queue
+        """
+        elapsed = ((self.stopped or time.perf_counter()) - self.started) if self.started is not None else 0.0
+        return {
+            "processed": self.processed,
+            "throughput": self.processed / elapsed if elapsed > 0 else 0.0,
+            "mean_seconds": self.busy_time / self.processed if self.processed else 0.0,
+            "queue_depth": len(queue) if queue is not None else 0,
+            "dropped": queue.dropped if queue is not None else 0,
+        }
+
+
+class Pipeline:
+    """
+    Runs the stages of Integration on a live feed, each stage on its own thread: capture reads the
+    feed, segment follows the card groups with a FrameTracker, classify finds their cards and decide
+    picks each player's action in the AUTO mode, with the expected values computed on Algorithm's
+    evaluator processes. Stages are joined by LatestQueues, so while a stage is busy only the newest
+    frames wait for it
+    :arg frames iterable of images, e.g. Camera.get_frame()
+    :arg integration the Integration whose detection, model and algorithm the stages use
+    :arg queue_size the most frames waiting for each stage
+    :arg on_result function called with every decided Frame, on the decide stage's thread
+    :arg decision_budget seconds the decide stage may spend on the players of a frame
+    """
+
+    STAGES = ("capture", "segment", "classify", "decide")
+
+    def __init__(self, frames, integration=None, queue_size=1, on_result=None, decision_budget=0.1):
+        self.frames = frames
+        self.integration = integration if integration is not None else I.Integration(voting=True)
+        self.on_result = on_result
+        self.decision_budget = decision_budget
+        # only the regions of the table that changed since the last segmented frame are detected again
+        self.tracker = FT.FrameTracker(lambda image: self.integration.card_detection.DectectCards(
+            image, self.integration.DETECTION_SCALE, refine=True))
+        # the queue into each stage after capture, and the decided frames
+        self.queues = {name: LatestQueue(queue_size) for name in self.STAGES[1:]}
+        self.results = LatestQueue(queue_size)
+        self.metrics = {name: StageMetrics(name) for name in self.STAGES}
+        # the first stage to fail, and its exception
+        self.failed_stage = None
+        self.error = None
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        Starts every stage. The evaluator processes are started first, so they are forked before
+        any stage thread is running
+        """
+        self.integration.start_evaluators()
+        work = {"segment": self._segment, "classify": self._classify, "decide": self._decide}
+        outputs = dict(zip(self.STAGES, self.STAGES[1:]))
+        self._threads = [threading.Thread(target=self._capture, name="pipeline-capture", daemon=True)]
+        for name in self.STAGES[1:]:
+            output = self.queues[outputs[name]] if name in outputs else self.results
+            self._threads.append(threading.Thread(target=self._run_stage, args=(name, work[name], output),
+                                                  name=f"pipeline-{name}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops capturing and waits for the frames already captured to finish
+        """
+        self._stopping.set()
+        self.join()
+
+    def join(self, timeout=None):
+        """
+        Waits until the feed has ended and every stage has finished
+        """
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def decisions(self):
+        """
+        Yields the decided frames as they come, skipping stale ones when the caller falls behind,
+        until the pipeline stops
+        :raise RuntimeError once the decided frames run out, if a stage failed
+        """
+        while True:
+            frame = self.results.get()
+            if frame is None:
+                break
+            yield frame
+        if self.error is not None:
+            raise RuntimeError(f"The {self.failed_stage} stage failed") from self.error
+
+    def report(self):
+        """
+        :return the metrics of every stage, see StageMetrics.as_dict
+        """
+        return {name: self.metrics[name].as_dict(self.queues.get(name)) for name in self.STAGES}
+
+    def _capture(self):
+        metrics = self.metrics["capture"]
+        metrics.started = time.perf_counter()
+        try:
+            for index, image in enumerate(self.frames):
+                if self._stopping.is_set():
+                    break
+                self.queues["segment"].put(Frame(index, image, time.perf_counter()))
+                metrics.processed += 1
+        except Exception as error:
+            self._fail("capture", error)
+        finally:
+            metrics.stopped = time.perf_counter()
+            self.queues["segment"].close()
+
+    def _run_stage(self, name, work, output):
+        metrics = self.metrics[name]
+        metrics.started = time.perf_counter()
+        try:
+            while True:
+                frame = self.queues[name].get()
+                if frame is None:
+                    return
+                start = time.perf_counter()
+                frame = work(frame)
+                metrics.busy_time += time.perf_counter() - start
+                metrics.processed += 1
+                output.put(frame)
+        except Exception as error:
+            self._fail(name, error)
+        finally:
+            metrics.stopped = time.perf_counter()
+            output.close()
+
+    def _fail(self, name, error):
+        """
+        Records the first stage to fail and stops capturing, so the stages before it wind down too
+        """
+        traceback.print_exc()
+        if self.error is None:
+            self.failed_stage, self.error = name, error
+        self._stopping.set()
+
+    def _segment(self, frame):
+        return frame._replace(card_groups=[group.rect for group in self.tracker.update(frame.image)])
+
+    def _classify(self, frame):
+        return frame._replace(cards=self.integration.classify_groups(frame.image, frame.card_groups))
+
+    def _decide(self, frame):
+        decision = self.integration.decide(frame.card_groups, frame.cards, A.EvaluationMode.AUTO,
+                                           self.decision_budget)
+        if decision is not None:
+            frame = frame._replace(actions=decision[0], players=decision[1])
+        if self.on_result is not None:
+            self.on_result(frame)
+        return frame
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append("Old_Source_Files")
+    import cv2
+    from Camera import Camera
+
+    camera = Camera()
+    integration = I.Integration(voting=True)
+    integration.warm_up()
+    pipeline = Pipeline(camera.get_frame(), integration).start()
+    try:
+        for decided in pipeline.decisions():
+            if decided.actions is not None:
+                integration.draw_actions(decided.image, decided.players, decided.actions)
+            cv2.imshow("frame", decided.image)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    finally:
+        pipeline.stop()
+        for stage, metrics in pipeline.report().items():
+            print(f"{stage}: {metrics['throughput']:.1f} fps, {metrics['mean_seconds'] * 1000:.0f} ms per frame, "
+                  f"{metrics['queue_depth']} waiting, {metrics['dropped']} dropped")
+        integration.shutdown()
+        camera.release()
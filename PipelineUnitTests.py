@@ -0,0 +1,126 @@
+import contextlib
+import io
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from Algorithm import EvaluationMode
+from Pipeline import LatestQueue, Pipeline
+
+
+class FakeIntegration:
+    """Stands in for Integration with a slow classifier"""
+    DETECTION_SCALE = 0.25
+
+    def __init__(self, classify_seconds, fail_at=None):
+        self.classify_seconds = classify_seconds
+        self.fail_at = fail_at
+        self.decided = 0
+        self.detections = 0
+        self.decisions = []
+        self.card_detection = self
+        self.threads = {}
+        self.threads_at_start = None
+
+    def start_evaluators(self):
+        self.threads_at_start = [thread.name for thread in threading.enumerate()]
+
+    def DectectCards(self, image, scale, refine):
+        self.threads["segment"] = threading.current_thread().name
+        self.detections += 1
+        return [[0, 0, 10, 10], [20, 0, 30, 10]]
+
+    def classify_groups(self, image, card_groups):
+        self.threads["classify"] = threading.current_thread().name
+        time.sleep(self.classify_seconds)
+        return [{"6h"}, {"10s", "5c"}]
+
+    def decide(self, card_groups, cards, mode, time_budget):
+        self.threads["decide"] = threading.current_thread().name
+        self.decided += 1
+        self.decisions.append((mode, time_budget))
+        if self.decided == self.fail_at:
+            raise ValueError("no such card")
+        return [1], card_groups[1:]
+
+
+class TestPipeline(unittest.TestCase):
+    def test_latest_queue_drops_the_oldest_item(self):
+        queue = LatestQueue(2)
+        for item in range(5):
+            queue.put(item)
+        self.assertEqual((len(queue), queue.dropped), (2, 3))
+        queue.close()
+        self.assertEqual([queue.get(), queue.get(), queue.get()], [3, 4, None])
+        self.assertIsNone(LatestQueue().get(timeout=0.01))
+
+    def test_slow_stage_drops_stale_frames_without_stalling_capture(self):
+        def feed():
+            for _ in range(40):
+                time.sleep(0.002)
+                yield np.zeros((10, 10, 3), dtype=np.uint8)
+
+        integration = FakeIntegration(classify_seconds=0.02)
+        decided = []
+        pipeline = Pipeline(feed(), integration, on_result=decided.append).start()
+        pipeline.join(timeout=10)
+        report = pipeline.report()
+
+        self.assertEqual(report["capture"]["processed"], 40)
+        self.assertEqual(report["segment"]["processed"] + report["segment"]["dropped"], 40)
+        # classify keeps up with only some frames, the rest are dropped from its queue
+        self.assertGreater(report["classify"]["dropped"], 0)
+        self.assertEqual(report["classify"]["processed"] + report["classify"]["dropped"],
+                         report["segment"]["processed"])
+        self.assertEqual(report["decide"]["processed"] + report["decide"]["dropped"],
+                         report["classify"]["processed"])
+        self.assertEqual(decided[-1].index, 39)
+        self.assertEqual([frame.index for frame in decided], sorted(frame.index for frame in decided))
+        self.assertEqual((decided[-1].actions, decided[-1].players), ([1], [[20, 0, 30, 10]]))
+        self.assertGreater(report["classify"]["mean_seconds"], 0.015)
+        self.assertEqual(len(set(integration.threads.values())), 3)
+        self.assertEqual(list(pipeline.decisions()), [decided[-1]])
+        # the evaluator processes were started before any stage thread
+        self.assertFalse([name for name in integration.threads_at_start if name.startswith("pipeline")])
+        # the table never changed, so the cards were only detected on the first frame
+        self.assertEqual((integration.detections, pipeline.tracker.full_detections), (1, 1))
+        self.assertEqual(set(integration.decisions), {(EvaluationMode.AUTO, pipeline.decision_budget)})
+
+    def test_failing_stage_stops_the_pipeline(self):
+        def endless_feed():
+            while True:
+                time.sleep(0.001)
+                yield np.zeros((10, 10, 3), dtype=np.uint8)
+
+        pipeline = Pipeline(endless_feed(), FakeIntegration(classify_seconds=0, fail_at=3)).start()
+        with contextlib.redirect_stderr(io.StringIO()) as errors:
+            with self.assertRaisesRegex(RuntimeError, "decide stage failed"):
+                for _ in pipeline.decisions():
+                    pass
+            pipeline.join(timeout=10)
+        self.assertIn("no such card", errors.getvalue())
+        self.assertIsInstance(pipeline.error, ValueError)
+        self.assertFalse(any(thread.is_alive() for thread in pipeline._threads))
+        self.assertEqual(pipeline.report()["decide"]["processed"], 2)
+
+    def test_failing_feed_is_reported(self):
+        def broken_feed():
+            for _ in range(3):
+                yield np.zeros((10, 10, 3), dtype=np.uint8)
+            raise OSError("camera unplugged")
+
+        with contextlib.redirect_stderr(io.StringIO()) as errors:
+            pipeline = Pipeline(broken_feed(), FakeIntegration(classify_seconds=0)).start()
+            with self.assertRaisesRegex(RuntimeError, "capture stage failed"):
+                for _ in pipeline.decisions():
+                    pass
+            pipeline.join(timeout=10)
+        self.assertIn("camera unplugged", errors.getvalue())
+        self.assertIsInstance(pipeline.error, OSError)
+        self.assertEqual(pipeline.report()["capture"]["processed"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,66 +1,296 @@
+import threading
+from typing import NamedTuple
+
 import cv2
-import torch
-from ultralytics import YOLO
+import numpy as np
+
+from Inference_Backends import backend_for, load_backend, non_max_suppression
+
+
+def letterbox_transform(shape, size):
+    """
+    Finds where an image of a given shape is placed when it is letterboxed into a size x size square
+    :arg shape the image's (height, width, ...)
+    :return the scale the image is resized by, its resized (width, height), and the (x, y) offset
+    of its top left corner
+    """
+    height, width = shape[:2]
+    scale = min(size / height, size / width)
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    return scale, (new_width, new_height), ((size - new_width) // 2, (size - new_height) // 2)
+
+
+def letterbox(image, size, out):
+    """
+    Resizes an image to fit in a size x size square keeping its aspect ratio, centred in out
+    :arg image read as cv2 img
+    :arg size the side of the square
+    :arg out size x size x 3 array, already filled with the padding colour
+    :return the scale the image was resized by, and the (x, y) offset of its top left corner
+    """
+    scale, (new_width, new_height), (left, top) = letterbox_transform(image.shape, size)
+    out[top:top + new_height, left:left + new_width] = cv2.resize(image, (new_width, new_height),
+                                                                  interpolation=cv2.INTER_LINEAR)
+    return scale, (left, top)
+
+
+def tile_starts(length, size, overlap):
+    """
+    Returns where tiles of a given size start along one side of an image so they cover it and
+    neighbouring tiles share at least overlap pixels, the last tile ending on the edge
+    """
+    if length <= size:
+        return [0]
+    return list(range(0, length - size, size - overlap)) + [length - size]
+
+
+class CardPrediction(NamedTuple):
+    """
+    The cards the model found in one crop, kept as arrays. Nothing is drawn unless plot is called
+    :arg boxes (n, 4) float32 array of [x1, y1, x2, y2] in the crop's pixels
+    :arg confidences (n,) float32 array
+    :arg class_ids (n,) int64 array
+    :arg names dict of class id to card name, shared with the model
+    """
+    boxes: np.ndarray
+    confidences: np.ndarray
+    class_ids: np.ndarray
+    names: dict
+
+    @property
+    def labels(self):
+        """
+        The card name of every detection
+        """
+        return [self.names[class_id] for class_id in self.class_ids.tolist()]
+
+    @property
+    def cards(self):
+        """
+        The set of card names found
+        """
+        return set(self.labels)
+
+    @property
+    def card_confidences(self):
+        """
+        The highest confidence of each card name found
+        """
+        confidences = {}
+        for label, confidence in zip(self.labels, self.confidences.tolist()):
+            confidences[label] = max(confidence, confidences.get(label, 0.0))
+        return confidences
+
+    def plot(self, image):
+        """
+        Draws the detections on a copy of the crop they were found in
+        :arg image the crop, read as cv2 img
+        :return the annotated copy, for cv2.imwrite
+        """
+        annotated = image.copy()
+        thickness = max(1, round(sum(image.shape[:2]) / 600))
+        for (x1, y1, x2, y2), label, confidence in zip(self.boxes.round().astype(int).tolist(), self.labels,
+                                                       self.confidences.tolist()):
+            cv2.rectangle(annotated, (x1, y1), (x2, y2), (0, 0, 255), thickness)
+            cv2.putText(annotated, f"{label} {confidence:.2f}", (x1, max(y1 - 2 * thickness, 0)),
+                        cv2.FONT_HERSHEY_SIMPLEX, thickness / 3, (0, 0, 255), thickness, cv2.LINE_AA)
+        return annotated
+
+
+class ModelRegistry:
+    """
+    Loads each model once per process, the first time it is asked for, and shares it between every
+    Prediction that uses the same weights and backend
+    :arg loader function that loads a weights file with a backend, see Inference_Backends.load_backend
+    """
+
+    def __init__(self, loader=load_backend):
+        self.loader = loader
+        self.loads = 0
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, weights, backend=None):
+        """
+        Returns the model of a weights file, loading it if this is the first time it is asked for
+        :arg backend the backend that runs the model, None to pick from the extension of weights
+        """
+        key = (weights, backend or backend_for(weights))
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = self.loader(*key)
+                self.loads += 1
+            return model
+
+    def loaded(self, weights, backend=None):
+        """
+        Whether the model of a weights file has been loaded already
+        """
+        return (weights, backend or backend_for(weights)) in self._models
+
+    def clear(self):
+        """
+        Forgets every loaded model, so the next get loads it again
+        """
+        with self._lock:
+            self._models.clear()
+
+
+# the models every Prediction shares
+models = ModelRegistry()
 
 
 class Prediction:
-    def __init__(self):
-        print(torch.cuda.is_available())
-        if torch.cuda.is_available():
-            print(f"GPU: {torch.cuda.get_device_name(0)} is available.")
-        else:
-            print("No GPU available. Training will run on CPU.")
+    # side of the square images the model was trained on, see runs/detect/yolov8n_custom/args.yaml
+    IMAGE_SIZE = 416
+    # gray the letterbox borders are filled with, as ultralytics does
+    PAD_VALUE = 114
+    # frames are shrunk by about as much as a padded card group crop is when it is letterboxed, so
+    # cards are the size the model was trained on
+    TILE_SCALE = 0.3
+    # pixels neighbouring tiles share, more than a shrunk card so every card is whole in some tile
+    TILE_OVERLAP = 208
+    # detections this close to a tile edge shared with another tile are cut off by it
+    TILE_EDGE = 2
 
-        # Load the model
-        self.model = YOLO('best.pt')
+    def __init__(self, weights="best.pt", registry=models, backend=None):
+        """
+        :arg weights the model's weights file, only loaded on the first prediction or warm_up. Use
+        Inference_Backends to export best.pt to ONNX, optionally int8, for CPU inference
+        :arg registry where the model is loaded and shared from
+        :arg backend "torch", "onnxruntime" or "openvino", None to pick from the extension of weights
+        """
+        self.weights = weights
+        self.registry = registry
+        self.backend = backend
 
+    @property
+    def model(self):
+        return self.registry.get(self.weights, self.backend)
 
+    def warm_up(self):
+        """
+        Loads the model and runs it once on a blank crop, so the first real prediction isn't slowed
+        down by loading and the model's first call
+        """
+        blank = np.full((self.IMAGE_SIZE, self.IMAGE_SIZE, 3), self.PAD_VALUE, dtype=np.uint8)
+        self.predict_batch([blank])
 
     def predict(self, img):
         """
         This function will return the predictions for the image
-        :return: predictions
+        :return: CardPrediction, call its plot to draw it
         """
-        # Pass the image through the detection model and get the result
-        detect_result = self.model(img)
+        return self.predict_batch([img])[0]
 
-        matches = set()
+    def predict_batch(self, crops):
+        """
+        Predicts the cards of several card group crops with a single pass of the model. Every crop is
+        letterboxed into one preallocated batch instead of being prepared and run on its own
+        :arg crops list of images read as cv2 img
+        :return a list with a CardPrediction for each crop, in order
+        """
+        if not crops:
+            return []
+        model = self.model
+        predictions = []
+        for crop, (boxes, confidences, class_ids) in zip(crops, model(self.prepare_batch(crops))):
+            # from the letterboxed square back to the crop's pixels
+            scale, _, offset = letterbox_transform(crop.shape, self.IMAGE_SIZE)
+            boxes = (boxes - np.tile(np.asarray(offset, dtype=np.float32), 2)) / np.float32(scale)
+            predictions.append(CardPrediction(boxes, confidences, class_ids, model.names))
+        return predictions
 
-        for result in detect_result:
-            boxes = result.boxes  # Access the bounding boxes
-            for box in boxes:
-                # Get the bounding box coordinates
-                x1, y1, x2, y2 = box.xyxy[0]
+    def predict_frame(self, image, card_groups, scale=TILE_SCALE, overlap=TILE_OVERLAP):
+        """
+        Predicts the cards of every card group with one pass of the model over the frame, instead of
+        a padded crop per group. The shrunk frame is split into overlapping IMAGE_SIZE tiles, the
+        tiles touching a card group are run as one batch, and their detections are merged across
+        tiles and given to the card group that contains them
+        :arg image read as cv2 img
+        :arg card_groups list of [TopLeft_x, TopLeft_y, BottomRight_x, Bottom_left_y], see Card_Detection
+        :arg scale factor the frame is shrunk by before tiling
+        :arg overlap pixels of the shrunk frame neighbouring tiles share
+        :return a list with a CardPrediction for each card group, in order, its boxes in the frame's pixels
+        """
+        if not card_groups:
+            return []
+        size = self.IMAGE_SIZE
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        small = cv2.copyMakeBorder(small, 0, max(size - small.shape[0], 0), 0, max(size - small.shape[1], 0),
+                                   cv2.BORDER_CONSTANT, value=(self.PAD_VALUE,) * 3)
+        height, width = small.shape[:2]
+        groups = np.asarray(card_groups, dtype=np.float32).reshape(-1, 4)
+        shrunk_groups = groups * scale
 
-                # Get the class ID and confidence score
-                class_id = box.cls[0].item()
-                confidence = box.conf[0].item()
+        tiles, origins = [], []
+        for y in tile_starts(height, size, overlap):
+            for x in tile_starts(width, size, overlap):
+                # tiles without a card group are not run
+                if np.any((shrunk_groups[:, 0] < x + size) & (shrunk_groups[:, 2] > x)
+                          & (shrunk_groups[:, 1] < y + size) & (shrunk_groups[:, 3] > y)):
+                    tiles.append(small[y:y + size, x:x + size])
+                    origins.append((x, y))
 
-                # Get the class name
-                class_name = self.model.names[class_id]
-                matches.add(class_name)
+        model = self.model
+        if not tiles:
+            # groups outside the frame, or without any area, have no tile to find cards in
+            return [CardPrediction(np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32),
+                                   np.zeros(0, dtype=np.int64), model.names) for _ in card_groups]
+        boxes, confidences, class_ids = [], [], []
+        for (x, y), (tile_boxes, tile_confidences, tile_class_ids) in zip(origins, model(self.prepare_batch(tiles))):
+            # a card cut by an edge shared with another tile is whole in that tile
+            edge = self.TILE_EDGE
+            cut = (((x > 0) & (tile_boxes[:, 0] <= edge)) | ((y > 0) & (tile_boxes[:, 1] <= edge))
+                   | ((x + size < width) & (tile_boxes[:, 2] >= size - edge))
+                   | ((y + size < height) & (tile_boxes[:, 3] >= size - edge)))
+            boxes.append(tile_boxes[~cut] + np.array([x, y, x, y], dtype=np.float32))
+            confidences.append(tile_confidences[~cut])
+            class_ids.append(tile_class_ids[~cut])
+        boxes = np.concatenate(boxes).reshape(-1, 4)
+        confidences = np.concatenate(confidences).astype(np.float32)
+        class_ids = np.concatenate(class_ids).astype(np.int64)
 
-                # print("Class:", class_name)
-                # print("Confidence:", confidence)
-                # print("Bounding box:", x1, y1, x2, y2)
+        # the same card seen by several tiles
+        kept = non_max_suppression(boxes, confidences, class_ids)
+        boxes, confidences, class_ids = boxes[kept] / np.float32(scale), confidences[kept], class_ids[kept]
 
-        # Plot the detections
-        detect_image = detect_result[0].plot()
+        # each card goes to the smallest card group containing its centre
+        centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+        inside = ((centres[:, None, 0] >= groups[:, 0]) & (centres[:, None, 0] < groups[:, 2])
+                  & (centres[:, None, 1] >= groups[:, 1]) & (centres[:, None, 1] < groups[:, 3]))
+        areas = (groups[:, 2] - groups[:, 0]) * (groups[:, 3] - groups[:, 1])
+        owners = np.where(inside, areas, np.inf).argmin(axis=1)
+        owners[~inside.any(axis=1)] = -1
+        return [CardPrediction(boxes[owners == group], confidences[owners == group],
+                               class_ids[owners == group], model.names) for group in range(len(groups))]
 
-        # Convert the image to RGB format
-        detect_image = cv2.cvtColor(detect_image, cv2.COLOR_BGR2RGB)
+    @staticmethod
+    def prepare_batch(crops):
+        """
+        Letterboxes crops into one preallocated batch for the model
+        :arg crops list of images read as cv2 img
+        :return (n, 3, IMAGE_SIZE, IMAGE_SIZE) float32 RGB array scaled to [0, 1]
+        """
+        size = Prediction.IMAGE_SIZE
+        batch = np.full((len(crops), size, size, 3), Prediction.PAD_VALUE, dtype=np.uint8)
+        for crop, out in zip(crops, batch):
+            letterbox(crop, size, out)
 
-        # Return the detected card names
-        return detect_image, matches
+        # BGR HWC bytes to the RGB CHW floats the models take
+        floats = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32)
+        floats /= 255
+        return floats
 
 
 if __name__ == "__main__":
     prediction = Prediction()
     img = cv2.imread("out/card_0.jpg", cv2.IMREAD_COLOR)
-    pred, match = prediction.predict(img)
-    cv2.imwrite("out/predictions1.jpg", pred)
-    print(match)
+    pred = prediction.predict(img)
+    cv2.imwrite("out/predictions1.jpg", pred.plot(img))
+    print(pred.cards)
     img = cv2.imread("out/card_1.jpg", cv2.IMREAD_COLOR)
-    pred, match = prediction.predict(img)
-    cv2.imwrite("out/predictions2.jpg", pred)
-    print(match)
\ No newline at end of file
+    pred = prediction.predict(img)
+    cv2.imwrite("out/predictions2.jpg", pred.plot(img))
+    print(pred.cards)
\ No newline at end of file
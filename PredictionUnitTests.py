@@ -0,0 +1,260 @@
+import subprocess
+import sys
+import unittest
+
+import cv2
+import numpy as np
+
+from Inference_Backends import backend_for, decode_yolo_output, read_openvino_names
+from Label_Voting import LabelVoter
+from Prediction import ModelRegistry, Prediction
+from Recognition_Cache import RecognitionCache
+
+
+class TestPrediction(unittest.TestCase):
+    def test_models_are_loaded_once_on_first_use(self):
+        loaded = []
+        registry = ModelRegistry(lambda weights, backend: loaded.append(weights) or object())
+        first, second = Prediction("best.pt", registry), Prediction("best.pt", registry)
+        self.assertEqual(loaded, [])
+        self.assertFalse(registry.loaded("best.pt"))
+        self.assertIs(first.model, second.model)
+        self.assertIs(Prediction("other.pt", registry).model, registry.get("other.pt"))
+        self.assertEqual((loaded, registry.loads), (["best.pt", "other.pt"], 2))
+        registry.clear()
+        first.model
+        self.assertEqual(registry.loads, 3)
+
+    def test_backends_are_picked_from_the_weights(self):
+        loaded = []
+        registry = ModelRegistry(lambda weights, backend: loaded.append((weights, backend)) or object())
+        Prediction("best_int8.onnx", registry).model
+        Prediction("best_int8.onnx", registry, "openvino").model
+        Prediction("best.pt", registry).model
+        self.assertEqual(loaded, [("best_int8.onnx", "onnxruntime"), ("best_int8.onnx", "openvino"),
+                                  ("best.pt", "torch")])
+        with self.assertRaises(ValueError):
+            backend_for("best.h5")
+
+    def test_openvino_names_come_from_the_runtime_info(self):
+        class Labels(str):
+            def astype(self, kind):
+                return kind(self)
+
+        class ExportedModel:
+            """Stands in for an openvino.Model that ultralytics exported"""
+            def __init__(self, rt_info):
+                self.rt_info = rt_info
+
+            def has_rt_info(self, path):
+                return tuple(path) in self.rt_info
+
+            def get_rt_info(self, path):
+                return self.rt_info[tuple(path)]
+
+        model = ExportedModel({("model_info", "labels"): Labels("10h As Kd")})
+        self.assertEqual(read_openvino_names(model), {0: "10h", 1: "As", 2: "Kd"})
+        self.assertIsNone(read_openvino_names(ExportedModel({})))
+
+    def test_prepare_batch_letterboxes_into_rgb_floats(self):
+        crop = np.zeros((200, 100, 3), dtype=np.uint8)
+        crop[..., 0] = 255  # blue
+        batch = Prediction.prepare_batch([crop, np.zeros((50, 400, 3), dtype=np.uint8)])
+        self.assertEqual((batch.shape, batch.dtype), ((2, 3, 416, 416), np.float32))
+        # the tall crop is centred between gray borders, with its blue in the last channel
+        self.assertAlmostEqual(float(batch[0, 0, 0, 0]), 114 / 255)
+        self.assertEqual(batch[0, :, 208, 208].tolist(), [0.0, 0.0, 1.0])
+        self.assertEqual(float(batch[1, 2, 208, 0]), 0.0)
+
+    def test_decode_keeps_best_class_and_suppresses_overlaps(self):
+        # centre x, centre y, width, height, then the scores of three classes, for four anchors
+        output = np.array([[[100, 104, 300, 300],
+                            [100, 100, 300, 300],
+                            [50, 50, 40, 40],
+                            [50, 50, 40, 40],
+                            [0.9, 0.8, 0.1, 0.6],
+                            [0.1, 0.1, 0.2, 0.7],
+                            [0.0, 0.0, 0.1, 0.0]]], dtype=np.float32)
+        (boxes, confidences, class_ids), = decode_yolo_output(output)
+        # the second anchor overlaps the first with the same class, the third is below the threshold
+        self.assertEqual(class_ids.tolist(), [0, 1])
+        self.assertEqual(confidences.tolist(), [np.float32(0.9), np.float32(0.7)])
+        self.assertEqual(boxes[0].tolist(), [75.0, 75.0, 125.0, 125.0])
+
+    def test_predictions_map_boxes_back_to_each_crop(self):
+        class FakeModel:
+            names = {0: "10h", 1: "As"}
+
+            def __call__(self, batch):
+                # one card in the middle of the letterboxed square of every crop, and a second in the last
+                detections = [(np.array([[158, 158, 258, 258]], dtype=np.float32), np.array([0.9], dtype=np.float32),
+                               np.array([0]))] * len(batch)
+                detections[-1] = (np.array([[158, 158, 258, 258], [0, 0, 416, 416]], dtype=np.float32),
+                                  np.array([0.5, 0.8], dtype=np.float32), np.array([0, 1]))
+                return detections
+
+        prediction = Prediction("fake.pt", ModelRegistry(lambda weights, backend: FakeModel()))
+        crops = [np.zeros((832, 416, 3), dtype=np.uint8), np.zeros((208, 208, 3), dtype=np.uint8)]
+        tall, square = prediction.predict_batch(crops)
+        # the tall crop was halved and centred 104 pixels from the left of the square
+        self.assertEqual(tall.boxes.tolist(), [[108.0, 316.0, 308.0, 516.0]])
+        self.assertEqual((tall.cards, tall.card_confidences), ({"10h"}, {"10h": np.float32(0.9)}))
+        self.assertEqual(square.labels, ["10h", "As"])
+        self.assertEqual(square.boxes.tolist()[1], [0.0, 0.0, 208.0, 208.0])
+        self.assertEqual(prediction.predict_batch([]), [])
+
+        annotated = square.plot(crops[1])
+        self.assertEqual(annotated.shape, crops[1].shape)
+        self.assertTrue(annotated.any())
+        self.assertFalse(crops[1].any())
+
+    def test_frame_tiles_merge_and_assign_cards_to_groups(self):
+        class BrightBlobModel:
+            """Reports every white blob of each tile as a card, even when the tile cuts it"""
+            names = {0: "card"}
+            batches = []
+
+            def __call__(self, batch):
+                self.batches.append(len(batch))
+                detections = []
+                for tile in batch:
+                    _, _, stats, _ = cv2.connectedComponentsWithStats((tile.min(axis=0) > 0.9).astype(np.uint8))
+                    x, y, w, h = stats[1:, :4].T.astype(np.float32)
+                    detections.append((np.stack([x, y, x + w, y + h], axis=1), np.full(len(x), 0.9, np.float32),
+                                       np.zeros(len(x), dtype=np.int64)))
+                return detections
+
+        model = BrightBlobModel()
+        prediction = Prediction("fake.pt", ModelRegistry(lambda weights, backend: model))
+        frame = np.zeros((1600, 2000, 3), dtype=np.uint8)
+        frame[200:600, 1270:1570] = 255  # cut by the edge of the first tile
+        frame[1000:1400, 100:400] = 255
+        groups = [[1200, 100, 1700, 700], [0, 900, 500, 1500], [1800, 1500, 1900, 1590]]
+        first, second, empty = prediction.predict_frame(frame, groups, scale=0.3)
+        # four tiles cover the shrunk frame, and the first card is cut by the edge of two of them
+        self.assertEqual(model.batches, [4])
+        self.assertEqual(len(first.boxes), 1)
+        np.testing.assert_allclose(first.boxes[0], [1270, 200, 1570, 600], atol=4)
+        np.testing.assert_allclose(second.boxes, [[100, 1000, 400, 1400]], atol=4)
+        self.assertEqual((second.cards, len(empty.boxes)), ({"card"}, 0))
+        self.assertEqual(prediction.predict_frame(frame, []), [])
+        # a group beyond the frame touches no tile, so the model isn't run at all
+        outside, = prediction.predict_frame(frame, [[2100, 1700, 2300, 1900]], scale=0.3)
+        self.assertEqual(model.batches, [4])
+        self.assertEqual((outside.boxes.shape, outside.cards), ((0, 4), set()))
+
+    def test_recognition_cache_skips_unchanged_groups(self):
+        rng = np.random.default_rng(0)
+        groups = []
+        for rank in ("K", "5", "9"):
+            group = np.full((600, 500, 3), 235, dtype=np.uint8)
+            cv2.putText(group, rank, (40, 200), cv2.FONT_HERSHEY_SIMPLEX, 5, (20, 20, 200), 20)
+            cv2.putText(group, rank, (120, 480), cv2.FONT_HERSHEY_SIMPLEX, 5, (20, 20, 20), 20)
+            groups.append(group)
+        predicted = []
+
+        def predict(missing):
+            predicted.append(missing)
+            return [f"labels {index}" for index in missing]
+
+        cache = RecognitionCache(capacity=2)
+        self.assertEqual(cache.recognize(groups[:2], predict), ["labels 0", "labels 1"])
+        # the same groups a frame later, with sensor noise, come from the cache
+        noisy = [np.clip(group + rng.normal(0, 3, group.shape), 0, 255).astype(np.uint8) for group in groups[:2]]
+        self.assertEqual(cache.recognize(noisy[::-1], predict), ["labels 1", "labels 0"])
+        self.assertEqual((predicted, cache.hits, cache.misses), ([[0, 1]], 2, 2))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+        # a new group is predicted and evicts the least recently used one, the second group
+        self.assertEqual(cache.recognize([groups[2], groups[0]], predict), ["labels 0", "labels 0"])
+        self.assertEqual((predicted[-1], cache.evictions, len(cache)), ([0], 1, 2))
+        cache.recognize([groups[1]], predict)
+        self.assertEqual(predicted[-1], [0])
+        # a group of another size never matches
+        self.assertIsNone(cache.lookup(cache.key(cv2.resize(groups[0], (250, 300)))))
+        # nor does one with a different corner, even if a looser tolerance lets its hash match
+        changed = groups[1].copy()
+        changed[:80, :80] = 255 - changed[:80, :80]
+        self.assertIsNone(cache.lookup(cache.key(changed)))
+        cache.tolerance = 255
+        self.assertIsNone(cache.lookup(cache.key(changed)))
+
+    def test_label_votes_settle_and_ignore_a_noisy_frame(self):
+        voter = LabelVoter(window=5, settle=3)
+        dealer, player = [100, 100, 400, 500], [900, 100, 1300, 500]
+        frames = [{"Kh": 0.9}, {"Kh": 0.8}, {"Kh": 0.9}, {"Qh": 0.6}, {"Kh": 0.9}]
+        settled = []
+        for frame, confidences in enumerate(frames):
+            # the groups move by a few pixels between frames
+            shifted = [rect[0] + frame * 5 for rect in (dealer, player)]
+            voted = voter.update([[shifted[0]] + dealer[1:], [shifted[1]] + player[1:]],
+                                 [confidences, {"5s": 0.9, "6d": 0.7}])
+            settled.append((voted[0].cards, voted[0].stable))
+        # nothing settles before three frames agree, and the Queen of one frame doesn't flip the King
+        self.assertEqual(settled, [(None, False), (None, False), ({"Kh"}, True), ({"Kh"}, True), ({"Kh"}, True)])
+        self.assertAlmostEqual(voted[0].scores["Qh"], 0.12)
+        self.assertEqual(voted[1].cards, {"5s", "6d"})
+        self.assertEqual(len(voter.groups), 2)
+
+        # settled groups that stay put can skip classification, a new or moved group can't
+        dealer, player = [120, 100, 400, 500], [920, 100, 1300, 500]
+        self.assertEqual(voter.stable([dealer, [2000, 100, 2400, 500]]), [True, False])
+        self.assertEqual(voter.stable([[200, 100, 500, 500]]), [False])
+        voted = voter.update([dealer, [2000, 100, 2400, 500]], [None, {"As": 0.9}])
+        self.assertEqual((voted[0].cards, voted[1].cards), ({"Kh"}, None))
+
+        # a card dealt to the player grows its group, which has to be classified again until its new
+        # cards have been voted three frames in a row
+        grown = [920, 100, 1450, 500]
+        for _ in range(2):
+            self.assertEqual(voter.stable([grown]), [False])
+            voted, = voter.update([grown], [{"5s": 0.9, "6d": 0.7, "9c": 0.9}])
+            self.assertEqual(voted.cards, {"5s", "6d"})
+        voted, = voter.update([grown], [{"5s": 0.9, "6d": 0.7, "9c": 0.9}])
+        self.assertEqual((voted.cards, voted.stable), ({"5s", "6d", "9c"}, True))
+        self.assertEqual(voter.stable([grown]), [True])
+
+    def test_integration_stops_classifying_settled_groups(self):
+        from Integration import Integration
+
+        class HandModel:
+            """Finds the cards in hand in every crop"""
+            names = {0: "Kh", 1: "5s"}
+
+            def __init__(self):
+                self.hand = [0]
+                self.crops = 0
+
+            def __call__(self, batch):
+                self.crops += len(batch)
+                boxes = np.array([[20 * card, 0, 20 * card + 10, 10] for card in self.hand], dtype=np.float32)
+                return [(boxes, np.full(len(self.hand), 0.9, dtype=np.float32), np.array(self.hand))] * len(batch)
+
+        model = HandModel()
+        integration = Integration(voting=True)
+        integration.prediction = Prediction("fake.pt", ModelRegistry(lambda weights, backend: model))
+        integration.recognition_cache = RecognitionCache(capacity=0)  # every frame reaches the model
+        frame = np.random.default_rng(0).integers(0, 256, (800, 800, 3), dtype=np.uint8)
+        labels = [integration.classify_groups(frame, [[300, 300, 500, 500]]) for _ in range(5)]
+        self.assertEqual(labels, [[{"Kh"}]] * 5)
+        self.assertEqual(model.crops, 3)
+
+        # a card dealt into the group grows it, so it is classified again until the new cards settle
+        model.hand = [0, 1]
+        grown = [[300, 300, 650, 500]]
+        labels = [integration.classify_groups(frame, grown) for _ in range(5)]
+        self.assertEqual(labels, [[{"Kh"}]] * 2 + [[{"Kh", "5s"}]] * 3)
+        self.assertEqual(integration.voter.stable(grown), [True])
+        self.assertEqual(model.crops, 6)
+        integration.shutdown()
+
+    def test_imports_skip_torch(self):
+        imported = subprocess.run([sys.executable, "-c", "import sys, Pipeline, Simulation, Benchmark; "
+                                   "print(sorted({'torch', 'ultralytics', 'onnxruntime', 'openvino'} "
+                                   "& set(sys.modules)))"],
+                                  capture_output=True, text=True, check=True)
+        self.assertEqual(imported.stdout.strip(), "[]")
+
+
+if __name__ == '__main__':
+    unittest.main()
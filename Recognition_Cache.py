@@ -0,0 +1,164 @@
+'''
+Description: Recognition_Cache remembers what the model found in each card group, keyed by a
+perceptual hash of the group's pixels, so groups that haven't changed skip inference
+'''
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def thumbnail(image, size):
+    """
+    Shrinks an image to a size x size gray image
+    :arg image read as cv2 img
+    :return the thumbnail as a uint8 array
+    """
+    # skipping rows and columns first keeps four source pixels per thumbnail pixel, at a fraction of the cost
+    step = max(1, min(image.shape[:2]) // (size * 4))
+    small = cv2.resize(image[::step, ::step], (size, size), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+
+def perceptual_hash(image, hash_size=16):
+    """
+    Hashes the low frequencies of an image, so nearly identical images get nearly identical hashes
+    :arg image read as cv2 img
+    :arg hash_size the hash has hash_size * hash_size - 1 bits
+    :return the hash as an int
+    """
+    small = thumbnail(image, hash_size * 4)
+    frequencies = cv2.dct(small.astype(np.float32))[:hash_size, :hash_size].ravel()
+    # the constant term says nothing about the content, only about brightness
+    bits = frequencies[1:] > np.median(frequencies[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class RecognitionCache:
+    """
+    Keeps the predictions of the most recently seen card groups. A crop whose hash differs from a
+    cached one in at most tolerance bits, whose size is within size_tolerance of it, and whose
+    thumbnail differs from the cached thumbnail by at most pixel_tolerance in every pixel, gets the
+    cached prediction instead of running the model. By default only crops of an unchanged group
+    match; a looser tolerance also matches groups that moved by a few pixels, at the risk of
+    matching a group whose cards changed
+    :arg capacity the most predictions kept, the least recently used is evicted first
+    :arg tolerance the most hash bits a crop may differ by and still match
+    :arg hash_size see perceptual_hash
+    :arg size_tolerance the largest relative difference in width or height of matching crops
+    :arg pixel_tolerance the largest gray level difference of any pixel of matching thumbnails,
+    None to trust the hash alone
+    """
+
+    # the same crop of a test photo with sensor noise keeps its hash, while a shift of 2 pixels
+    # already changes 8 to 14 of the 255 bits and covering a card's corner with a different 80x80
+    # patch changes as few as 6
+    TOLERANCE = 2
+    # sensor noise changes a thumbnail pixel by at most 3 gray levels, while a different 80x80
+    # patch in a card group changes at least one by 47
+    PIXEL_TOLERANCE = 24
+
+    def __init__(self, capacity=256, tolerance=TOLERANCE, hash_size=16, size_tolerance=0.1,
+                 pixel_tolerance=PIXEL_TOLERANCE):
+        self.capacity = capacity
+        self.tolerance = tolerance
+        self.hash_size = hash_size
+        self.size_tolerance = size_tolerance
+        self.pixel_tolerance = pixel_tolerance
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # hash -> (crop height and width, thumbnail, prediction), least recently used first
+        self._entries: OrderedDict[int, tuple] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """
+        The share of lookups answered from the cache
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def key(self, crop):
+        """
+        Returns what a crop is cached under: its hash, size and thumbnail
+        """
+        small = thumbnail(crop, self.hash_size * 4)
+        return perceptual_hash(small, self.hash_size), crop.shape[:2], small
+
+    def lookup(self, key):
+        """
+        Finds the cached prediction of a crop, counting a hit or a miss
+        :arg key see key
+        :return the prediction, or None if no cached crop is close enough
+        """
+        found = self._find(key)
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(found)
+        return self._entries[found][2]
+
+    def store(self, key, prediction):
+        """
+        Caches the prediction of a crop, evicting the least recently used prediction when full
+        """
+        crop_hash, shape, small = key
+        self._entries[crop_hash] = (shape, small, prediction)
+        self._entries.move_to_end(crop_hash)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def recognize(self, crops, predict):
+        """
+        Returns the prediction of every crop, running the model only for the crops that aren't cached
+        :arg crops list of card group crops, read as cv2 img
+        :arg predict function that returns the predictions of the crops at a list of indices, in order
+        :return a list with the prediction of each crop, in order
+        """
+        keys = [self.key(crop) for crop in crops]
+        predictions = [self.lookup(key) for key in keys]
+        missing = [index for index, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            for index, prediction in zip(missing, predict(missing)):
+                predictions[index] = prediction
+                self.store(keys[index], prediction)
+        return predictions
+
+    def clear(self):
+        """
+        Forgets every cached prediction, keeping the counts
+        """
+        self._entries.clear()
+
+    def _find(self, key):
+        crop_hash, shape, small = key
+        if crop_hash in self._entries and self._matches(self._entries[crop_hash], shape, small):
+            return crop_hash
+        if not self.tolerance:
+            return None
+        # the closest cached hash within tolerance, most recently used first on ties
+        best, best_distance = None, self.tolerance + 1
+        for cached_hash in reversed(self._entries):
+            distance = (cached_hash ^ crop_hash).bit_count()
+            if distance < best_distance and self._matches(self._entries[cached_hash], shape, small):
+                best, best_distance = cached_hash, distance
+        return best
+
+    def _matches(self, entry, shape, small):
+        cached_shape, cached_small, _ = entry
+        return self._same_size(cached_shape, shape) and self._same_pixels(cached_small, small)
+
+    def _same_size(self, cached_shape, shape):
+        return all(abs(cached - size) <= self.size_tolerance * max(cached, size)
+                   for cached, size in zip(cached_shape, shape))
+
+    def _same_pixels(self, cached_small, small):
+        if self.pixel_tolerance is None:
+            return True
+        return int(cv2.absdiff(cached_small, small).max()) <= self.pixel_tolerance
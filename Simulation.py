@@ -0,0 +1,338 @@
+'''
+Description: Simulation plays whole shoes of blackjack with a pluggable strategy, dealing many
+shuffled shoes at once as NumPy arrays and spreading them over processes, to measure the EV per
+hand a strategy actually earns
+'''
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import os
+import sys
+import time
+
+import numpy as np
+
+from Algorithm import Action, ACE_CLASS, Algorithm, HI_LO_TAGS, NUM_VALUE_CLASSES
+from Monte_Carlo import add_card, VALUE_CLASS_WORTH_ARRAY
+
+
+class SimulationResult(NamedTuple):
+    """The outcome of a simulation.
+
+    hands -- the number of hands played
+    ev_per_hand -- the mean payoff per hand, in initial bets
+    standard_error -- the standard error of ev_per_hand
+    hands_per_second -- the throughput of the simulation
+    """
+    hands: int
+    ev_per_hand: float
+    standard_error: float
+    hands_per_second: float
+
+
+class BasicStrategy:
+    """Plays multi-deck basic strategy for a dealer standing on all 17s, without splitting.
+
+    surrender -- whether late surrender is used
+    """
+
+    # decisions that fall back to another action after the first two cards
+    _DOUBLE_ELSE_HIT = 5
+    _DOUBLE_ELSE_STAND = 6
+    _SURRENDER_ELSE_HIT = 7
+
+    def __init__(self, surrender: bool = True):
+        self.surrender = surrender
+
+        # decisions indexed [first decision, soft, player total, dealer upcard total]
+        self._decisions = np.zeros((2, 2, 22, 12), dtype=np.int8)
+        for soft in (False, True):
+            for player_total in range(4, 22):
+                for dealer_total in range(2, 12):
+                    decision = self._decision(player_total, soft, dealer_total)
+                    self._decisions[1, int(soft), player_total, dealer_total] = {
+                        self._DOUBLE_ELSE_HIT: Action.DOUBLE.value,
+                        self._DOUBLE_ELSE_STAND: Action.DOUBLE.value,
+                        self._SURRENDER_ELSE_HIT: Action.SURRENDER.value if surrender else Action.HIT.value,
+                    }.get(decision, decision)
+                    self._decisions[0, int(soft), player_total, dealer_total] = {
+                        self._DOUBLE_ELSE_HIT: Action.HIT.value,
+                        self._DOUBLE_ELSE_STAND: Action.STAND.value,
+                        self._SURRENDER_ELSE_HIT: Action.HIT.value,
+                    }.get(decision, decision)
+
+    def _decision(self, player_total: int, soft: bool, dealer_total: int) -> int:
+        """Returns the basic strategy decision for a hand, before falling back for later cards.
+        """
+        if soft:
+            if player_total >= 19:
+                return Action.STAND.value
+            if player_total == 18:
+                if 3 <= dealer_total <= 6:
+                    return self._DOUBLE_ELSE_STAND
+                return Action.STAND.value if dealer_total <= 8 else Action.HIT.value
+            lowest_double = {17: 3, 16: 4, 15: 4, 14: 5, 13: 5}.get(player_total, 7)
+            return self._DOUBLE_ELSE_HIT if lowest_double <= dealer_total <= 6 else Action.HIT.value
+
+        if player_total >= 17:
+            return Action.STAND.value
+        if (player_total == 16 and dealer_total >= 9) or (player_total == 15 and dealer_total == 10):
+            return self._SURRENDER_ELSE_HIT
+        if player_total >= 13:
+            return Action.STAND.value if dealer_total <= 6 else Action.HIT.value
+        if player_total == 12:
+            return Action.STAND.value if 4 <= dealer_total <= 6 else Action.HIT.value
+        if player_total == 11 or (player_total == 10 and dealer_total <= 9) \
+                or (player_total == 9 and 3 <= dealer_total <= 6):
+            return self._DOUBLE_ELSE_HIT
+        return Action.HIT.value
+
+    def decide(self, shoe_counts: np.ndarray, dealer_total: np.ndarray, player_total: np.ndarray,
+               player_soft_total: np.ndarray, first_decision: bool) -> np.ndarray:
+        """Returns the Action value played in each hand. Every strategy implements this method.
+
+        shoe_counts -- the value class counts in each hand's shoe, as of the start of the hand
+        dealer_total -- the point value of each dealer upcard
+        player_total -- the point total of each player hand
+        player_soft_total -- whether an ace in each player total can still become a 1
+        first_decision -- whether the hands still hold their first two cards, so doubling and
+        surrendering are allowed
+        """
+        return self._decisions[int(first_decision), player_soft_total.astype(np.intp), player_total, dealer_total]
+
+
+class TableStrategy:
+    """Plays the best tabled action at each shoe's Hi-Lo true count, see Strategy_Table. Counts
+    outside the table use its closest true count.
+
+    strategy_table -- the StrategyTable to look decisions up in
+    """
+
+    def __init__(self, strategy_table):
+        self.strategy_table = strategy_table
+
+    def decide(self, shoe_counts: np.ndarray, dealer_total: np.ndarray, player_total: np.ndarray,
+               player_soft_total: np.ndarray, first_decision: bool) -> np.ndarray:
+        """See BasicStrategy.decide().
+        """
+        table = self.strategy_table
+        cards_left = shoe_counts.sum(axis=1)
+        running_count = shoe_counts @ -np.array(HI_LO_TAGS)
+        true_count = np.rint(running_count / np.maximum(cards_left / 52, 1 / 52)).astype(np.intp)
+        true_count = np.clip(true_count, table.MIN_TRUE_COUNT, table.MAX_TRUE_COUNT)
+
+        entries = np.asarray(table.expected_values[true_count - table.MIN_TRUE_COUNT,
+                                                   dealer_total - table.MIN_DEALER_TOTAL,
+                                                   player_total - table.MIN_PLAYER_TOTAL,
+                                                   player_soft_total.astype(np.intp)])
+        entries = np.nan_to_num(entries, nan=-np.inf)
+        if not first_decision:
+            entries[:, Action.DOUBLE.value] = -np.inf
+        # argmax picks the first of equal EVs, which prefers standing, then hitting
+        return np.argmax(entries, axis=1).astype(np.int8)
+
+
+class AlgorithmStrategy:
+    """Plays the action with the highest exact EV, calculated by Algorithm for each hand's shoe.
+    The Algorithm is created in whichever process plays the hands, and its transposition table is
+    shared by every hand that process plays.
+
+    surrender -- whether late surrender is used
+    cache_size -- the maximum number of EV states kept in the transposition table of each process,
+    None to split Algorithm.CACHE_MEMORY_BUDGET across one process per CPU, as simulate() runs by default
+    """
+
+    def __init__(self, surrender: bool = True, cache_size: int | None = None):
+        self.surrender = surrender
+        self.cache_size = cache_size
+        self._algorithm = None
+
+    def __getstate__(self):
+        return {"surrender": self.surrender, "cache_size": self.cache_size, "_algorithm": None}
+
+    def decide(self, shoe_counts: np.ndarray, dealer_total: np.ndarray, player_total: np.ndarray,
+               player_soft_total: np.ndarray, first_decision: bool) -> np.ndarray:
+        """See BasicStrategy.decide().
+        """
+        if self._algorithm is None:
+            cache_size = Algorithm.default_cache_size(os.cpu_count()) if self.cache_size is None else self.cache_size
+            self._algorithm = Algorithm(num_decks=0, cache_size=cache_size, workers=0,
+                                        surrender=self.surrender, max_splits=0)
+        algorithm = self._algorithm
+
+        decisions = np.empty(len(player_total), dtype=np.int8)
+        for hand, (shoe_state, dealer, player, player_soft) in enumerate(
+                zip(map(tuple, shoe_counts.tolist()), dealer_total.tolist(), player_total.tolist(),
+                    player_soft_total.tolist())):
+            dealer_soft = dealer == 11
+            dealer_can_blackjack = dealer >= 10
+            player_actions = [Action.STAND, Action.HIT] + ([Action.DOUBLE] if first_decision else [])
+            hand_values = {player_action: algorithm.evaluate(player_action, shoe_state, dealer, player, player_soft,
+                                                             dealer_soft, dealer_can_blackjack)
+                           for player_action in player_actions}
+            if first_decision and self.surrender:
+                distribution = algorithm.dealer_distribution(list(shoe_state), dealer, dealer_soft,
+                                                             dealer_can_blackjack)
+                hand_values[Action.SURRENDER] = -0.5 - 0.5 * distribution[Algorithm.DEALER_BLACKJACK]
+            decisions[hand] = Algorithm.best_action(hand_values)
+        return decisions
+
+
+def simulate(strategy, num_decks: int = 6, shoes: int = 1000, penetration: float = 0.75,
+             seed: int | None = None, workers: int | None = None, shoes_per_task: int = 100,
+             blackjack_payout: float = 1.5) -> SimulationResult:
+    """Plays every hand of many shuffled shoes with a strategy. Dealers stand on all 17s and only
+    take their hole card after the player acts, so a dealer blackjack takes doubled bets too.
+    Splitting is not simulated.
+
+    The shoes are split into tasks of shoes_per_task shoes, each shuffled with its own seed spawned
+    from seed, so a seeded simulation gives the same result with any number of workers.
+
+    strategy -- a BasicStrategy, TableStrategy or AlgorithmStrategy
+    num_decks -- the number of decks in each shoe
+    shoes -- the number of shoes to play
+    penetration -- the share of each shoe dealt before it is reshuffled
+    seed -- the seed to shuffle with, None for a random one
+    workers -- the number of processes, 0 plays every shoe in this process
+    shoes_per_task -- the number of shoes one process plays at a time
+    blackjack_payout -- what a player blackjack pays per bet
+    """
+    if shoes < 1:
+        raise ValueError(f"shoes must be at least 1, got {shoes}")
+    if not 0 < penetration <= 1:
+        raise ValueError(f"penetration must be in (0, 1], got {penetration}")
+
+    task_sizes = [min(shoes_per_task, shoes - start) for start in range(0, shoes, shoes_per_task)]
+    seeds = np.random.SeedSequence(seed).spawn(len(task_sizes))
+    arguments = [(strategy, num_decks, task_shoes, penetration, blackjack_payout, task_seed)
+                 for task_shoes, task_seed in zip(task_sizes, seeds)]
+    workers = os.cpu_count() if workers is None else workers
+
+    start = time.perf_counter()
+    if workers == 0 or len(arguments) == 1:
+        results = [play_shoes(*task_arguments) for task_arguments in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(play_shoes, *zip(*arguments)))
+    elapsed = time.perf_counter() - start
+
+    hands = sum(result[0] for result in results)
+    total = sum(result[1] for result in results)
+    squares = sum(result[2] for result in results)
+    mean = total / hands
+    variance = max(squares / hands - mean * mean, 0.0)
+    return SimulationResult(hands, mean, (variance / hands) ** 0.5, hands / elapsed)
+
+
+def play_shoes(strategy, num_decks: int, shoes: int, penetration: float, blackjack_payout: float,
+               seed) -> tuple[int, float, float]:
+    """Plays every hand of a batch of shoes in lockstep and returns the number of hands played,
+    the sum of their payoffs and the sum of their squared payoffs. See simulate() for arguments.
+    """
+    rng = np.random.default_rng(seed)
+    deck = np.repeat(np.arange(NUM_VALUE_CLASSES), [4 * num_decks] * (NUM_VALUE_CLASSES - 1) + [16 * num_decks])
+    full_counts = np.bincount(deck, minlength=NUM_VALUE_CLASSES)
+
+    # each shoe is followed by one extra deck, for the rare last hand that runs past its end
+    spare = np.repeat(np.arange(NUM_VALUE_CLASSES), [4] * (NUM_VALUE_CLASSES - 1) + [16])
+    cards = np.hstack([rng.permuted(np.tile(deck, (shoes, 1)), axis=1),
+                       rng.permuted(np.tile(spare, (shoes, 1)), axis=1)])
+    position = np.zeros(shoes, dtype=np.intp)
+    shoe_counts = np.tile(full_counts, (shoes, 1))
+    cut_card = int(penetration * deck.size)
+
+    hands = 0
+    total = 0.0
+    squares = 0.0
+    while True:
+        active = np.flatnonzero(position < cut_card)
+        if not active.size:
+            break
+        payoffs = _play_hand(strategy, cards, position, shoe_counts, active, blackjack_payout)
+        hands += active.size
+        total += payoffs.sum()
+        squares += np.square(payoffs).sum()
+    return hands, float(total), float(squares)
+
+
+def _play_hand(strategy, cards: np.ndarray, position: np.ndarray, shoe_counts: np.ndarray,
+               active: np.ndarray, blackjack_payout: float) -> np.ndarray:
+    """Plays one hand in each active shoe and returns the payoffs. The shoe counts the strategy
+    sees are updated once the hand is over, the same way the cards on the table are only removed
+    from Algorithm's shoe after the hand.
+
+    cards -- the shuffled value classes of each shoe
+    position -- the index of the next card in each shoe, updated in place
+    shoe_counts -- the value class counts left in each shoe, updated in place
+    active -- the shoes that play this hand
+    """
+    hands = active.size
+    dealt = np.zeros((hands, NUM_VALUE_CLASSES), dtype=shoe_counts.dtype)
+    every_hand = np.ones(hands, dtype=bool)
+
+    def draw(drawing: np.ndarray) -> np.ndarray:
+        rows = np.flatnonzero(drawing)
+        drawn = np.zeros(hands, dtype=np.intp)
+        drawn[rows] = cards[active[rows], position[active[rows]]]
+        position[active[rows]] += 1
+        dealt[rows, drawn[rows]] += 1
+        return drawn
+
+    player, player_soft = add_card(np.zeros(hands, dtype=np.intp), np.zeros(hands, dtype=bool), draw(every_hand))
+    upcard = draw(every_hand)
+    player, player_soft = add_card(player, player_soft, draw(every_hand))
+    dealer_total = VALUE_CLASS_WORTH_ARRAY[upcard]
+    player_blackjack = player == 21
+
+    bet = np.ones(hands)
+    surrendered = np.zeros(hands, dtype=bool)
+    playing = ~player_blackjack
+    first_decision = True
+    counts = shoe_counts[active]
+    while playing.any():
+        rows = np.flatnonzero(playing)
+        decision = np.full(hands, Action.STAND.value, dtype=np.int8)
+        decision[rows] = strategy.decide(counts[rows], dealer_total[rows], player[rows], player_soft[rows],
+                                         first_decision)
+
+        surrendered |= playing & (decision == Action.SURRENDER.value)
+        doubling = playing & (decision == Action.DOUBLE.value)
+        bet[doubling] = 2
+        drawing = doubling | (playing & (decision == Action.HIT.value))
+        new_player, new_player_soft = add_card(player, player_soft, draw(drawing))
+        player = np.where(drawing, new_player, player)
+        player_soft = np.where(drawing, new_player_soft, player_soft)
+        # like the exact recursion, the player stands on 21
+        playing = drawing & ~doubling & (player < 21)
+        first_decision = False
+
+    player_bust = player > 21
+
+    # the dealer's first card is the hole card, which is the only one that can make a blackjack
+    dealer, dealer_soft = add_card(dealer_total, upcard == ACE_CLASS, draw(every_hand))
+    dealer_blackjack = (dealer_total >= 10) & (dealer == 21)
+
+    # dealer stands on all 17s, and only draws if the player's hand is still live
+    drawing = ~(player_bust | surrendered | player_blackjack | dealer_blackjack) & (dealer < 17)
+    while drawing.any():
+        new_dealer, new_dealer_soft = add_card(dealer, dealer_soft, draw(drawing))
+        dealer = np.where(drawing, new_dealer, dealer)
+        dealer_soft = np.where(drawing, new_dealer_soft, dealer_soft)
+        drawing &= dealer < 17
+
+    payoffs = np.where(player_bust | dealer_blackjack, -bet,
+                       np.where(dealer > 21, bet, np.sign(player - dealer) * bet))
+    payoffs = np.where(surrendered, np.where(dealer_blackjack, -1.0, -0.5), payoffs)
+    payoffs = np.where(player_blackjack, np.where(dealer_blackjack, 0.0, blackjack_payout), payoffs)
+
+    shoe_counts[active] -= dealt
+    return payoffs
+
+
+if __name__ == "__main__":
+    # e.g. python Simulation.py basic 6 2000, or python Simulation.py exact 8 30 for the exact
+    # strategy over 30 eight-deck shoes, which takes several minutes
+    strategies = {"basic": BasicStrategy, "exact": AlgorithmStrategy}
+    name, num_decks, shoes = (sys.argv[1:] + ["basic", "6", "2000"][len(sys.argv) - 1:])[:3]
+    result = simulate(strategies[name](), int(num_decks), int(shoes), seed=0)
+    print(f"{result.hands} hands: EV {result.ev_per_hand:+.4f} +/- {result.standard_error:.4f} per hand, "
+          f"{result.hands_per_second:,.0f} hands/sec")
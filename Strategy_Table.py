@@ -0,0 +1,175 @@
+'''
+Description: Strategy_Table generates, saves and looks up precomputed EVs for every dealer upcard
+and player total at each Hi-Lo true count, so most decisions skip the exact recursion in Algorithm
+'''
+import os
+import sys
+
+import numpy as np
+
+from Algorithm import Action, Algorithm, CardRank, EstimatedValue, hi_lo_true_count
+
+
+class StrategyTable:
+    """EVs of hitting, standing and doubling for every (true count, dealer upcard, player total,
+    soft/hard) entry, computed exactly on a representative shoe for each true count. Tables are
+    stored as .npy files and memory-mapped, so loading one is instant and lookups only touch the
+    pages they need. Splitting and surrendering are left to Algorithm, which adds them on top.
+
+    num_decks -- the number of decks in the shoe the table was generated for
+    expected_values -- float32 array indexed [true count, upcard, player total, soft, Action.value];
+    entries for impossible hands are NaN
+    """
+
+    # true counts are rounded to the nearest whole bucket in this range
+    MIN_TRUE_COUNT = -6
+    MAX_TRUE_COUNT = 6
+    # close to the end of the shoe its exact composition matters more than its true count
+    MIN_DECKS_REMAINING = 1.0
+
+    # a dealer upcard's point total, two through ace, indexes the upcard axis after subtracting this
+    MIN_DEALER_TOTAL = 2
+    # player totals from 4 (a pair of twos) to 21
+    MIN_PLAYER_TOTAL = 4
+    MAX_PLAYER_TOTAL = 21
+
+    # the actions stored for each entry, indexed by their Action value
+    TABLED_ACTIONS = (Action.STAND, Action.HIT, Action.DOUBLE)
+
+    DEFAULT_DIRECTORY = "strategy_tables"
+
+    def __init__(self, num_decks: int, expected_values: np.ndarray):
+        self.num_decks = num_decks
+        self.expected_values = expected_values
+
+    @staticmethod
+    def path_for(num_decks: int) -> str:
+        """Returns the default table file for a shoe of num_decks decks.
+        """
+        return os.path.join(StrategyTable.DEFAULT_DIRECTORY, f"strategy_{num_decks}_decks.npy")
+
+    @classmethod
+    def load(cls, num_decks: int, path: str | None = None) -> "StrategyTable":
+        """Memory-maps a saved table, see generate().
+
+        num_decks -- the number of decks in the shoe the table was generated for
+        path -- the table file, defaults to path_for(num_decks)
+
+        ValueError -- if the file doesn't hold a table of the expected shape
+        """
+        path = path or cls.path_for(num_decks)
+        expected_values = np.load(path, mmap_mode="r")
+        if expected_values.shape != cls.shape():
+            raise ValueError(f"{path} has shape {expected_values.shape}, expected {cls.shape()}")
+        return cls(num_decks, expected_values)
+
+    @classmethod
+    def shape(cls) -> tuple[int, ...]:
+        """Returns the shape of the expected_values array.
+        """
+        return (cls.MAX_TRUE_COUNT - cls.MIN_TRUE_COUNT + 1, 10,
+                cls.MAX_PLAYER_TOTAL - cls.MIN_PLAYER_TOTAL + 1, 2, len(cls.TABLED_ACTIONS))
+
+    def lookup(self, shoe: Algorithm.Shoe, dealer_total: int, player_total: int,
+               player_soft_total: bool) -> dict[Action, EstimatedValue] | None:
+        """Returns the tabled EV of each action, or None if the shoe or hand is outside the table
+        and the EVs have to be calculated exactly.
+
+        shoe -- the current shoe
+        dealer_total -- the point value of the card the dealer is showing
+        player_total -- the current point total of the player's cards
+        player_soft_total -- whether an ace in the player's total can still become a 1
+        """
+        if shoe.num_decks != self.num_decks or shoe.decks_remaining() < self.MIN_DECKS_REMAINING:
+            return None
+        true_count = round(shoe.true_count())
+        if not self.MIN_TRUE_COUNT <= true_count <= self.MAX_TRUE_COUNT:
+            return None
+        if not self.MIN_PLAYER_TOTAL <= player_total <= self.MAX_PLAYER_TOTAL:
+            return None
+
+        entry = self.expected_values[true_count - self.MIN_TRUE_COUNT, dealer_total - self.MIN_DEALER_TOTAL,
+                                     player_total - self.MIN_PLAYER_TOTAL, int(player_soft_total)]
+        if np.isnan(entry[Action.HIT.value]):
+            return None
+        return {player_action: EstimatedValue(float(entry[player_action.value]), 0.0, 0)
+                for player_action in self.TABLED_ACTIONS}
+
+    @classmethod
+    def generate(cls, num_decks: int, path: str | None = None, workers: int | None = None) -> "StrategyTable":
+        """Calculates every table entry exactly and saves the table. This takes a while, and is
+        meant to be run offline once per number of decks.
+
+        num_decks -- the number of decks in the shoe
+        path -- the table file, defaults to path_for(num_decks)
+        workers -- the number of evaluator processes, see Algorithm
+        """
+        path = path or cls.path_for(num_decks)
+        hand_states = [(total, False) for total in range(cls.MIN_PLAYER_TOTAL, cls.MAX_PLAYER_TOTAL + 1)]
+        hand_states += [(total, True) for total in range(12, cls.MAX_PLAYER_TOTAL + 1)]
+        hands = [cls.representative_hand(player_total, player_soft_total)
+                 for player_total, player_soft_total in hand_states]
+        upcards = [CardRank.TWO, CardRank.THREE, CardRank.FOUR, CardRank.FIVE, CardRank.SIX,
+                   CardRank.SEVEN, CardRank.EIGHT, CardRank.NINE, CardRank.TEN, CardRank.ACE]
+
+        expected_values = np.full(cls.shape(), np.nan, dtype=np.float32)
+        for true_count in range(cls.MIN_TRUE_COUNT, cls.MAX_TRUE_COUNT + 1):
+            algorithm = Algorithm(num_decks, workers=workers, surrender=False, max_splits=0)
+            algorithm.observe_cards(cls.cards_for_true_count(algorithm.shoe, true_count))
+            for upcard in upcards:
+                batch = algorithm.action_batch(upcard, hands)
+                for (player_total, player_soft_total), hand_values in zip(hand_states, batch):
+                    for player_action, expected_value in hand_values.items():
+                        expected_values[true_count - cls.MIN_TRUE_COUNT, upcard.worth() - cls.MIN_DEALER_TOTAL,
+                                        player_total - cls.MIN_PLAYER_TOTAL, int(player_soft_total),
+                                        player_action.value] = expected_value
+            algorithm.shutdown()
+            print(f"Tabled true count {true_count} for {num_decks} decks")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.save(path, expected_values)
+        return cls.load(num_decks, path)
+
+    @staticmethod
+    def representative_hand(player_total: int, player_soft_total: bool) -> list[CardRank]:
+        """Returns a hand with the given total. The EV calculations only depend on the total.
+        """
+        ranks = {rank.worth(): rank for rank in CardRank if rank not in (CardRank.JACK, CardRank.QUEEN, CardRank.KING)}
+        if player_soft_total:
+            # an ace as 11 and the rest, soft 12 being a pair of aces
+            return [CardRank.ACE, ranks[player_total - 11] if player_total > 12 else CardRank.ACE]
+        if player_total <= 11:
+            return [CardRank.TWO, ranks[player_total - 2]]
+        if player_total <= 20:
+            return [CardRank.TEN, ranks[player_total - 10]]
+        return [CardRank.TEN, CardRank.FIVE, CardRank.SIX]
+
+    @staticmethod
+    def cards_for_true_count(shoe: Algorithm.Shoe, true_count: int) -> list[CardRank]:
+        """Returns the cards to deal out of a full shoe to bring it to a true count, taking low
+        cards for positive counts and high cards for negative ones, always from the rank that has
+        the most cards left so the shoe stays balanced.
+
+        shoe -- a full shoe
+        true_count -- the target Hi-Lo true count
+        """
+        if true_count >= 0:
+            candidates = [CardRank.TWO, CardRank.THREE, CardRank.FOUR, CardRank.FIVE, CardRank.SIX]
+        else:
+            candidates = [CardRank.ACE, CardRank.TEN, CardRank.JACK, CardRank.QUEEN, CardRank.KING]
+
+        rank_counts = dict(shoe.rank_counts)
+        value_counts = list(shoe.value_counts)
+        dealt = []
+        while abs(hi_lo_true_count(value_counts)) < abs(true_count):
+            rank = max(candidates, key=lambda candidate: rank_counts[candidate])
+            rank_counts[rank] -= 1
+            value_counts[rank.value_class()] -= 1
+            dealt.append(rank)
+        return dealt
+
+
+if __name__ == "__main__":
+    # Generate the tables offline, e.g. python Strategy_Table.py 6 8
+    for num_decks in [int(argument) for argument in sys.argv[1:]] or [6]:
+        StrategyTable.generate(num_decks)